@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Optional dense-vector search engine (``BOOKSHELF_SEARCH_ENGINE=ann``).
+
+The TF-IDF matrix is reduced to ``N_COMPONENTS`` dimensions with
+TruncatedSVD (LSA), so books can match a query on related terms they do not
+contain. The L2-normalized embeddings are clustered with k-means into an
+inverted file (IVF): a query is compared with the cluster centroids and only
+the rows of the ``nprobe`` closest clusters are scored.
+
+Stored under ``<index>/ann/``: one float32 SVD vector per term, the centroids,
+the rows grouped by cluster with their offsets, and the embeddings in the
+same order as float16. Built by ``python build_index.py --ann`` or, when
+missing, at startup.
+
+``AnnIndex`` has the search interface of ``tfidf_index.TfidfIndex``
+(``matches``/``search_vector``/``search`` and ``vectorizer``), so callers
+pick either engine.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+import tfidf_index
+
+N_COMPONENTS = 128
+NPROBE = int(os.environ.get("BOOKSHELF_ANN_NPROBE", 16))
+# k-means is fitted on a sample of the rows; the rest are only assigned
+KMEANS_SAMPLE = 200_000
+
+
+class AnnIndex:
+    """LSA embeddings of the books behind an IVF index."""
+
+    def __init__(self, vectorizer, term_vectors, centroids, list_offsets, rows, vectors, nprobe=NPROBE):
+        self.vectorizer = vectorizer
+        self.term_vectors = term_vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.nprobe = nprobe
+        self.n_rows = len(rows)
+
+    def embed(self, query_vec):
+        """L2-normalized embedding of a TF-IDF query vector (all zeros for no known terms)."""
+        # Only the query's own term rows are read
+        query_vec = query_vec.tocsr()
+        q = (query_vec.data.astype(np.float32) @ self.term_vectors[query_vec.indices]).ravel()
+        norm = np.linalg.norm(q)
+        return q / norm if norm else q
+
+    def matches(self, query_vec, mask=None, nprobe=None):
+        """Rows in the probed clusters (and ``mask``) with a positive score, unordered."""
+        q = self.embed(query_vec)
+        if not q.any():
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+
+        starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+        rows = np.concatenate([self.rows[start:end] for start, end in zip(starts, ends)]).astype(np.int64)
+        vectors = np.concatenate([self.vectors[start:end] for start, end in zip(starts, ends)])
+        scores = vectors.astype(np.float32) @ q
+        keep = scores > 0
+        if mask is not None:
+            keep &= mask[rows]
+        return rows[keep], scores[keep]
+
+    def match_rows(self, query_vec, mask=None, nprobe=None):
+        """The rows ``matches`` returns, sorted; only their scores tell them apart, so they are scored."""
+        return np.sort(self.matches(query_vec, mask, nprobe)[0])
+
+    def search_vector(self, query_vec, k=20, mask=None):
+        return tfidf_index.top_k(*self.matches(query_vec, mask), k)
+
+    def search(self, query, k=20, mask=None):
+        """Top ``k`` rows for ``query`` as ``(rows, scores)``, best first (approximate)."""
+        return self.search_vector(self.vectorizer.transform([query]), k, mask)
+
+
+def build(index, n_components=N_COMPONENTS, n_lists=None, seed=0):
+    """Fit the SVD and the IVF clusters on a ``TfidfIndex``."""
+    # Only building and updating need scikit-learn (see tfidf_index.make_vectorizer)
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.preprocessing import normalize
+    matrix = index.full_matrix()
+    n_components = min(n_components, matrix.shape[1] - 1, matrix.shape[0] - 1)
+    svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=seed)
+    embeddings = normalize(svd.fit_transform(matrix)).astype(np.float32)
+
+    # About 4 * sqrt(n) clusters keeps both the centroid scan and the probed lists short
+    n_lists = n_lists or max(1, min(int(4 * np.sqrt(len(embeddings))), len(embeddings)))
+    rng = np.random.default_rng(seed)
+    sample = embeddings if len(embeddings) <= KMEANS_SAMPLE else embeddings[rng.choice(len(embeddings), KMEANS_SAMPLE, replace=False)]
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, n_init=1, random_state=seed).fit(sample)
+    labels = kmeans.predict(embeddings)
+
+    order = np.argsort(labels, kind="stable")
+    list_offsets = np.searchsorted(labels[order], np.arange(n_lists + 1)).astype(np.int64)
+    centroids = normalize(kmeans.cluster_centers_).astype(np.float32)
+    return AnnIndex(
+        index.vectorizer,
+        np.ascontiguousarray(svd.components_.T, dtype=np.float32),
+        centroids,
+        list_offsets,
+        order.astype(np.int32),
+        embeddings[order].astype(np.float16),
+    )
+
+
+def update(ann, index, rows):
+    """``ann`` with ``rows`` of the TF-IDF ``index`` embedded again and put in their closest cluster.
+
+    For incremental updates: the SVD and the clusters stay as they are, and
+    terms new since the build get a zero vector.
+    """
+    from sklearn.preprocessing import normalize
+    rows = np.asarray(rows, dtype=np.int64)
+    term_vectors = np.asarray(ann.term_vectors)
+    n_terms = index.n_terms
+    if n_terms > len(term_vectors):
+        term_vectors = np.vstack([term_vectors, np.zeros((n_terms - len(term_vectors), term_vectors.shape[1]), dtype=np.float32)])
+    embeddings = normalize(np.asarray(index.row_vectors(rows) @ term_vectors)).astype(np.float32)
+    labels = np.argmax(embeddings @ ann.centroids.T, axis=1)
+
+    old_labels = np.repeat(np.arange(len(ann.centroids)), np.diff(ann.list_offsets))
+    keep = ~np.isin(ann.rows, rows)
+    labels = np.concatenate([old_labels[keep], labels])
+    order = np.argsort(labels, kind="stable")
+    return AnnIndex(
+        index.vectorizer,
+        term_vectors,
+        ann.centroids,
+        np.searchsorted(labels[order], np.arange(len(ann.centroids) + 1)).astype(np.int64),
+        np.concatenate([ann.rows[keep], rows.astype(np.int32)])[order],
+        np.concatenate([ann.vectors[keep], embeddings.astype(np.float16)])[order],
+        ann.nprobe,
+    )
+
+
+_ARRAYS = ["term_vectors", "centroids", "list_offsets", "rows", "vectors"]
+
+
+def save(ann, path):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in _ARRAYS:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(ann, name))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"n_components": ann.term_vectors.shape[1], "n_lists": len(ann.centroids)}, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load(path, vectorizer, nprobe=NPROBE):
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in _ARRAYS}
+    # The small arrays are read on every query; keep them in memory
+    for name in ("centroids", "list_offsets"):
+        arrays[name] = np.asarray(arrays[name])
+    return AnnIndex(vectorizer, nprobe=nprobe, **arrays)
+
+
+def ensure(index_dir, index):
+    """The ANN index stored with ``index_dir``, building it first if it is missing.
+
+    The build holds the build lock of the index root, so that workers
+    starting together build it once.
+    """
+    path = os.path.join(index_dir, "ann")
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        with tfidf_index.build_lock(os.path.dirname(index_dir)):
+            if not os.path.exists(os.path.join(path, "meta.json")):
+                save(build(index), path)
+    return load(path, index.vectorizer)
@@ -5,59 +5,78 @@ Created on Thu Jul 17 07:24:59 2025
 @author: win11
 """
 
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+import flask
 import dash
 from dash import dcc, html, Input, Output, State, callback_context
 import dash_bootstrap_components as dbc
-from itertools import chain
+from collections import OrderedDict
+import functools
 import numpy as np
+import logging
+import os
+import threading
+import json
+from datetime import date
 
-vizro_bootstrap = "https://cdn.jsdelivr.net/gh/mckinsey/vizro@main/vizro-core/src/vizro/static/css/vizro-bootstrap.min.css?v=2"
+import app_context
+import metrics
+import search_service
 
+vizro_bootstrap = "https://cdn.jsdelivr.net/gh/mckinsey/vizro@main/vizro-core/src/vizro/static/css/vizro-bootstrap.min.css?v=2"
 
-# Load data
-books_df = pd.read_csv("goodreads_works_v1.csv")
-reviews_df = pd.read_csv("goodreads_reviews.csv", low_memory=False)
 
-# Merge reviews into books
-reviews_grouped = reviews_df.groupby("work_id")["review_text"].apply(lambda texts: " ".join(str(t) for t in texts)).reset_index()
-books_df = books_df.merge(reviews_grouped, on="work_id", how="left")
+# Startup reports (catalog memory per column, index builds) go to the log
+logging.basicConfig(level=os.environ.get("BOOKSHELF_LOG_LEVEL", "INFO"), format="%(message)s")
 
-# Convert genre strings to lists and collect unique genres
-books_df["genre_list"] = books_df["genres"].fillna("").apply(lambda g: [genre.strip() for genre in g.split(",") if genre.strip()])
-unique_genres = sorted(set(chain.from_iterable(books_df["genre_list"])))
+# Load data
+# The catalog and every index on it come from the index written by
+# build_index.py (the reviews CSV is only read when no index matches the
+# current CSVs); generations added later by update_index.py are swapped in
+# while serving. Nothing is loaded on import: the first request starts the
+# warm-up in the background and /healthz answers at once (see app_context.py)
+bookshelf = app_context.BookshelfHolder()
 
 # -----------------------
-# ✳️ Normalize & prioritize fields
+# Dash App with Bootstrap
 # -----------------------
-books_df["original_title_lower"] = books_df["original_title"].fillna("").str.lower()
-books_df["author_lower"] = books_df["author"].fillna("").str.lower()
-books_df["genres_lower"] = books_df["genres"].fillna("").str.lower()
-books_df["description_lower"] = books_df["description"].fillna("").str.lower()
-books_df["review_text_lower"] = books_df["review_text"].fillna("").str.lower()
-
-# Boost important fields like author and genres (using lowercase versions)
-books_df["text"] = (
-    (books_df["original_title_lower"] + " ") +
-    (books_df["genres_lower"] + " ") * 2 +
-    books_df["description_lower"] + " " +
-    (books_df["author_lower"] + " ") * 4 +
-    books_df["review_text_lower"]
-)
-
+#app = dash.Dash(__name__, external_stylesheets=[dbc.themes.LUX])
 # -----------------------
-# ✳️ TF-IDF
+# Background callbacks
 # -----------------------
-vectorizer = TfidfVectorizer(stop_words="english")
-tfidf_matrix = vectorizer.fit_transform(books_df["text"])
+# With BOOKSHELF_BACKGROUND_CALLBACKS=1 the search and the details modal run
+# as Dash background callbacks: every call is a job in a process forked from
+# the worker (sharing its loaded indexes), with its result handed back
+# through a diskcache directory; no broker needed. The worker thread only
+# starts the job and answers the browser's polls, so a slow broad-genre
+# search no longer holds it while quick lookups queue behind. A search the
+# user has typed past is killed: the browser sends its job along with the
+# next call of the same callback and Dash terminates it.
+# Needs `pip install "dash[diskcache]"`. Jobs do not write back into the
+# worker's in-memory caches (rendered cards, favorites profiles); the ranked
+# results cache is an SQLite file and is shared as before.
+BACKGROUND_CALLBACKS = os.environ.get("BOOKSHELF_BACKGROUND_CALLBACKS", "0") == "1"
+# How often the browser polls a running job
+BACKGROUND_POLL_MS = int(os.environ.get("BOOKSHELF_BACKGROUND_POLL_MS", 250))
+JOBS_DIR = os.environ.get("BOOKSHELF_JOBS_DIR", "callback_jobs")
 
-# -----------------------
-# Dash App with Bootstrap
-# -----------------------
-#app = dash.Dash(__name__, external_stylesheets=[dbc.themes.LUX])
-app = dash.Dash(__name__, external_stylesheets=[vizro_bootstrap, dbc.icons.FONT_AWESOME])
+if BACKGROUND_CALLBACKS:
+    import diskcache
+    background_callback_manager = dash.DiskcacheManager(diskcache.Cache(JOBS_DIR))
+else:
+    background_callback_manager = None
+
+
+def background_options(cancel=()):
+    """Extra ``app.callback`` arguments of a callback that runs as a background job when enabled.
+
+    A change of any ``cancel`` input kills the running job.
+    """
+    if not BACKGROUND_CALLBACKS:
+        return {}
+    return {"background": True, "interval": BACKGROUND_POLL_MS, "cancel": list(cancel)}
+
+
+app = dash.Dash(__name__, external_stylesheets=[vizro_bootstrap, dbc.icons.FONT_AWESOME], background_callback_manager=background_callback_manager)
 # Add custom favicon
 app._favicon = "logo.png"
 
@@ -119,7 +138,9 @@ dbc.Row([
                     id="query-input", 
                     placeholder="Enter keywords, author name or title ...", 
                     size="lg", 
-                    debounce=True  # This triggers callback on Enter or after pause
+                    debounce=True,  # This triggers callback on Enter or after pause
+                    list="query-suggestions",  # Filled while typing by assets/suggest.js
+                    autocomplete="off"
                     ),
                 
             dbc.Button(
@@ -130,25 +151,49 @@ dbc.Row([
                 size="lg"
             ),
             dbc.Button(html.I(className="fa fa-search me-2"), id="search-button", color="primary", n_clicks=0, size="lg")
-                ], className="mb-3")
+                ], className="mb-3"),
+            html.Datalist(id="query-suggestions")
         ], className="col-12 col-md-6"),
    # ]),
     
    # dbc.Row([
         dbc.Col([
-            dbc.Select(
+            dcc.Dropdown(
                 id="genre-filter",
-                options=[{"label": "All genres", "value": "All"}] + [{"label": genre, "value": genre} for genre in unique_genres],
-                value="All",  # Set default value
-                placeholder="Filter by genre...",
+                options=[],  # Filled in by genre_options once the catalog is loaded
+                value=[],  # Empty selection means all genres
+                multi=True,
+                placeholder="All genres",
+                className="mb-2"
+            ),
+            dbc.Switch(
+                id="genre-match-all",
+                label="Books must have all selected genres",
+                value=False,
+                className="mb-2"
+            ),
+            dbc.Switch(
+                id="for-you-switch",
+                label="Recommended for you, based on your favorites",
+                value=False,
                 className="mb-4"
             )
         ], className="col-12 col-md-6")
     ]),
     
+    dcc.Store(id="results-cursor", data=None),
     dbc.Row([
         dbc.Col([
-            html.Div(id="results-container")
+            html.P(id="results-count", className="text-muted mb-2"),
+            html.Div(id="results-container"),
+            dbc.Pagination(
+                id="results-pages",
+                max_value=1,
+                active_page=1,
+                fully_expanded=False,
+                previous_next=True,
+                className="d-none"
+            )
         ],  className="col-12")
     ]),
     
@@ -193,15 +238,20 @@ dbc.Row([
         dbc.AccordionItem(
             [
                 dcc.Markdown('''
-                   If you enter one or more keywords this is happening in this order:
+                   If you enter one or more keywords, titles, authors and the text of the books
+                   are all searched at once. The results are ordered like this:
                        
-                   * Author: if you enter an authorname or a string that is part of an authorname,
-                   you will get a list of the authors books in return. The result is ordered by
-                   relevance.
-                   * Title: if your keyword(s) match part or a booktitle, those books will be
-                   returned. The result is ordered by most recent book first.
-                   * If both search attempts give an empty result, the system uses intelligence
-                   to find the most appropriate books for your query. The result is ordered by relevance.
+                   * Books whose title or author is exactly your keywords come first.
+                   * Then books whose title starts with your keywords.
+                   * Then books whose title or author contains your keywords.
+                   * Then all other books that match your keywords, the most relevant first.
+                   
+                   Within each group the most relevant book comes first, and books that are
+                   equally relevant are ordered by most recent book first.
+                   
+                   While you type, matching titles and authors are suggested below the search box.
+                   If a misspelled word gives no results (for example "crighton"), the search is
+                   repeated with the closest title or author word ("crichton").
                    
                    
                    Warning: if you search for example for an author in a genre which was not assigned
@@ -221,10 +271,24 @@ dbc.Row([
                * Startingpoint: select a genre without keywords
                * Filter: select a combination of genre and keyword(s)
                
+               You can select more than one genre. By default a book needs one of
+               the selected genres; switch on "all selected genres" to only see books
+               that have every one of them.
+               
                Warning: most books are assigned to many genres.
 
         '''),
             title="Genres",
+        ),
+        dbc.AccordionItem(
+            dcc.Markdown('''
+               Switch on "Recommended for you" to see books that resemble the
+               books you loved, most similar first. Books you already loved are
+               left out, and the genre filter still applies. Keywords are ignored
+               while the switch is on.
+
+        '''),
+            title="Recommended for you",
         ),
             dbc.AccordionItem(
                 dcc.Markdown('''
@@ -274,7 +338,6 @@ dbc.Row([
                 Possible improvements list:          
                           
                 * back button going to previous query result
-                * number of results for query
                 * test a bit more with NLP
                 
 
@@ -295,26 +358,43 @@ dbc.Row([
 ),
 ], fluid=False, id="main-container")
 
+# -----------------------
+# Favorites
+# -----------------------
+def loved_work_ids(shelf, loved_books):
+    """work_ids in the loved-books store, in the order they were loved.
+
+    Old "<title>_<author>" entries are converted (the store is rewritten on
+    the next toggle). Entries this generation does not know are kept as
+    they are, so that rewriting the store does not drop them; lookups skip
+    them.
+    """
+    work_index = shelf.work_index
+    work_ids = []
+    for book in loved_books or []:
+        if isinstance(book, dict):
+            book = book.get('id')
+        if book in work_index:
+            work_id = int(book)
+        elif isinstance(book, str):
+            work_id = shelf.legacy_work_id(book) or book
+        else:
+            work_id = book
+        if work_id is not None and work_id not in work_ids:
+            work_ids.append(work_id)
+    return work_ids
+
+
 # -----------------------
 # Helper function to create book card
 # -----------------------
-def create_book_card(book, loved_books):
+def create_book_card(book, loved_ids):
     # Check if image_url exists, otherwise use placeholder
     image_url = book.get('image_url', f"https://via.placeholder.com/120x180.png?text={book['original_title'][:10]}...")
     
     # Check if this book is loved
-    book_id = f"{book['original_title']}_{book['author']}"  # Create unique ID
-    
-    # Check if book is in loved_books (handle both dict and string formats)
-    is_loved = False
-    for loved_book in loved_books:
-        if isinstance(loved_book, dict):
-            if loved_book.get('id') == book_id:
-                is_loved = True
-                break
-        elif loved_book == book_id:
-            is_loved = True
-            break
+    book_id = int(book['work_id'])
+    is_loved = book_id in loved_ids
     
     card = dbc.Card([
         dbc.Row([
@@ -354,7 +434,7 @@ def create_book_card(book, loved_books):
                     ], className="text-muted mb-3"),
                     html.P([
                         dbc.Badge(f"{int(book['original_publication_year'])}", color="primary", className="me-2 mt-2"),
-                        dbc.Badge(f"★ {book['avg_rating']}", color="warning", className="me-2 mt-2"),
+                        dbc.Badge(f"★ {book['avg_rating']:g}", color="warning", className="me-2 mt-2"),
                         dbc.Badge(
                              "Pages unknown" if np.isnan(book['num_pages']) else f"{int(book['num_pages'])} pages" , 
                             color="secondary", className="me-2 mt-2"),
@@ -367,7 +447,7 @@ def create_book_card(book, loved_books):
                     ),
                     dbc.Button(
                         "Details",
-                        id={"type": "details-button", "index": book.get('work_id', '')},
+                        id={"type": "details-button", "index": book_id},
                         color="secondary",
                         outline=False,
                         size="sm",
@@ -380,6 +460,95 @@ def create_book_card(book, loved_books):
     
     return card
 
+
+# Rendered cards kept per worker; a popular book is rendered once, not on every search
+CARD_CACHE_SIZE = int(os.environ.get("BOOKSHELF_CARD_CACHE_SIZE", 2000))
+
+
+def _love_button_path(node, path=()):
+    # Keys from the root of a serialized card to the props of its heart button
+    if isinstance(node, dict):
+        button_id = node.get("props", {}).get("id")
+        if isinstance(button_id, dict) and button_id.get("type") == "love-button":
+            return (*path, "props")
+        items = node.items()
+    elif isinstance(node, list):
+        items = enumerate(node)
+    else:
+        return None
+    for key, child in items:
+        found = _love_button_path(child, (*path, key))
+        if found:
+            return found
+    return None
+
+
+def _replace(node, path, value):
+    # Copy of node with the item at path replaced; only the containers on the path are copied
+    if not path:
+        return value
+    node = node.copy()
+    node[path[0]] = _replace(node[path[0]], path[1:], value)
+    return node
+
+
+class CardCache:
+    """Book cards serialized once per work_id, least recently used evicted first.
+
+    A card is stored as the plain JSON tree Dash sends to the browser, so a
+    cached card costs neither the component tree, its description lookup nor
+    its serialization. Only the heart button depends on the user: the few
+    dicts from the root to that button are copied and its state set, the
+    rest of the tree is shared.
+    """
+
+    def __init__(self, max_entries=CARD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.cards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def render(self, shelf, rows, loved_ids):
+        """Cards of books ``rows`` of ``shelf`` in order, hearts set for ``loved_ids``."""
+        timer = metrics.Stopwatch()
+        # Keyed on the index generation too: its cards are rendered again
+        keys = [(shelf.index_dir, int(work_id)) for work_id in shelf.books_df["work_id"].to_numpy()[rows]]
+        with self._lock:
+            entries = [self.cards.get(key) for key in keys]
+            missing = [i for i, entry in enumerate(entries) if entry is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            books = search_service.book_records(shelf, np.asarray(rows)[missing])
+            # One serialization for all the new cards; plotly's encoder is imported with the first one
+            from plotly.io.json import to_json_plotly
+            rendered = json.loads(to_json_plotly([create_book_card(book, ()) for book in books]))
+            for i, card in zip(missing, rendered):
+                entries[i] = (card, _love_button_path(card))
+        with self._lock:
+            for key, entry in zip(keys, entries):
+                self.cards[key] = entry
+                self.cards.move_to_end(key)
+            while len(self.cards) > self.max_entries:
+                self.cards.popitem(last=False)
+
+        cards = []
+        for (_, work_id), (card, path) in zip(keys, entries):
+            is_loved = work_id in loved_ids
+            props = functools.reduce(lambda node, key: node[key], path, card)
+            cards.append(_replace(card, path, {**props, "color": "danger" if is_loved else "secondary", "outline": not is_loved}))
+        # Includes the "records" stage of the cards rendered anew
+        timer.lap("cards")
+        return cards
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.cards), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+card_cache = CardCache()
+
 # -----------------------
 # Callback for theme switching
 # -----------------------
@@ -402,13 +571,15 @@ def switch_theme(dark_mode):
     prevent_initial_call=True
 )
 def update_loved_books(n_clicks_list, loved_books):
+    # Also fires when a new page of cards appears; leave the store alone then
+    # so the hearts are not restyled for nothing
     if not any(n_clicks_list):
-        return loved_books
+        return dash.no_update
     
     # Get which button was clicked
     ctx = callback_context
-    if not ctx.triggered:
-        return loved_books
+    if not ctx.triggered or not ctx.triggered[0].get("value"):
+        return dash.no_update
     
     # Extract button info
     button_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -416,104 +587,280 @@ def update_loved_books(n_clicks_list, loved_books):
     button_dict = json.loads(button_id)
     book_id = button_dict["index"]
     
-    # Convert loved_books to a list of IDs if needed
-    loved_book_ids = []
-    for book in loved_books:
-        if isinstance(book, dict):
-            loved_book_ids.append(book['id'])
-        else:
-            loved_book_ids.append(book)
+    # The store only holds work_ids; older entries are converted here
+    shelf = bookshelf.current()
+    loved_book_ids = loved_work_ids(shelf, loved_books)
+    before = search_service.profile_favorites(shelf, loved_book_ids)
     
     # Toggle love status
     if book_id in loved_book_ids:
         # Remove the book
-        loved_books = [b for b in loved_books if (isinstance(b, dict) and b['id'] != book_id) or (isinstance(b, str) and b != book_id)]
+        loved_book_ids.remove(book_id)
     else:
-        # Add the book (we'll store full data in the export callback)
-        loved_books.append(book_id)
+        # Add the book (title and author are looked up in the export callback)
+        loved_book_ids.append(book_id)
+    
+    # Update the profile used by "Recommended for you" from the previous one
+    after = search_service.profile_favorites(shelf, loved_book_ids)
+    if after != before:
+        shelf.profiles.update(shelf.work_index.lookup(before), shelf.work_index.lookup(after))
     
-    return loved_books
+    return loved_book_ids
+
+
+# -----------------------
+# Ranking
+# -----------------------
+def results_summary(total, n_ranked):
+    if total > n_ranked:
+        return f"{total} books found, showing the best {n_ranked}"
+    return f"{total} book found" if total == 1 else f"{total} books found"
+
+
+# -----------------------
+# Warm-up and health checks
+# -----------------------
+@app.server.before_request
+def warm_up():
+    # Any first request (a health probe, the page) starts loading the
+    # bookshelf without waiting for it; later requests return at once
+    if not bookshelf.ready:
+        bookshelf.warm_up()
+        if BACKGROUND_CALLBACKS and flask.request.path.endswith("_dash-update-component"):
+            # Jobs are forked from this process: never while the warm-up
+            # thread holds locks (imports, the load) the child would inherit
+            bookshelf.current()
+
+
+@app.server.route("/healthz")
+def healthz():
+    """Liveness: the worker answers, loaded or not."""
+    return flask.jsonify({"status": "ok"})
+
+
+@app.server.route("/readyz")
+def readyz():
+    """Readiness: 200 once the bookshelf is loaded, 503 while warming up or after a failed load."""
+    status = bookshelf.status()
+    return flask.jsonify(status), 200 if status["status"] == "ready" else 503
+
+
+def warming_up_response():
+    return flask.jsonify({"error": "warming up, retry shortly", **bookshelf.status()}), 503, {"Retry-After": "5"}
+
+
+# -----------------------
+# Search box suggestions
+# -----------------------
+@app.server.route("/suggest")
+def suggest():
+    """Completions for the search box as a JSON list; fetched on every keystroke by assets/suggest.js."""
+    if not bookshelf.ready:
+        return flask.jsonify([])
+    return flask.jsonify(bookshelf.current().suggestions.suggest(flask.request.args.get("q", "")))
+
+
+# -----------------------
+# JSON API
+# -----------------------
+# Search, recommendations and details for other services and load tests,
+# without Dash components (see search_service.py):
+#
+#   GET  /api/search?q=dune&genre=fantasy&match_all=1&page=2&page_size=20
+#   POST /api/search        one search as a JSON object with the same fields
+#                           ("genres" and "loved" as lists), or
+#                           {"queries": [...]} for a batch
+#   GET  /api/books/<work_id>
+#
+# "loved" (work_ids) asks for the recommendations for those favorites;
+# "cursor" from an earlier result pages through that search.
+API_MAX_BATCH = int(os.environ.get("BOOKSHELF_API_MAX_BATCH", 100))
+API_MAX_PAGE_SIZE = 100
+
+
+def api_search_args(params):
+    """``search_service.search`` arguments from a request's fields; ValueError for invalid ones."""
+    genres = params.get("genres") or []
+    loved = params.get("loved") or None
+    cursor = params.get("cursor") or None
+    if not isinstance(genres, list) or not all(isinstance(genre, str) for genre in genres):
+        raise ValueError("genres must be a list of strings")
+    if loved is not None:
+        if not isinstance(loved, list):
+            raise ValueError("loved must be a list of work ids")
+        if len(loved) > search_service.MAX_LOVED:
+            raise ValueError(f"at most {search_service.MAX_LOVED} loved books")
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError("cursor must be a string")
+    page_size = int(params.get("page_size") or search_service.PAGE_SIZE)
+    if not 1 <= page_size <= API_MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {API_MAX_PAGE_SIZE}")
+    return {
+        "query": str(params.get("q") or ""),
+        "genres": genres,
+        "match_all": str(params.get("match_all", "")).lower() in ("1", "true"),
+        "loved": [int(work_id) for work_id in loved] if loved else None,
+        "page": int(params.get("page") or 1),
+        "page_size": page_size,
+        "cursor": cursor,
+    }
+
+
+@app.server.route("/api/search", methods=["GET", "POST"])
+@metrics.timed("api_search")
+def api_search():
+    """One search (GET, or POST of an object) or a batch of them (POST of ``{"queries": [...]}``)."""
+    if not bookshelf.ready:
+        return warming_up_response()
+    shelf = bookshelf.current()
+    request = flask.request
+    try:
+        if request.method == "GET":
+            params = {**request.args.to_dict(), "genres": request.args.getlist("genre"), "loved": request.args.getlist("loved")}
+            return flask.jsonify(search_service.search(shelf, **api_search_args(params)))
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        if "queries" not in body:
+            return flask.jsonify(search_service.search(shelf, **api_search_args(body)))
+        queries = body["queries"]
+        if not isinstance(queries, list) or len(queries) > API_MAX_BATCH:
+            raise ValueError(f"queries must be a list of at most {API_MAX_BATCH} searches")
+        # All searches of a batch are answered from the same index generation
+        batch = [api_search_args(params) for params in queries]
+        return flask.jsonify({"results": [search_service.search(shelf, **args) for args in batch]})
+    except (ValueError, TypeError, AttributeError) as err:
+        return flask.jsonify({"error": str(err)}), 400
+
+
+@app.server.route("/api/books/<int:work_id>")
+@metrics.timed("api_book")
+def api_book(work_id):
+    """The book, its most recent reviews and similar books, as shown in the details modal."""
+    if not bookshelf.ready:
+        return warming_up_response()
+    book_details = search_service.details(bookshelf.current(), work_id)
+    if book_details is None:
+        return flask.jsonify({"error": f"unknown work_id {work_id}"}), 404
+    return flask.jsonify(book_details)
+
+
+# -----------------------
+# Metrics
+# -----------------------
+# Prometheus scrapes /metrics (see metrics.py): per-stage and per-callback
+# latency histograms, startup and index build phases, cache hit rates and
+# memory. /metrics/profile shows the sampled profile when
+# BOOKSHELF_PROFILE_RATE is set.
+@metrics.registry.collector
+def bookshelf_metrics():
+    ready = metrics.Gauge("bookshelf_ready", "1 once the bookshelf is loaded, 0 while warming up")
+    ready.set(int(bookshelf.ready))
+    if not bookshelf.ready:
+        # A scrape never waits for the warm-up
+        return [ready, metrics.memory_gauge()]
+    shelf = bookshelf.current()
+    build = metrics.Gauge("bookshelf_index_build_seconds", "Time per phase of the build (or update) of the served index generation", ["phase"])
+    for phase, seconds in shelf.meta.get("build_seconds", {}).items():
+        build.set(seconds, phase=phase)
+    index = metrics.Gauge("bookshelf_index_info", "The served index generation and its number of works", ["generation"])
+    index.set(len(shelf.books_df), generation=shelf.generation)
+    caches = {
+        "results": shelf.results_cache.stats(),
+        "cards": card_cache.stats(),
+        "records": search_service.record_cache.stats(),
+        "profiles": shelf.profiles.stats(),
+    }
+    memory = metrics.memory_gauge([("catalog", shelf.catalog_bytes), ("tfidf_mapped", shelf.tfidf.matrix.data.nbytes + shelf.tfidf.matrix.indices.nbytes)])
+    return [ready, build, index, memory, *metrics.cache_metrics(caches)]
+
+
+@app.server.route("/metrics")
+def metrics_route():
+    return flask.Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.server.route("/metrics/profile")
+def profile_route():
+    """The summed profile of the sampled calls, ``?sort=tottime`` for self time."""
+    if metrics.profiler.rate <= 0:
+        return flask.Response("Profiling is off; set BOOKSHELF_PROFILE_RATE (0..1)\n", status=404, mimetype="text/plain")
+    sort = flask.request.args.get("sort", "cumulative")
+    if sort not in ("cumulative", "tottime", "calls"):
+        return flask.Response("sort must be cumulative, tottime or calls\n", status=400, mimetype="text/plain")
+    return flask.Response(metrics.profiler.report(sort), mimetype="text/plain")
+
+
+# -----------------------
+# Genre options
+# -----------------------
+@app.callback(
+    Output("genre-filter", "options"),
+    Input("genre-filter", "id")
+)
+def genre_options(_):
+    # Runs once per page load, after the catalog is loaded; also brings in
+    # the genres of newer index generations without a restart
+    return [{"label": genre, "value": genre} for genre in bookshelf.current().genres]
 
 
 # -----------------------
 # Callback for search
 # -----------------------
 @app.callback(
-    Output("results-container", "children"),
+    [Output("results-container", "children"),
+     Output("results-count", "children"),
+     Output("results-pages", "max_value"),
+     Output("results-pages", "active_page"),
+     Output("results-pages", "className"),
+     Output("results-cursor", "data")],
     [Input("search-button", "n_clicks"),
      Input("query-input", "value"),
      Input("genre-filter", "value"),
-    Input("loved-books-store", "data")]
+     Input("genre-match-all", "value"),
+     Input("for-you-switch", "value"),
+     Input("results-pages", "active_page")],
+    # State, not Input: a heart click only restyles the hearts (see below)
+    [State("loved-books-store", "data"),
+     State("results-cursor", "data")],
+    # Clearing the search stops the running one at once
+    **background_options(cancel=[Input("clear-button", "n_clicks")])
 )
-def recommend_books(n_clicks, query, selected_genres, loved_books):
-    if query:
-        query = query.lower().strip()
-    
-    # 1. Filter by genre
-    if selected_genres != None and selected_genres != "All":
-        filtered_df = books_df[books_df["genres_lower"].str.contains(selected_genres.lower(), na=False)]
-    else:
-        filtered_df = books_df
-    
-    # Check if query matches (part of) any title names
-    if query:
-        title_matches = filtered_df[filtered_df["original_title_lower"].str.contains(query, na=False)]
-    else:
-        title_matches = pd.DataFrame()
-
-    if not title_matches.empty:
-        # Return title results sorted by publication year (newest first)
-        results = title_matches.sort_values("original_publication_year", ascending=False).head(20)[[
-            "work_id", "original_title", "author", "genres", "description", "original_publication_year", "avg_rating", "image_url", "num_pages"
-        ]].to_dict("records")
-    else:
-        # If no title match, check if query matches (part of) any author names
-        if query:
-            author_matches = filtered_df[filtered_df["author_lower"].str.contains(query, na=False)]
-        else:
-            author_matches = pd.DataFrame()
-
-        if not author_matches.empty:
-            # Return author results sorted by publication year (newest first)
-            results = author_matches.sort_values("original_publication_year", ascending=False).head(20)[[
-                "work_id", "original_title", "author", "genres", "description", "original_publication_year", "avg_rating", "image_url", "num_pages"
-            ]].to_dict("records")
+@metrics.timed("recommend_books")
+def recommend_books(n_clicks, query, selected_genres, match_all_genres, for_you, active_page, loved_books, cursor):
+    shelf = bookshelf.current()
+    # Changing pages reuses the ranked list of the current search; anything
+    # else starts a new search on page 1
+    result = None
+    if callback_context.triggered_id == "results-pages" and cursor:
+        try:
+            result = search_service.search_page(shelf, cursor, active_page)
+        except ValueError:
+            # A stale or tampered cursor from the browser store: search afresh
+            pass
+    if result is None:
+        if for_you:
+            loved_ids = search_service.profile_favorites(shelf, loved_work_ids(shelf, loved_books))
+            if not loved_ids:
+                return dbc.Alert("Love a few books first to get recommendations.", color="info"), "", 1, 1, "d-none", None
+            cursor = search_service.search_cursor(None, selected_genres, match_all_genres, loved_ids)
         else:
-            if query:
-                # If no title or author match, fall back to TF-IDF similarity
-                filtered_indices = filtered_df.index
-                if filtered_indices.empty:
-                    return dbc.Alert("No books found matching your criteria.", color="warning")
-                
-                # Ensure filtered_indices is a NumPy array for correct positional indexing
-                filtered_indices_array = filtered_indices.to_numpy()
-                
-                query_vec = vectorizer.transform([query])
-                
-                # Calculate similarity only on filtered rows
-                similarity_scores = linear_kernel(query_vec, tfidf_matrix[filtered_indices_array]).flatten()
-                
-                # Get top matches (local to filtered set)
-                top_indices_local = similarity_scores.argsort()[-20:][::-1]
-                
-                # Map back to global DataFrame index
-                top_indices_global = filtered_indices_array[top_indices_local]
-
-                # Return TF-IDF results in order of similarity (highest first)
-                results = filtered_df.loc[top_indices_global][[
-                    "work_id", "original_title", "author", "genres", "description", "original_publication_year", "avg_rating", "image_url", "num_pages"
-                ]].to_dict("records")
-            else:
-                # No query, just show genre-filtered results
-                results = filtered_df.sort_values("original_publication_year", ascending=False).head(20)[[
-                    "work_id", "original_title", "author", "genres", "description", "original_publication_year", "avg_rating", "image_url", "num_pages"
-                ]].to_dict("records")
+            cursor = search_service.search_cursor(query, selected_genres, match_all_genres)
+        result = search_service.search_page(shelf, cursor, 1)
+    
+    pages_class = "justify-content-center mt-3" if result["pages"] > 1 else "d-none"
+    summary = results_summary(result["total"], result["ranked"])
+    if result["corrected"] and result["total"]:
+        # Nothing found: searched again with the misspelled words corrected
+        summary = f'No books found for "{result["query"]}", showing results for "{result["corrected"]}": {summary}'
     
     # Create cards for each book
-    if results:
-        return [create_book_card(book, loved_books) for book in results]
+    if result["work_ids"]:
+        loved_ids = set(loved_work_ids(shelf, loved_books))
+        cards = card_cache.render(shelf, shelf.work_index.lookup(result["work_ids"]), loved_ids)
+        return cards, summary, result["pages"], result["page"], pages_class, result["cursor"]
     else:
-        return dbc.Alert("No books found matching your search.", color="warning")
+        return dbc.Alert("No books found matching your search.", color="warning"), "", 1, 1, "d-none", result["cursor"]
 
 @app.callback(
     Output("download-loves", "data"),
@@ -525,24 +872,14 @@ def export_loved_books(n_clicks, loved_books):
     if not loved_books:
         return None
     
-    # Convert to DataFrame
-    loved_data = []
-    for book in loved_books:
-        if isinstance(book, dict):
-            loved_data.append(book)
-        else:
-            # Handle case where only ID is stored
-            parts = book.split('_', 1)  # Split only on first underscore
-            loved_data.append({
-                'title': parts[0] if len(parts) > 0 else '',
-                'author': parts[1] if len(parts) > 1 else '',
-                'loved_date': pd.Timestamp.now().strftime('%Y-%m-%d')
-            })
-    
-    if not loved_data:
+    # Look up title and author of every loved work
+    shelf = bookshelf.current()
+    rows = shelf.work_index.lookup(loved_work_ids(shelf, loved_books))
+    if not len(rows):
         return None
     
-    df = pd.DataFrame(loved_data)
+    df = shelf.books_df.iloc[rows][['original_title', 'author']].rename(columns={'original_title': 'title'})
+    df['loved_date'] = date.today().isoformat()
     return dcc.send_data_frame(df.to_csv, "loved_books.csv", index=False)
 
 # -----------------------
@@ -553,11 +890,14 @@ def export_loved_books(n_clicks, loved_books):
      Output("modal-title", "children"),
      Output("modal-body", "children")],
     [Input({"type": "details-button", "index": dash.ALL}, "n_clicks"),
+     Input({"type": "similar-link", "index": dash.ALL}, "n_clicks"),
      Input("close-modal", "n_clicks")],
     [State("book-details-modal", "is_open")],
-    prevent_initial_call=True
+    prevent_initial_call=True,
+    **background_options(cancel=[Input("close-modal", "n_clicks")])
 )
-def toggle_modal(details_clicks, close_clicks, is_open):
+@metrics.timed("toggle_modal")
+def toggle_modal(details_clicks, similar_clicks, close_clicks, is_open):
     ctx = callback_context
     
     if not ctx.triggered:
@@ -569,11 +909,11 @@ def toggle_modal(details_clicks, close_clicks, is_open):
     if "close-modal" in trigger_id:
         return False, "", ""
     
-    # If details button clicked
-    if "details-button" in trigger_id:
-        # Check if any button was actually clicked (n_clicks > 0)
-        if not any(details_clicks) or all(click is None or click == 0 for click in details_clicks):
-            return False, "", ""
+    # If details button (or a similar book in the open modal) clicked
+    if "details-button" in trigger_id or "similar-link" in trigger_id:
+        # Check if the button was actually clicked, not just rendered
+        if not ctx.triggered[0].get("value"):
+            return dash.no_update, dash.no_update, dash.no_update
         
         # Get which button was clicked
         button_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -582,24 +922,20 @@ def toggle_modal(details_clicks, close_clicks, is_open):
         work_id = button_dict["index"]
         
         
-        # Get book details
-        book = books_df[books_df['work_id'] == work_id].iloc[0]
-        
-        # Get reviews for this book
-        book_reviews = reviews_df[reviews_df['work_id'] == work_id].copy()
-        
-        # Convert date_added to datetime and sort by most recent
-        book_reviews['date_added'] = pd.to_datetime(book_reviews['date_added'], errors='coerce')
-        book_reviews = book_reviews.sort_values('date_added', ascending=False).head(10)
+        # Get book details, the 10 most recent reviews and the similar books
+        book_details = search_service.details(bookshelf.current(), work_id, n_reviews=10)
+        if book_details is None:
+            return False, "", ""
+        book = book_details["book"]
         
         # Create modal content
         modal_title = html.H2(f"{book['original_title']} by {book['author']}")
         
         # Create accordion items for reviews
         accordion_items = []
-        for idx, review in book_reviews.iterrows():
-            review_date = review['date_added'].strftime('%Y-%m-%d') if pd.notna(review['date_added']) else 'Unknown date'
-            review_rating = f"★ {int(review['rating'])}" if pd.notna(review['rating']) else "No rating"
+        for review in book_details["reviews"]:
+            review_date = review['date_added'] or 'Unknown date'
+            review_rating = f"★ {review['rating']}" if review['rating'] is not None else "No rating"
             
             accordion_items.append(
                 dbc.AccordionItem(
@@ -610,10 +946,24 @@ def toggle_modal(details_clicks, close_clicks, is_open):
                 )
             )
         
+        # Similar books: one row read from the precomputed lists
+        similar_links = [
+            html.Li(dbc.Button(
+                f"{similar['original_title']} by {similar['author']}",
+                id={"type": "similar-link", "index": int(similar['work_id'])},
+                color="link",
+                className="p-0 text-decoration-none"
+            ))
+            for similar in book_details["similar"]
+        ]
+        
         modal_body = [
             html.H3("Full description", className="mb-3"),
             html.P(book['description'], className="mb-4"),
             html.Hr(),
+            html.H4("Similar books", className="mb-3"),
+            html.Ul(similar_links, className="list-unstyled mb-4") if similar_links else html.P("No similar books found.", className="text-muted"),
+            html.Hr(),
             html.H4(f"Recent Reviews ({len(accordion_items)})", className="mb-3"),
             dbc.Accordion(
                 accordion_items,
@@ -682,6 +1032,27 @@ def toggle_help_modal(help_clicks, close_clicks, is_open):
     
     return is_open
 
+# -----------------------
+# Client-side callback for heart state
+# -----------------------
+# Runs in the browser whenever the store changes, so toggling a favorite
+# neither re-runs the search nor sends the cards again.
+app.clientside_callback(
+    """
+    function(loved_books, button_ids) {
+        const loved = new Set((loved_books || []).map(String));
+        const colors = button_ids.map(id => loved.has(String(id.index)) ? 'danger' : 'secondary');
+        const outlines = button_ids.map(id => !loved.has(String(id.index)));
+        return [colors, outlines];
+    }
+    """,
+    [Output({"type": "love-button", "index": dash.ALL}, "color"),
+     Output({"type": "love-button", "index": dash.ALL}, "outline")],
+    Input("loved-books-store", "data"),
+    State({"type": "love-button", "index": dash.ALL}, "id"),
+    prevent_initial_call=True
+)
+
 # -----------------------
 # Client-side callback for theme
 # -----------------------
@@ -704,4 +1075,5 @@ app.clientside_callback(
 # Run app
 # -----------------------
 if __name__ == "__main__":
-    app.run(debug=False)
\ No newline at end of file
+    bookshelf.warm_up()
+    app.run(debug=False)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Everything the app20.py callbacks read, loaded from one index generation.
+
+``Bookshelf`` is the catalog plus every index built on it. ``BookshelfHolder``
+loads it lazily: importing app20.py loads no data, so the server can answer
+health checks at once. ``warm_up()`` loads it in a background thread, and
+the first request that needs it before then waits for that load (never a
+second one). After that the holder swaps in the next generation written by
+update_index.py while the worker keeps serving:
+
+* at most every ``RELOAD_SECONDS`` a request checks the index root for a
+  newer generation of the same build (a directory listing and a few small
+  meta.json reads);
+* the new ``Bookshelf`` is loaded in a background thread, so no request
+  waits for it; until it is ready the old one keeps answering;
+* the swap is a single reference assignment. A callback takes the current
+  bookshelf once and uses it to the end, so it never mixes two generations.
+
+Both generations are in memory for the length of the load. A rebuilt catalog
+(new CSVs) still needs a restart: only generations whose source files match
+the running build are picked up.
+
+The modules that load and search the data (pandas, scipy and scikit-learn
+behind them) are imported by the first load, not by this module, so
+``import app20`` stays within the budget checked by bench_suite.py.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+from itertools import chain
+
+import numpy as np
+
+import metrics
+
+# Engine for the free-text fallback: BM25F over the per-field counts, exact
+# TF-IDF, or the optional ANN index over LSA embeddings
+SEARCH_ENGINE = os.environ.get("BOOKSHELF_SEARCH_ENGINE", "bm25f")
+RELOAD_SECONDS = float(os.environ.get("BOOKSHELF_RELOAD_SECONDS", 30))
+
+logger = logging.getLogger(__name__)
+
+
+class Bookshelf:
+    """The catalog of one index generation and the indexes built on it.
+
+    Each loading phase is timed into ``metrics.startup_seconds``.
+    """
+
+    def __init__(self, index_dir, works_path=None, search_engine=SEARCH_ENGINE):
+        import ann_index
+        import bm25f_index
+        import catalog
+        import neighbors
+        import query_planner
+        import recommendations
+        import tfidf_index
+        from lookup_index import GenreIndex, SubstringIndex, SuggestIndex, WorkIndex
+        from query_cache import QueryCache
+        from review_store import ReviewStore
+
+        timer = metrics.Stopwatch(metrics.record_startup)
+        works_path = works_path or catalog.WORKS_CSV
+        self.index_dir = index_dir
+        self.meta = meta = tfidf_index.read_meta(index_dir)
+        self.generation = meta.get("generation", 0)
+
+        # Only the columns the callbacks use, compacted; the descriptions are read from the index
+        deltas = [os.path.join(index_dir, name) for name in meta.get("works_deltas", [])]
+        self.books_df = books_df = catalog.load_works(works_path, catalog.SERVING_COLUMNS, deltas)
+        self.catalog_bytes = int(catalog.memory_usage(books_df).sum())
+        timer.lap("read_catalog")
+
+        # work_id -> row, shared by every callback that gets a work_id back
+        self.work_index = WorkIndex(books_df["work_id"])
+
+        # Row x genre indicator matrix for the genre filter; the per-book
+        # lists are only needed to build it
+        genre_lists = catalog.genre_lists(books_df["genres"])
+        self.genres = sorted(set(chain.from_iterable(genre_lists)))
+        self.genre_index = GenreIndex(genre_lists)
+        timer.lap("genre_index")
+
+        # Trigram indexes for the title and author substring searches
+        self.title_index = SubstringIndex(books_df["original_title"])
+        self.author_index = SubstringIndex(books_df["author"])
+        timer.lap("substring_indexes")
+
+        # Completions and spelling corrections for the search box, most rated first
+        self.suggestions = SuggestIndex(books_df["original_title"], books_df["author"], books_df["ratings_count"])
+        timer.lap("suggestions")
+
+        # Memory-mapped from the index directory
+        self.tfidf = tfidf = tfidf_index.load_index(index_dir)
+        if search_engine == "bm25f":
+            self.search_index = bm25f_index.load(os.path.join(index_dir, "bm25f"), tfidf.vectorizer)
+        elif search_engine == "ann":
+            self.search_index = ann_index.ensure(index_dir, tfidf)
+        else:
+            self.search_index = tfidf
+        timer.lap("search_index")
+        self.reviews = ReviewStore(*tfidf_index.segment_paths(index_dir, "reviews"))
+        self.descriptions = catalog.TextColumn(*tfidf_index.segment_paths(index_dir, "descriptions"))
+        # Precomputed similar books (curated + TF-IDF neighbors), one row per book
+        self.similar_books = neighbors.load(index_dir)
+        timer.lap("stores")
+
+        # Summed TF-IDF rows of recent favorites lists, for "Recommended for you"
+        self.profiles = recommendations.ProfileCache(tfidf)
+
+        # One ranked pass over title, author and text matches for every query
+        self.planner = query_planner.SearchPlanner(
+            books_df["original_publication_year"],
+            self.title_index,
+            self.author_index,
+            self.search_index,
+        )
+
+        # Ranked results per (query, genres), shared by the workers and emptied
+        # with every index generation since it lives in the index directory
+        self.results_cache = QueryCache(os.path.join(index_dir, f"query_cache_{search_engine}.sqlite"))
+        timer.lap("planner")
+
+        # Old favorites resolved once per generation; a new one may add their books
+        self.legacy_work_id = functools.lru_cache(maxsize=1024)(self._legacy_work_id)
+
+    def _legacy_work_id(self, key):
+        # Favorites saved before the switch to work_ids are "<title>_<author>" strings
+        books_df = self.books_df
+        keys = books_df["original_title"].astype(str) + "_" + books_df["author"].astype(str)
+        rows = np.flatnonzero((keys == key).to_numpy())
+        return int(books_df["work_id"].iloc[rows[0]]) if len(rows) else None
+
+
+class BookshelfHolder:
+    """The current ``Bookshelf`` of this worker for the source CSVs ``paths``.
+
+    Loaded on first use or by ``warm_up``, replaced when a newer index
+    generation appears. ``paths`` default to the works and reviews CSVs of
+    catalog.py and ``root`` to ``tfidf_index.INDEX_ROOT``, both looked up
+    by the first load. ``kwargs`` go to ``Bookshelf``.
+    """
+
+    def __init__(self, paths=None, root=None, reload_seconds=RELOAD_SECONDS, **kwargs):
+        self.paths = paths
+        self.root = root
+        self.reload_seconds = reload_seconds
+        self.kwargs = kwargs
+        self.bookshelf = None
+        self.error = None
+        self.load_seconds = None
+        self._checked = time.monotonic()
+        self._loading = False
+        self._warming = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # A process forked while this one was loading (a background callback
+        # job) must not inherit the held lock: it loads on its own instead
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loading = self._warming = False
+
+    @property
+    def ready(self):
+        return self.bookshelf is not None
+
+    def status(self):
+        """``{"status": "ready" | "warming_up" | "failed" | "cold", ...}`` for health checks."""
+        bookshelf = self.bookshelf
+        if bookshelf is not None:
+            return {"status": "ready", "generation": bookshelf.generation, "works": len(bookshelf.books_df), "load_seconds": self.load_seconds}
+        if self._warming or self._load_lock.locked():
+            return {"status": "warming_up"}
+        if self.error is not None:
+            return {"status": "failed", "error": str(self.error)}
+        return {"status": "cold"}
+
+    def warm_up(self):
+        """Start loading the bookshelf in a background thread, unless it is loaded or loading; returns at once."""
+        with self._lock:
+            if self.bookshelf is not None or self._warming:
+                return
+            self._warming = True
+        threading.Thread(target=self._warm_up, name="bookshelf-warm-up", daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            self.current()
+        except Exception:
+            # status() reports it; the next request or warm_up() tries again
+            logger.exception("Loading the bookshelf failed")
+        finally:
+            self._warming = False
+
+    def _load(self):
+        # One load at a time; whoever waited for it gets its result
+        with self._load_lock:
+            if self.bookshelf is None:
+                start = time.perf_counter()
+                timer = metrics.Stopwatch(metrics.record_startup)
+                try:
+                    import build_index
+                    import catalog
+                    import tfidf_index
+
+                    self.paths = self.paths or [catalog.WORKS_CSV, catalog.REVIEWS_CSV]
+                    self.root = self.root or tfidf_index.INDEX_ROOT
+                    index_dir = build_index.ensure_index(self.paths[0], self.paths[1], root=self.root)
+                    timer.lap("find_index")
+                    bookshelf = Bookshelf(index_dir, self.paths[0], **self.kwargs)
+                except Exception as err:
+                    self.error = err
+                    raise
+                self.error = None
+                self.load_seconds = time.perf_counter() - start
+                self._checked = time.monotonic()
+                self.bookshelf = bookshelf
+                logger.info("Loaded index generation %d (%d works) in %.1fs", bookshelf.generation, len(bookshelf.books_df), self.load_seconds)
+            return self.bookshelf
+
+    def current(self):
+        """The bookshelf to answer a request with, loading it first if needed; starts loading a newer generation when there is one."""
+        if self.bookshelf is None:
+            return self._load()
+        if self.reload_seconds > 0 and time.monotonic() - self._checked >= self.reload_seconds:
+            with self._lock:
+                start = not self._loading and time.monotonic() - self._checked >= self.reload_seconds
+                if start:
+                    self._checked = time.monotonic()
+                    self._loading = True
+            if start:
+                threading.Thread(target=self._reload, daemon=True).start()
+        return self.bookshelf
+
+    def _reload(self):
+        import tfidf_index
+
+        try:
+            # No source hashing here: changed CSVs mean a new build and a restart
+            found = tfidf_index.index_generations(self.paths, self.root)
+            if found and found[-1][1] != self.bookshelf.index_dir:
+                start = time.perf_counter()
+                bookshelf = Bookshelf(found[-1][1], self.paths[0], **self.kwargs)
+                self.bookshelf = bookshelf
+                logger.info("Switched to index generation %d (%d works) in %.1fs", bookshelf.generation, len(bookshelf.books_df), time.perf_counter() - start)
+        except Exception:
+            # Keep serving the loaded generation; the next check tries again
+            logger.exception("Loading the new index generation failed")
+        finally:
+            self._loading = False
@@ -0,0 +1,31 @@
+// Completions for the search box, fetched from /suggest while typing.
+// The search itself still runs on Enter or when the box loses focus.
+(function () {
+    var pending = null;
+
+    document.addEventListener("input", function (event) {
+        var input = event.target;
+        if (input.id !== "query-input") {
+            return;
+        }
+        var list = document.getElementById("query-suggestions");
+        if (!list) {
+            return;
+        }
+        // Only the answer for the latest keystroke is shown
+        if (pending) {
+            pending.abort();
+        }
+        pending = new AbortController();
+        fetch("/suggest?q=" + encodeURIComponent(input.value), {signal: pending.signal})
+            .then(function (response) { return response.json(); })
+            .then(function (completions) {
+                list.replaceChildren.apply(list, completions.map(function (completion) {
+                    var option = document.createElement("option");
+                    option.value = completion;
+                    return option;
+                }));
+            })
+            .catch(function () {});
+    });
+})();
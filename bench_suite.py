@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark and load test of app20.py on synthetic catalogs.
+
+    python bench_suite.py run [--sizes 10000 100000 1000000] [--queries 200] [--load-seconds 20] [--out bench_results.json]
+    python bench_suite.py generate --works 100000 --dir bench_data/100000
+    python bench_suite.py load --url http://127.0.0.1:8050 [--concurrency 8] [--seconds 20] [--target dash|api]
+    python bench_suite.py importtime [--budget 2.0]
+
+``run`` does, for every size:
+
+1. generate a works CSV and a reviews CSV shaped like books_1980_1990.csv
+   (same columns; words, genres and image URLs drawn from it) into
+   ``bench_data/<size>``, unless they are already there;
+2. build the index in a child process: wall time and peak RSS;
+3. start the app in another child process: import time of app20.py, time
+   until its bookshelf is loaded, and peak RSS; then per search branch
+   (title, author, TF-IDF text, genre filter only) and for opening the
+   details modal the p50/p99 latency of the callback itself, with the
+   results cache off so every search is ranked;
+4. serve the app on a local port and drive it with ``--concurrency``
+   clients for ``--load-seconds``, through the same HTTP requests the
+   browser makes.
+
+``importtime`` (also part of ``run``) checks ``import app20`` against
+``IMPORT_BUDGET_S`` with ``python -X importtime`` in a fresh process, and
+lists the slowest imports. Everything goes into one JSON file, with the machine and the git revision,
+so runs on different commits or machines can be compared key by key. The
+micro-benchmarks of single engines are in benchmark.py.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_CSV = os.path.join(REPO_DIR, "books_1980_1990.csv")
+WORKS_CSV = "goodreads_works_v1.csv"
+REVIEWS_CSV = "goodreads_reviews.csv"
+QUERIES_JSON = "bench_queries.json"
+BRANCHES = ["title", "author", "tfidf", "genre"]
+# Works generated and written per chunk, to bound memory at 1M works
+CHUNK_WORKS = 50_000
+# Seconds `import app20` may take; no data is loaded on import (see app_context.py)
+IMPORT_BUDGET_S = 2.0
+
+
+# -----------------------
+# ✳️ Synthetic catalogs
+# -----------------------
+def _word_pool(texts, min_length=1):
+    counts = Counter(word for text in texts for word in re.findall(r"[a-z]+", str(text).lower()) if len(word) >= min_length)
+    words = np.array(sorted(counts))
+    weights = np.array([counts[word] for word in words], dtype=float)
+    return words, weights / weights.sum()
+
+
+def _phrases(rng, words, weights, lengths):
+    # Words drawn by their frequency in the source, joined into one phrase per length
+    picks = words[rng.choice(len(words), size=int(lengths.sum()), p=weights)]
+    ends = np.cumsum(lengths)
+    return [" ".join(picks[end - length:end]) for end, length in zip(ends, lengths)]
+
+
+def generate(n_works, out_dir, reviews_per_work=3, n_queries=200, seed=0):
+    """Write a works and a reviews CSV of ``n_works`` books, plus the benchmark queries, into ``out_dir``."""
+    rng = np.random.default_rng(seed)
+    source = pd.read_csv(SOURCE_CSV)
+    title_words, title_weights = _word_pool(source["original_title"])
+    description_words, description_weights = _word_pool(source["description"], min_length=3)
+    first_names = sorted({str(author).split()[0] for author in source["author"]})
+    last_names = sorted({str(author).split()[-1] for author in source["author"]})
+    genre_strings = source["genres"].dropna().to_numpy()
+    image_urls = source["image_url"].dropna().to_numpy()
+
+    # Popular authors write many books: Zipf-like weights over a pool of names
+    n_authors = max(n_works // 4, 1)
+    authors = np.array([f"{rng.choice(first_names)} {rng.choice(last_names)} {i}" for i in range(n_authors)])
+    author_weights = 1.0 / np.arange(1, n_authors + 1) ** 0.8
+    author_weights /= author_weights.sum()
+    work_ids = 1_000_000 + np.arange(n_works) * 7
+
+    os.makedirs(out_dir, exist_ok=True)
+    works_path, reviews_path = os.path.join(out_dir, WORKS_CSV), os.path.join(out_dir, REVIEWS_CSV)
+    titles, work_authors = [], []
+    for start in range(0, n_works, CHUNK_WORKS):
+        ids = work_ids[start:start + CHUNK_WORKS]
+        n = len(ids)
+        chunk_titles = _phrases(rng, title_words, title_weights, rng.integers(1, 5, size=n))
+        chunk_authors = authors[rng.choice(n_authors, size=n, p=author_weights)]
+        titles.extend(chunk_titles)
+        work_authors.extend(chunk_authors[:n_queries])
+        ratings = rng.integers(10, 100_000, size=(n, 5))
+        num_pages = rng.integers(80, 900, size=n).astype(float)
+        num_pages[rng.random(n) < 0.1] = np.nan
+        similar = [",".join(map(str, rng.choice(work_ids, size=rng.integers(1, 11)))) if has else None for has in rng.random(n) < 0.2]
+        works = pd.DataFrame({
+            "work_id": ids,
+            "isbn": rng.integers(10**8, 10**9, size=n).astype(str),
+            "isbn13": rng.integers(9780000000000, 9790000000000, size=n).astype(float),
+            "original_title": chunk_titles,
+            "author": chunk_authors,
+            "original_publication_year": rng.integers(1980, 1991, size=n),
+            "num_pages": num_pages,
+            "description": _phrases(rng, description_words, description_weights, rng.integers(30, 150, size=n)),
+            "genres": genre_strings[rng.integers(len(genre_strings), size=n)],
+            "image_url": image_urls[rng.integers(len(image_urls), size=n)],
+            "reviews_count": ratings.sum(axis=1) + rng.integers(0, 1000, size=n),
+            "text_reviews_count": rng.integers(0, 5000, size=n),
+            "5_star_ratings": ratings[:, 0],
+            "4_star_ratings": ratings[:, 1],
+            "3_star_ratings": ratings[:, 2],
+            "2_star_ratings": ratings[:, 3],
+            "1_star_ratings": ratings[:, 4],
+            "ratings_count": ratings.sum(axis=1),
+            "avg_rating": ((ratings * np.arange(5, 0, -1)).sum(axis=1) / ratings.sum(axis=1)).round(2),
+            "similar_books": similar,
+        })
+        works.to_csv(works_path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+
+        # Reviews of this chunk's works, a Poisson number per book
+        per_work = rng.poisson(reviews_per_work, size=n)
+        n_reviews = int(per_work.sum())
+        dates = pd.Timestamp("2007-01-01") + pd.to_timedelta(rng.integers(0, 10 * 365 * 86400, size=n_reviews), unit="s")
+        reviews = pd.DataFrame({
+            "user_id": rng.integers(1, max(n_works, 2), size=n_reviews),
+            "work_id": np.repeat(ids, per_work),
+            "review_text": _phrases(rng, description_words, description_weights, rng.integers(10, 80, size=n_reviews)),
+            "rating": rng.integers(1, 6, size=n_reviews),
+            "date_added": dates.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+        })
+        reviews.to_csv(reviews_path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+
+    # Queries per search branch: existing titles and authors, description words
+    # that are in no title, and genre filters without a query
+    title_vocabulary = set(title_words)
+    text_words = [word for word in description_words if word not in title_vocabulary and len(word) >= 5]
+    genres = sorted({genre.strip() for value in genre_strings for genre in value.split(",") if genre.strip()})
+    picks = rng.choice(len(titles), size=min(n_queries, len(titles)), replace=False)
+    queries = {
+        "title": [titles[i] for i in picks],
+        "author": [str(author) for author in work_authors[:n_queries]],
+        "tfidf": [" ".join(rng.choice(text_words, size=2, replace=False)) for _ in range(n_queries)],
+        "genre": [[str(genre) for genre in rng.choice(genres, size=rng.integers(1, 3), replace=False)] for _ in range(n_queries)],
+        "work_ids": [int(work_id) for work_id in rng.choice(work_ids, size=min(n_queries, n_works), replace=False)],
+    }
+    with open(os.path.join(out_dir, QUERIES_JSON), "w") as f:
+        json.dump(queries, f)
+    return out_dir
+
+
+# -----------------------
+# ✳️ Measurements (run in child processes)
+# -----------------------
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(timings):
+    timings = np.array(timings) * 1000
+    return {"p50_ms": float(np.percentile(timings, 50)), "p99_ms": float(np.percentile(timings, 99)), "n": len(timings)}
+
+
+class _NoCache:
+    # Stand-in for the results cache, so every search is ranked
+    def get_or_compute(self, key, compute):
+        return compute()
+
+
+class _Context:
+    # What the callbacks read from dash.callback_context
+    def __init__(self, triggered_id, prop_id=None):
+        self.triggered_id = triggered_id
+        self.triggered = [{"prop_id": prop_id or f"{triggered_id}.n_clicks", "value": 1}]
+
+
+def measure_build(data_dir):
+    import build_index
+    start = time.perf_counter()
+    build_index.build(WORKS_CSV, REVIEWS_CSV)
+    return {"index_build_s": time.perf_counter() - start, "index_build_peak_mb": peak_rss_mb()}
+
+
+def measure_app(data_dir):
+    with open(QUERIES_JSON) as f:
+        queries = json.load(f)
+    start = time.perf_counter()
+    import app20
+    imported = time.perf_counter()
+    shelf = app20.bookshelf.current()
+    result = {"import_s": imported - start, "startup_s": time.perf_counter() - start, "startup_peak_mb": peak_rss_mb()}
+
+    shelf.results_cache = _NoCache()
+    searches = {
+        "title": [(query, []) for query in queries["title"]],
+        "author": [(query, []) for query in queries["author"]],
+        "tfidf": [(query, []) for query in queries["tfidf"]],
+        "genre": [("", genres) for genres in queries["genre"]],
+    }
+    latency = {}
+    with mock.patch.object(app20, "callback_context", _Context("search-button")):
+        for branch in BRANCHES:
+            timings = []
+            for query, genres in searches[branch]:
+                start = time.perf_counter()
+                app20.recommend_books(1, query, genres, False, False, 1, [], None)
+                timings.append(time.perf_counter() - start)
+            latency[branch] = percentiles(timings)
+    timings = []
+    for work_id in queries["work_ids"]:
+        prop_id = json.dumps({"index": work_id, "type": "details-button"}, separators=(",", ":")) + ".n_clicks"
+        with mock.patch.object(app20, "callback_context", _Context(None, prop_id)):
+            start = time.perf_counter()
+            app20.toggle_modal([1], [], None, False)
+            timings.append(time.perf_counter() - start)
+    latency["modal"] = percentiles(timings)
+    result["latency"] = latency
+    result["peak_mb"] = peak_rss_mb()
+    return result
+
+
+def _child_env():
+    return {**os.environ, "PYTHONPATH": os.pathsep.join([REPO_DIR, os.environ.get("PYTHONPATH", "")]), "BOOKSHELF_LOG_LEVEL": "WARNING"}
+
+
+def _child(mode, data_dir):
+    # Runs this file as a separate process in data_dir, so startup and peak memory are its own
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), mode, "--dir", "."], cwd=data_dir, env=_child_env(), check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_import(budget=IMPORT_BUDGET_S, slowest=15):
+    """``import app20`` under ``python -X importtime`` in a fresh process: seconds, and the slowest modules app20.py imports.
+
+    ``status`` is "ok", "over_budget", or "missing" when the output has no
+    line for app20 (which fails the budget too).
+    """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app20"], cwd=REPO_DIR, env=_child_env(), check=True, capture_output=True, text=True)
+    total, direct = None, {}
+    # "import time: <self us> | <cumulative us> | <name, indented two spaces per level>";
+    # a module is listed after the modules it imported
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name, seconds = parts[2].rstrip(), int(parts[1]) / 1e6
+        if name == " app20":
+            total = seconds
+            break
+        if not name.startswith("  "):
+            # Another top-level import (of the interpreter startup): its modules are not app20's
+            direct = {}
+        elif not name.startswith("    "):
+            direct[name.strip()] = seconds
+    if total is None:
+        status = "missing"
+    else:
+        status = "ok" if total <= budget else "over_budget"
+    return {
+        "import_s": total,
+        "budget_s": budget,
+        "status": status,
+        "within_budget": status == "ok",
+        "slowest": dict(sorted(direct.items(), key=lambda item: -item[1])[:slowest]),
+    }
+
+
+# -----------------------
+# ✳️ Load driver
+# -----------------------
+def _dash_request(query="", genres=(), work_id=None):
+    # The request the browser sends for a search or for a details click
+    if work_id is None:
+        inputs = [
+            {"id": "search-button", "property": "n_clicks", "value": 1},
+            {"id": "query-input", "property": "value", "value": query},
+            {"id": "genre-filter", "property": "value", "value": list(genres)},
+            {"id": "genre-match-all", "property": "value", "value": False},
+            {"id": "for-you-switch", "property": "value", "value": False},
+            {"id": "results-pages", "property": "active_page", "value": 1},
+        ]
+        outputs = [("results-container", "children"), ("results-count", "children"), ("results-pages", "max_value"),
+                   ("results-pages", "active_page"), ("results-pages", "className"), ("results-cursor", "data")]
+        state = [{"id": "loved-books-store", "property": "data", "value": []}, {"id": "results-cursor", "property": "data", "value": None}]
+        changed = ["search-button.n_clicks"]
+    else:
+        button = {"index": work_id, "type": "details-button"}
+        inputs = [
+            [{"id": button, "property": "n_clicks", "value": 1}],
+            [],
+            {"id": "close-modal", "property": "n_clicks", "value": None},
+        ]
+        outputs = [("book-details-modal", "is_open"), ("modal-title", "children"), ("modal-body", "children")]
+        state = [{"id": "book-details-modal", "property": "is_open", "value": False}]
+        changed = [json.dumps(button, separators=(",", ":"), sort_keys=True) + ".n_clicks"]
+    return "/_dash-update-component", {
+        "output": ".." + "...".join(f"{id_}.{prop}" for id_, prop in outputs) + "..",
+        "outputs": [{"id": id_, "property": prop} for id_, prop in outputs],
+        "inputs": inputs,
+        "state": state,
+        "changedPropIds": changed,
+    }
+
+
+def _api_request(query="", genres=(), work_id=None):
+    if work_id is None:
+        return "/api/search", {"q": query, "genres": list(genres)}
+    return f"/api/books/{work_id}", None
+
+
+def load(url, queries, concurrency=8, seconds=20, target="dash", seed=0):
+    """Drive the server at ``url`` with ``concurrency`` clients for ``seconds``; latency per request kind."""
+    make_request = _dash_request if target == "dash" else _api_request
+    requests = [(branch, make_request(query=q)) for branch in ("title", "author", "tfidf") for q in queries[branch]]
+    requests += [("genre", make_request(genres=genres)) for genres in queries["genre"]]
+    requests += [("modal", make_request(work_id=work_id)) for work_id in queries["work_ids"]]
+    random.Random(seed).shuffle(requests)
+
+    timings = {kind: [] for kind in (*BRANCHES, "modal")}
+    errors = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(offset):
+        i = offset
+        while time.perf_counter() < deadline:
+            kind, (path, body) = requests[i % len(requests)]
+            i += concurrency
+            data = json.dumps(body).encode() if body is not None else None
+            request = urllib.request.Request(url + path, data=data, headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    response.read()
+            except (urllib.error.URLError, OSError) as err:
+                with lock:
+                    errors[type(err).__name__] += 1
+                continue
+            with lock:
+                timings[kind].append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    n_requests = sum(len(values) for values in timings.values())
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "requests": n_requests,
+        "requests_per_s": n_requests / elapsed,
+        "errors": dict(errors),
+        "latency": {kind: percentiles(values) for kind, values in timings.items() if values},
+    }
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_and_load(data_dir, concurrency, seconds, target="dash", startup_timeout=1800):
+    """Serve app20.py from ``data_dir`` in a child process and run ``load`` against it."""
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-c", f"import app20; app20.bookshelf.warm_up(); app20.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+        cwd=data_dir, env=_child_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.perf_counter() + startup_timeout
+        while True:
+            try:
+                # 503 (an HTTPError) until the warm-up is done
+                urllib.request.urlopen(url + "/readyz", timeout=5).read()
+                break
+            except (urllib.error.URLError, OSError):
+                if server.poll() is not None or time.perf_counter() > deadline:
+                    raise RuntimeError(f"app20.py did not start serving on {url}")
+                time.sleep(0.5)
+        with open(os.path.join(data_dir, QUERIES_JSON)) as f:
+            queries = json.load(f)
+        return load(url, queries, concurrency, seconds, target)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# -----------------------
+# ✳️ Suite
+# -----------------------
+def environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "git_revision": revision,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run(sizes, data_root, n_queries, load_seconds, concurrency, target, out_path):
+    results = {"environment": environment(), "settings": {"queries": n_queries, "load_seconds": load_seconds, "concurrency": concurrency, "target": target}, "sizes": {}}
+    results["import"] = measure_import()
+    imported = results["import"]
+    seconds = "missing" if imported["import_s"] is None else f"{imported['import_s']:.2f}s"
+    print(f"import app20: {seconds} (budget {IMPORT_BUDGET_S:.1f}s)", flush=True)
+    for n_works in sizes:
+        data_dir = os.path.join(data_root, str(n_works))
+        result = {}
+        if not os.path.exists(os.path.join(data_dir, QUERIES_JSON)):
+            start = time.perf_counter()
+            generate(n_works, data_dir, n_queries=n_queries)
+            result["generate_s"] = time.perf_counter() - start
+        result.update(_child("measure-build", data_dir))
+        result.update(_child("measure-app", data_dir))
+        if load_seconds:
+            result["load"] = serve_and_load(data_dir, concurrency, load_seconds, target)
+        results["sizes"][str(n_works)] = result
+        print(f"{n_works:>9} works: build {result['index_build_s']:.1f}s, startup {result['startup_s']:.1f}s, "
+              f"{result['peak_mb']:.0f} MB, " + ", ".join(f"{k} p99 {v['p99_ms']:.1f}ms" for k, v in result["latency"].items()), flush=True)
+        # Written after every size, so a long run keeps what it measured
+        with open(out_path, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and load-test app20.py on synthetic catalogs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="generate, build, measure and load-test every size")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    run_parser.add_argument("--data", default="bench_data", help="directory of the generated catalogs, reused across runs")
+    run_parser.add_argument("--queries", type=int, default=200, help="queries per search branch")
+    run_parser.add_argument("--load-seconds", type=float, default=20, help="0 skips the load test")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--target", choices=["dash", "api"], default="dash")
+    run_parser.add_argument("--out", default="bench_results.json")
+
+    generate_parser = commands.add_parser("generate", help="write one synthetic catalog")
+    generate_parser.add_argument("--works", type=int, required=True)
+    generate_parser.add_argument("--dir", required=True)
+    generate_parser.add_argument("--reviews-per-work", type=float, default=3)
+    generate_parser.add_argument("--queries", type=int, default=200)
+
+    load_parser = commands.add_parser("load", help="drive a running server with the queries of a generated catalog")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8050")
+    load_parser.add_argument("--dir", default=".", help="catalog directory holding bench_queries.json")
+    load_parser.add_argument("--concurrency", type=int, default=8)
+    load_parser.add_argument("--seconds", type=float, default=20)
+    load_parser.add_argument("--target", choices=["dash", "api"], default="dash")
+
+    import_parser = commands.add_parser("importtime", help="check the import time of app20.py against a budget")
+    import_parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_S, help="seconds; exits with status 1 above it")
+
+    # Used by ``run`` in its child processes
+    for mode in ("measure-build", "measure-app"):
+        commands.add_parser(mode).add_argument("--dir", default=".")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        run(args.sizes, args.data, args.queries, args.load_seconds, args.concurrency, args.target, args.out)
+    elif args.command == "generate":
+        generate(args.works, args.dir, args.reviews_per_work, args.queries)
+    elif args.command == "load":
+        with open(os.path.join(args.dir, QUERIES_JSON)) as f:
+            queries = json.load(f)
+        print(json.dumps(load(args.url.rstrip("/"), queries, args.concurrency, args.seconds, args.target), indent=2))
+    elif args.command == "importtime":
+        result = measure_import(args.budget)
+        print(json.dumps(result, indent=2))
+        if not result["within_budget"]:
+            sys.exit(1)
+    elif args.command == "measure-build":
+        print(json.dumps(measure_build(args.dir)))
+    else:
+        print(json.dumps(measure_app(args.dir)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Latency benchmarks for the search paths of app20.py.
+
+    python benchmark.py [--sizes 10000 100000 1000000] [--queries 200]
+
+Catalogs are synthetic TF-IDF matrices with a Zipf-like term distribution, so
+sizes well beyond the real CSVs can be measured without fitting a vectorizer.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.metrics.pairwise import linear_kernel
+from sklearn.preprocessing import normalize
+
+import ann_index
+import bm25f_index
+import recommendations
+import tfidf_index
+
+
+# -----------------------
+# Synthetic data
+# -----------------------
+def synthetic_tfidf(n_rows, n_terms=50000, terms_per_row=40, seed=0, n_topics=0):
+    rng = np.random.default_rng(seed)
+    # Zipf-like term popularity, like words in book descriptions
+    popularity = 1.0 / np.arange(1, n_terms + 1) ** 1.1
+    popularity /= popularity.sum()
+
+    indices = rng.choice(n_terms, size=n_rows * terms_per_row, p=popularity).astype(np.int32)
+    if n_topics:
+        # Half of each row's terms come from its topic's own word ranking,
+        # which gives the catalog the low-rank structure LSA looks for
+        topics = rng.permutation(n_terms * n_topics).reshape(n_topics, n_terms) % n_terms
+        row_topics = np.repeat(rng.integers(n_topics, size=n_rows), terms_per_row)
+        from_topic = rng.random(len(indices)) < 0.5
+        indices[from_topic] = topics[row_topics[from_topic], indices[from_topic]]
+    indptr = np.arange(0, n_rows * terms_per_row + 1, terms_per_row, dtype=np.int64)
+    data = rng.random(len(indices)) + 0.1
+    matrix = sp.csr_matrix((data, indices, indptr), shape=(n_rows, n_terms))
+    matrix.sum_duplicates()
+    matrix = normalize(matrix)
+
+    vectorizer = tfidf_index.make_vectorizer(vocabulary={f"t{i}": i for i in range(n_terms)})
+    vectorizer.idf_ = np.ones(n_terms)
+    return tfidf_index.TfidfIndex(vectorizer, matrix)
+
+
+def synthetic_bm25f(n_rows, n_terms=50000, seed=0):
+    # Per-field counts: a few title/author/genre terms, longer descriptions and reviews
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, n_terms + 1) ** 1.1
+    popularity /= popularity.sum()
+    fields = {}
+    for name, per_row in {"title": 3, "author": 2, "genres": 4, "description": 40, "reviews": 40}.items():
+        indices = rng.choice(n_terms, size=n_rows * per_row, p=popularity).astype(np.int32)
+        indptr = np.arange(0, n_rows * per_row + 1, per_row, dtype=np.int64)
+        counts = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(n_rows, n_terms))
+        counts.sum_duplicates()
+        fields[name] = counts
+    vectorizer = tfidf_index.make_vectorizer(vocabulary={f"t{i}": i for i in range(n_terms)})
+    vectorizer.idf_ = np.ones(n_terms)
+    return bm25f_index.build(fields, {f"t{i}": i for i in range(n_terms)}, vectorizer)
+
+
+def synthetic_queries(n_queries, n_terms=50000, seed=1):
+    rng = np.random.default_rng(seed)
+    # Mostly mid-frequency terms, one to three per query
+    return [" ".join(f"t{t}" for t in rng.integers(50, n_terms // 5, size=rng.integers(1, 4))) for _ in range(n_queries)]
+
+
+# -----------------------
+# Measurements
+# -----------------------
+def percentiles(timings):
+    timings = np.array(timings) * 1000
+    return {"p50_ms": float(np.percentile(timings, 50)), "p99_ms": float(np.percentile(timings, 99))}
+
+
+def time_calls(fn, args_list):
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return percentiles(timings)
+
+
+def argsort_baseline(index, query, mask):
+    # The pre-index TF-IDF path: slice the filtered rows, score them all, full argsort
+    filtered = np.flatnonzero(mask)
+    query_vec = index.vectorizer.transform([query])
+    scores = linear_kernel(query_vec, index.matrix[filtered]).flatten()
+    return filtered[scores.argsort()[-20:][::-1]]
+
+
+def bench_tfidf(sizes, n_queries):
+    queries = synthetic_queries(n_queries)
+    print(f"{'works':>10} {'path':<24} {'p50 ms':>9} {'p99 ms':>9}")
+    for n_rows in sizes:
+        index = synthetic_tfidf(n_rows)
+        genre_mask = np.random.default_rng(2).random(n_rows) < 0.1
+        all_rows = np.ones(n_rows, dtype=bool)
+        runs = {
+            "argsort (all rows)": time_calls(argsort_baseline, [(index, q, all_rows) for q in queries]),
+            "argsort (10% genre)": time_calls(argsort_baseline, [(index, q, genre_mask) for q in queries]),
+            "search (all rows)": time_calls(index.search, [(q, 20, None) for q in queries]),
+            "search (10% genre)": time_calls(index.search, [(q, 20, genre_mask) for q in queries]),
+        }
+        for name, result in runs.items():
+            print(f"{n_rows:>10} {name:<24} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+
+
+def recommend_from_scratch(index, loved_rows):
+    profile = recommendations.ProfileCache(index).get(loved_rows)
+    return recommendations.recommend(index, profile, loved_rows)
+
+
+def recommend_after_click(index, profiles, loved_rows, row):
+    # A heart click: profile updated by one row, then ranked
+    return recommendations.recommend(index, profiles.toggle(loved_rows, row), np.append(loved_rows, row))
+
+
+def bench_profiles(sizes, n_users, n_loved=300):
+    print(f"{'works':>10} {'path':<24} {'p50 ms':>9} {'p99 ms':>9}")
+    for n_rows in sizes:
+        index = synthetic_tfidf(n_rows)
+        rng = np.random.default_rng(3)
+        users = [rng.choice(n_rows, size=n_loved, replace=False) for _ in range(n_users)]
+        profiles = recommendations.ProfileCache(index)
+        for loved_rows in users:
+            profiles.get(loved_rows)
+        clicks = [(index, profiles, loved_rows, int(rng.integers(n_rows))) for loved_rows in users]
+        runs = {
+            f"profile ({n_loved} loved)": time_calls(recommend_from_scratch, [(index, loved_rows) for loved_rows in users]),
+            "heart click + rank": time_calls(recommend_after_click, clicks),
+        }
+        for name, result in runs.items():
+            print(f"{n_rows:>10} {name:<24} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+
+
+def bench_bm25f(sizes, n_queries):
+    queries = synthetic_queries(n_queries)
+    print(f"{'works':>10} {'path':<24} {'p50 ms':>9} {'p99 ms':>9}")
+    for n_rows in sizes:
+        index = synthetic_bm25f(n_rows)
+        genre_mask = np.random.default_rng(2).random(n_rows) < 0.1
+        runs = {
+            "bm25f (all rows)": time_calls(index.search, [(q, 20, None) for q in queries]),
+            "bm25f (10% genre)": time_calls(index.search, [(q, 20, genre_mask) for q in queries]),
+        }
+        for name, result in runs.items():
+            print(f"{n_rows:>10} {name:<24} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+
+
+def recall_at_k(found, expected):
+    return len(set(found) & set(expected)) / len(expected) if len(expected) else 1.0
+
+
+def bench_ann(sizes, n_queries, nprobes=(4, 16, 64)):
+    # Topic-structured catalogs; pure Zipf noise has nothing for LSA to find
+    queries = synthetic_queries(n_queries)
+    print(f"{'works':>10} {'path':<24} {'p50 ms':>9} {'p99 ms':>9} {'recall@20':>10} {'vs LSA':>8}")
+    for n_rows in sizes:
+        index = synthetic_tfidf(n_rows, n_topics=50)
+        ann = ann_index.build(index)
+        query_vecs = [index.vectorizer.transform([q]) for q in queries]
+        exact = [index.search_vector(v, 20)[0] for v in query_vecs]
+        # Every cluster probed: the best the embeddings can do, without IVF loss
+        ann.nprobe = len(ann.centroids)
+        lsa = [ann.search_vector(v, 20)[0] for v in query_vecs]
+
+        result = time_calls(index.search_vector, [(v, 20, None) for v in query_vecs])
+        print(f"{n_rows:>10} {'tfidf (exact)':<24} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} {1.0:>10.2f} {'':>8}")
+        for nprobe in (*nprobes, len(ann.centroids)):
+            ann.nprobe = nprobe
+            result = time_calls(ann.search_vector, [(v, 20, None) for v in query_vecs])
+            found = [ann.search_vector(v, 20)[0] for v in query_vecs]
+            recall = np.mean([recall_at_k(f, e) for f, e in zip(found, exact)])
+            recall_lsa = np.mean([recall_at_k(f, e) for f, e in zip(found, lsa)])
+            name = f"ann nprobe={nprobe}/{len(ann.centroids)}"
+            print(f"{n_rows:>10} {name:<24} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} {recall:>10.2f} {recall_lsa:>8.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app20.py search paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--users", type=int, default=50, help="favorites lists for the recommendation benchmark")
+    parser.add_argument("--ann", action="store_true", help="also benchmark the ANN engine (fits an SVD per size)")
+    args = parser.parse_args(argv)
+    bench_tfidf(args.sizes, args.queries)
+    bench_bm25f(args.sizes, args.queries)
+    bench_profiles(args.sizes, args.users)
+    if args.ann:
+        bench_ann(args.sizes, args.queries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+BM25F search engine (``BOOKSHELF_SEARCH_ENGINE=bm25f``, the default).
+
+Instead of counting some fields several times into one document, the index
+keeps one term-count matrix per field (title, author, genres, description,
+reviews) in CSC form, plus each book's field lengths. At query time the
+field counts of a term are length-normalized and weighted per field, summed
+into one pseudo term frequency and saturated:
+
+    tf(t, d)    = sum_f  w_f * tf_f(t, d) / (1 - b_f + b_f * len_f(d) / avglen_f)
+    score(q, d) = sum_t  idf(t) * tf(t, d) / (k1 + tf(t, d))
+
+``w_f``, ``b_f`` and ``k1`` are plain query-time parameters (``Bm25fParams``),
+so they can be tuned without rebuilding the index. Term ids are those of the
+TF-IDF vectorizer, which is shared with ``tfidf_index.TfidfIndex``. Like the
+TF-IDF matrix, the field counts of an updated generation are the stored ones
+of the last full fit plus a ``tfidf_index.RowDelta`` per field.
+"""
+
+import json
+import os
+import shutil
+from dataclasses import dataclass, field
+
+import numpy as np
+import scipy.sparse as sp
+
+import tfidf_index
+
+
+def _default_weights():
+    # Same relative weights as the TF-IDF field boosts; BOOKSHELF_BM25F_WEIGHTS
+    # (JSON, e.g. {"author": 6}) overrides single fields
+    weights = dict(tfidf_index.FIELD_WEIGHTS)
+    weights.update(json.loads(os.environ.get("BOOKSHELF_BM25F_WEIGHTS", "{}")))
+    return weights
+
+
+def _default_b():
+    # Short fields are hardly length-normalized, long ones fully
+    return {"title": 0.3, "author": 0.0, "genres": 0.3, "description": 0.75, "reviews": 0.75}
+
+
+@dataclass
+class Bm25fParams:
+    weights: dict = field(default_factory=_default_weights)
+    b: dict = field(default_factory=_default_b)
+    k1: float = 1.2
+
+
+class Bm25fIndex:
+    """Per-field term counts with BM25F scoring; same search interface as ``TfidfIndex``."""
+
+    def __init__(self, vectorizer, fields, lengths, df, params=None, deltas=None):
+        self.vectorizer = vectorizer
+        self.fields = fields
+        # Per field, the rows changed since ``fields`` were counted (see update_index.py)
+        self.deltas = deltas or {}
+        self.lengths = lengths
+        self.avg_lengths = {name: max(float(np.mean(length)), 1e-9) for name, length in lengths.items()}
+        self.n_rows = len(next(iter(lengths.values())))
+        self.df = df
+        # Robertson-Sparck Jones idf, kept positive for terms in most books
+        self.idf = np.log1p((self.n_rows - df + 0.5) / (df + 0.5))
+        self.params = params or Bm25fParams()
+
+    def term_frequencies(self, term, params):
+        """Rows containing ``term`` in any field and their weighted, length-normalized frequency."""
+        rows, tfs = [], []
+        for name, counts in self.fields.items():
+            weight = params.weights.get(name, 0)
+            if not weight:
+                continue
+            field_rows, field_counts = tfidf_index.column(counts, self.deltas.get(name), term)
+            if not len(field_rows):
+                continue
+            b = params.b.get(name, 0.75)
+            norm = 1 - b + b * self.lengths[name][field_rows] / self.avg_lengths[name]
+            rows.append(field_rows)
+            tfs.append(weight * field_counts / norm)
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        return rows, np.bincount(inverse, weights=np.concatenate(tfs))
+
+    def matches(self, query_vec, mask=None, params=None):
+        """Every row inside ``mask`` containing a query term and its BM25F score, unordered."""
+        params = params or self.params
+        rows, scores = [], []
+        for term in np.unique(sp.csr_matrix(query_vec).indices):
+            term_rows, tf = self.term_frequencies(term, params)
+            rows.append(term_rows)
+            scores.append(self.idf[term] * tf / (params.k1 + tf))
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        if mask is not None:
+            keep = mask[rows]
+            rows, scores = rows[keep], scores[keep]
+        return rows.astype(np.int64), scores
+
+    def match_rows(self, query_vec, mask=None, params=None):
+        """The rows ``matches`` returns, sorted, without scoring them.
+
+        Those are the rows with a query term in a field of non-zero weight.
+        """
+        params = params or self.params
+        hit = np.zeros(self.n_rows, dtype=bool)
+        for term in sp.csr_matrix(query_vec).indices:
+            for name, counts in self.fields.items():
+                if params.weights.get(name, 0):
+                    hit[tfidf_index.column(counts, self.deltas.get(name), term)[0]] = True
+        if mask is not None:
+            hit &= mask
+        return np.flatnonzero(hit)
+
+    def search_vector(self, query_vec, k=20, mask=None, params=None):
+        return tfidf_index.top_k(*self.matches(query_vec, mask, params), k)
+
+    def search(self, query, k=20, mask=None, params=None):
+        """Top ``k`` rows for ``query`` as ``(rows, scores)``, best first."""
+        return self.search_vector(self.vectorizer.transform([query]), k, mask, params)
+
+
+def build(fields, vocabulary, vectorizer):
+    """BM25F index from the raw per-field counts of ``tfidf_index.count_all``.
+
+    Term ids are moved from ``vocabulary`` to those of ``vectorizer``.
+    """
+    remap = np.array([vectorizer.vocabulary[term] for term in sorted(vocabulary, key=vocabulary.get)], dtype=np.int32)
+    fields = {name: tfidf_index.remap_terms(counts, remap, dtype=np.float32) for name, counts in fields.items()}
+    lengths = {name: np.asarray(counts.sum(axis=1), dtype=np.float32).ravel() for name, counts in fields.items()}
+    # Books containing each term in any field
+    df = np.bincount(tfidf_index.add_counts(list(fields.values()), len(remap)).indices, minlength=len(remap))
+    return Bm25fIndex(vectorizer, {name: counts.tocsc() for name, counts in fields.items()}, lengths, df)
+
+
+def save(index, path, base_from=None):
+    """Write ``index`` to ``path``; with ``base_from`` the stored counts are hard-linked from there, see ``tfidf_index.save_index``."""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, counts in index.fields.items():
+        if base_from is None:
+            counts.sort_indices()
+            tfidf_index.save_sparse(tmp_path, f"{name}_", counts)
+        else:
+            tfidf_index.link_sparse(base_from, tmp_path, f"{name}_")
+        if name in index.deltas:
+            tfidf_index.save_delta(tmp_path, f"{name}_", index.deltas[name])
+        np.save(os.path.join(tmp_path, f"{name}_lengths.npy"), index.lengths[name])
+    np.save(os.path.join(tmp_path, "df.npy"), index.df)
+    stored_shape = next(iter(index.fields.values())).shape
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"fields": list(index.fields), "shape": [index.n_rows, len(index.df)], "stored_shape": list(stored_shape)}, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load(path, vectorizer, params=None):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    shape = tuple(meta["shape"])
+    stored_shape = tuple(meta.get("stored_shape", shape))
+    fields = {name: tfidf_index.load_sparse(path, f"{name}_", stored_shape, sp.csc_matrix, "r") for name in meta["fields"]}
+    lengths = {name: np.load(os.path.join(path, f"{name}_lengths.npy")) for name in meta["fields"]}
+    deltas = {name: tfidf_index.load_delta(path, f"{name}_", shape) for name in meta["fields"]}
+    deltas = {name: delta for name, delta in deltas.items() if delta is not None}
+    return Bm25fIndex(vectorizer, fields, lengths, np.load(os.path.join(path, "df.npy")), params, deltas)
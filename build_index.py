@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Offline index build for app20.py.
+
+    python build_index.py [--works goodreads_works_v1.csv] [--reviews goodreads_reviews.csv] [--out index] [--ann]
+
+Run it whenever the source CSVs change; workers pick up the new index on their
+next start. New works and reviews can also be added to a built index without
+a rebuild, see update_index.py.
+
+The index directory holds the TF-IDF matrix, the per-field counts of the
+BM25F search engine, plus the review store, the book descriptions and the
+similar-books lists used by the cards and the details modal; with ``--ann``
+also the optional ANN search engine (see ann_index.py).
+"""
+
+import argparse
+import logging
+import os
+import resource
+import threading
+
+import ann_index
+import bm25f_index
+import catalog
+import metrics
+import neighbors
+import review_store
+import tfidf_index
+
+logger = logging.getLogger(__name__)
+
+
+def build(works_path, reviews_path, root=tfidf_index.INDEX_ROOT, chunksize=catalog.REVIEW_CHUNKSIZE, books_df=None, workers=None, ann=False):
+    """Build every artifact for the given CSVs and return the index directory.
+
+    The time of each phase is kept in meta.json as ``build_seconds``
+    (served by the ``/metrics`` route of app20.py).
+    """
+    paths = [works_path, reviews_path]
+    timings = {}
+    timer = metrics.Stopwatch(timings.__setitem__)
+    if books_df is None or not set(catalog.WORK_COLUMNS) <= set(books_df):
+        # The app's catalog leaves out the descriptions
+        books_df = catalog.load_works(works_path)
+    digest = tfidf_index.source_digest(paths)
+    staging = tfidf_index.staging_path(digest, root)
+    positions = catalog.WorkPositions(books_df["work_id"])
+    timer.lap("read_works")
+
+    review_store.build(reviews_path, positions, os.path.join(staging, "reviews"), chunksize)
+    catalog.save_text_column(books_df["description"], os.path.join(staging, "descriptions"))
+    timer.lap("review_store")
+    logger.info("Wrote review store and descriptions in %.1fs", timings["review_store"])
+
+    fields, vocabulary = tfidf_index.count_all(books_df, reviews_path, chunksize, workers, positions)
+    index = tfidf_index.fit_counts(tfidf_index.weighted_counts(fields), vocabulary)
+    timer.lap("fit")
+    logger.info("Fitted TF-IDF %s (%d non-zeros) in %.1fs", index.matrix.shape, index.matrix.nnz, timings["fit"])
+
+    bm25f_index.save(bm25f_index.build(fields, vocabulary, index.vectorizer), os.path.join(staging, "bm25f"))
+    del fields
+    timer.lap("bm25f")
+    logger.info("Wrote BM25F field counts in %.1fs", timings["bm25f"])
+
+    similar = neighbors.compute(index.matrix, workers=workers)
+    similar_books = catalog.load_similar_books(works_path)
+    if similar_books is not None:
+        similar = neighbors.merge(neighbors.curated(similar_books, positions), similar)
+    neighbors.save(staging, similar)
+    timer.lap("neighbors")
+    logger.info("Computed %d similar books per work in %.1fs", similar.shape[1], timings["neighbors"])
+
+    if ann:
+        ann_search = ann_index.build(index)
+        ann_index.save(ann_search, os.path.join(staging, "ann"))
+        timer.lap("ann")
+        logger.info("Built ANN index (%d dims, %d lists) in %.1fs", ann_search.term_vectors.shape[1], len(ann_search.centroids), timings["ann"])
+
+    # Renames the staging directory, with everything written into it, into place
+    return tfidf_index.save_index(index, paths, root=root, digest=digest, extra_meta={"build_seconds": timings})
+
+
+def ensure_index(works_path, reviews_path, books_df=None, root=tfidf_index.INDEX_ROOT):
+    """Directory of a complete index matching the CSVs, building one if needed.
+
+    The latest generation wins (see update_index.py); ``books_df``, when
+    given, is the catalog of the works CSV alone. Builds hold the build lock
+    of ``root``: of several workers started together one builds, the others
+    wait and then load its index.
+    """
+    def usable(path):
+        return path is not None and (books_df is None or tfidf_index.read_meta(path)["base_rows"] == len(books_df))
+
+    path = tfidf_index.find_index([works_path, reviews_path], root)
+    if usable(path):
+        return path
+    with tfidf_index.build_lock(root):
+        # Built by another worker while this one waited for the lock
+        path = tfidf_index.find_index([works_path, reviews_path], root)
+        if usable(path):
+            return path
+        if path is None:
+            logger.warning("No prebuilt index found in %s; building in-process (run `python build_index.py`)", root)
+        else:
+            logger.warning("Index at %s does not match the catalog; rebuilding", path)
+        # Forking the process pools from a thread (the app's warm-up) can
+        # deadlock the children on locks held by other threads
+        workers = None if threading.current_thread() is threading.main_thread() else 1
+        return build(works_path, reviews_path, root, books_df=books_df, workers=workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the persisted index for app20.py")
+    parser.add_argument("--works", default=catalog.WORKS_CSV)
+    parser.add_argument("--reviews", default=catalog.REVIEWS_CSV)
+    parser.add_argument("--out", default=tfidf_index.INDEX_ROOT)
+    parser.add_argument("--chunksize", type=int, default=catalog.REVIEW_CHUNKSIZE, help="reviews read per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="processes for the term counting and the similar-books job (default: all cores)")
+    parser.add_argument("--ann", action="store_true", help="also build the ANN search engine")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with tfidf_index.build_lock(args.out):
+        path = build(args.works, args.reviews, args.out, args.chunksize, workers=args.workers, ann=args.ann)
+    print(f"Wrote index to {path}")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
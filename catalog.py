@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Loading and normalization of the Goodreads works and reviews CSVs.
+
+Shared by app20.py (serving) and build_index.py (offline index build) so both
+see the books in exactly the same row order.
+"""
+
+import argparse
+import logging
+import os
+import resource
+import shutil
+
+import numpy as np
+import pandas as pd
+
+WORKS_CSV = "goodreads_works_v1.csv"
+REVIEWS_CSV = "goodreads_reviews.csv"
+REVIEW_CHUNKSIZE = 20_000
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------
+# ✳️ Works
+# -----------------------
+# The columns the app and the index build use; ISBNs and star counts are never read
+WORK_COLUMNS = [
+    "work_id", "original_title", "author", "original_publication_year", "num_pages",
+    "description", "genres", "image_url", "ratings_count", "avg_rating",
+]
+# The app reads the descriptions from the index (see TextColumn) instead
+SERVING_COLUMNS = [column for column in WORK_COLUMNS if column != "description"]
+# Years and page counts stay floats for the missing values; float32 holds them exactly
+WORK_DTYPES = {
+    "original_publication_year": "float32",
+    "num_pages": "float32",
+    "avg_rating": "float32",
+}
+# Text columns stored as categories: few distinct values, repeated over many books
+CATEGORY_COLUMNS = ["author", "genres", "image_url"]
+
+
+def load_works(path=WORKS_CSV, columns=WORK_COLUMNS, deltas=()):
+    """The works CSV as a compact frame, one row per book, with only ``columns``.
+
+    The works of the ``deltas`` CSVs (added by update_index.py) follow the
+    base catalog, in order.
+
+    Numbers are downcast, repeated strings are categorical and the other
+    strings use pandas' string dtype (Arrow-backed when pyarrow is
+    installed). There are no lowercase copies: the search indexes lowercase
+    what they need once, when they are built.
+    """
+    frames = [pd.read_csv(p, usecols=lambda column: column in columns, dtype=WORK_DTYPES) for p in [path, *deltas]]
+    books_df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    books_df["work_id"] = pd.to_numeric(books_df["work_id"], downcast="integer")
+    if "ratings_count" in books_df:
+        books_df["ratings_count"] = pd.to_numeric(books_df["ratings_count"].fillna(0), downcast="integer")
+    for column in ["original_title", "description"]:
+        if column in books_df:
+            # Missing titles and descriptions are empty strings, not "nan"
+            books_df[column] = books_df[column].astype("string").fillna("")
+    for column in CATEGORY_COLUMNS:
+        if column in books_df:
+            books_df[column] = books_df[column].fillna("").astype("category")
+    log_memory(books_df)
+    return books_df
+
+
+def genre_lists(genres):
+    """Per-book lists of the genres in the comma-separated ``genres`` column.
+
+    Each distinct genres string is split once.
+    """
+    genres = pd.Series(genres).astype("category")
+    split = [[genre.strip() for genre in value.split(",") if genre.strip()] for value in genres.cat.categories.astype(str)]
+    return [split[code] if code >= 0 else [] for code in genres.cat.codes]
+
+
+def load_similar_books(path=WORKS_CSV, deltas=()):
+    """The ``similar_books`` column of the works CSV(s) (only the index build needs it), or None when there is none."""
+    columns = []
+    for p in [path, *deltas]:
+        if "similar_books" in pd.read_csv(p, nrows=0).columns:
+            columns.append(pd.read_csv(p, usecols=["similar_books"])["similar_books"])
+        else:
+            columns.append(pd.Series([None] * len(pd.read_csv(p, usecols=[0])), dtype=object))
+    if all(column.isna().all() for column in columns):
+        return None
+    return pd.concat(columns, ignore_index=True)
+
+
+# -----------------------
+# ✳️ Text columns on disk
+# -----------------------
+def save_text_column(values, path):
+    """Write ``values`` as ``offsets.npy`` plus the UTF-8 texts back to back in ``text.bin``.
+
+    Missing values are stored as empty strings.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    offsets = [0]
+    with open(os.path.join(tmp_path, "text.bin"), "wb") as blob:
+        for value in pd.Series(values).astype(object).fillna(""):
+            encoded = str(value).encode("utf-8")
+            blob.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+    np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+class TextColumn:
+    """Memory-mapped read side of ``save_text_column``: ``column[row]`` is one text.
+
+    Several paths are segments of consecutive rows (a full build, then the
+    works added by each update). The pages are shared by every worker
+    through the page cache, so a long text column costs no resident memory
+    per worker.
+    """
+
+    def __init__(self, *paths):
+        self.segments = []
+        for path in paths:
+            offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+            text_path = os.path.join(path, "text.bin")
+            # np.memmap cannot map an empty file
+            text = np.memmap(text_path, dtype=np.uint8, mode="r") if os.path.getsize(text_path) else np.empty(0, dtype=np.uint8)
+            self.segments.append((offsets, text))
+        self.starts = np.cumsum([0] + [len(offsets) - 1 for offsets, _ in self.segments])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, row):
+        segment = int(np.searchsorted(self.starts, row, side="right")) - 1
+        offsets, text = self.segments[segment]
+        row -= self.starts[segment]
+        return text[offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+
+# -----------------------
+# ✳️ Memory report
+# -----------------------
+def memory_usage(df):
+    """Bytes per column, strings and categories counted in full, largest first."""
+    return df.memory_usage(index=False, deep=True).sort_values(ascending=False)
+
+
+def log_memory(df):
+    usage = memory_usage(df)
+    logger.info("Catalog: %d works, %.1f MB", len(df), usage.sum() / 2**20)
+    for column, size in usage.items():
+        logger.info("  %-26s %-10s %8.1f MB", column, df[column].dtype, size / 2**20)
+
+
+def load_reviews(path=REVIEWS_CSV):
+    return pd.read_csv(path, low_memory=False)
+
+
+class WorkPositions:
+    """Rows of whole arrays of work_ids in the books_df order.
+
+    Built once per catalog and shared by everything that maps the work_ids
+    of a CSV onto books (review counts, the review store, curated similar
+    books). A duplicated work_id maps to its first row, like
+    ``lookup_index.WorkIndex``; ``pd.Index.get_indexer`` refuses duplicates.
+    """
+
+    def __init__(self, work_ids):
+        work_ids = np.asarray(work_ids)
+        unique, first = np.unique(work_ids, return_index=True)
+        self.n_rows = len(work_ids)
+        self.index = pd.Index(unique)
+        self.first = first
+
+    def __len__(self):
+        return self.n_rows
+
+    def get_indexer(self, work_ids):
+        """Row of each of ``work_ids``, -1 for those not in the catalog."""
+        found = self.index.get_indexer(work_ids)
+        return np.where(found >= 0, self.first[found], -1)
+
+
+def iter_review_chunks(path, positions, chunksize=REVIEW_CHUNKSIZE):
+    """Stream the reviews CSV as ``(rows, texts)`` chunks.
+
+    ``rows`` are books_df rows, from the ``WorkPositions`` of the catalog.
+    Only the two columns needed are parsed; reviews of unknown works and
+    empty reviews are dropped, like the left merge of the grouped reviews
+    used to.
+    """
+    for chunk in pd.read_csv(path, usecols=["work_id", "review_text"], chunksize=chunksize):
+        chunk = chunk.dropna(subset=["review_text"])
+        rows = positions.get_indexer(chunk["work_id"])
+        known = rows >= 0
+        yield rows[known], chunk["review_text"].to_numpy()[known]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory per column of the works CSV as app20.py loads it")
+    parser.add_argument("--works", default=WORKS_CSV)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    load_works(args.works, SERVING_COLUMNS)
+    # ru_maxrss is in kilobytes on Linux
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
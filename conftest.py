@@ -0,0 +1 @@
+# Lets pytest import the modules of the repository root from tests/
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory lookup structures built once at load time for app20.py.
+
+All lookups return positional row numbers into books_df (sorted ascending),
+so they can be combined with other filters without touching the frame.
+"""
+
+import bisect
+import re
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+# -----------------------
+# ✳️ Substring index (titles, authors)
+# -----------------------
+class SubstringIndex:
+    """Substring lookup over one lowercased text column via a trigram index.
+
+    Gives the same matches as ``column.str.contains(query, regex=False)``:
+    the posting lists of the query's trigrams are intersected to get a small
+    candidate set, which is then verified with a plain ``in`` check.
+
+    Grams are indexed per distinct value, not per row, so an author with
+    fifty books costs one entry; ``row_order``/``row_starts`` map a distinct
+    value back to its rows and ``codes`` a row to its value. Values are
+    lowercased here, and this is the only lowercase copy kept.
+    """
+
+    def __init__(self, values, n=3):
+        self.n = n
+        codes, uniques = pd.factorize(pd.Series(values).astype(object).fillna(""), sort=False)
+        self.values = [value.lower() for value in uniques]
+        self.codes = codes.astype(np.int32)
+
+        postings = defaultdict(list)
+        for value_id, value in enumerate(self.values):
+            for gram in {value[i:i + n] for i in range(len(value) - n + 1)}:
+                postings[gram].append(value_id)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+        self.row_order = np.argsort(codes, kind="stable").astype(np.int32)
+        self.row_starts = np.searchsorted(codes[self.row_order], np.arange(len(self.values) + 1))
+
+    def _matching_values(self, query):
+        if len(query) < self.n:
+            # Too short to use the grams; these queries match nearly everything anyway
+            return [i for i, value in enumerate(self.values) if query in value]
+
+        grams = {query[i:i + self.n] for i in range(len(query) - self.n + 1)}
+        lists = [self.postings.get(gram) for gram in grams]
+        if any(ids is None for ids in lists):
+            return []
+        lists.sort(key=len)
+        candidates = lists[0]
+        for ids in lists[1:]:
+            candidates = np.intersect1d(candidates, ids, assume_unique=True)
+            if not len(candidates):
+                return []
+        return [i for i in candidates if query in self.values[i]]
+
+    def values_at(self, rows):
+        """Lowercased values of ``rows``, as an object array."""
+        values = np.empty(len(rows), dtype=object)
+        values[:] = [self.values[code] for code in self.codes[rows]]
+        return values
+
+    def lookup(self, query):
+        value_ids = self._matching_values(query)
+        if not value_ids:
+            return np.empty(0, dtype=np.int32)
+        rows = np.concatenate([self.row_order[self.row_starts[i]:self.row_starts[i + 1]] for i in value_ids])
+        rows.sort()
+        return rows
+
+
+# -----------------------
+# ✳️ Suggestions (autocomplete, spelling)
+# -----------------------
+WORD = re.compile(r"\w+")
+# Leading articles a title can also be completed without
+ARTICLES = ("the ", "a ", "an ")
+
+
+def _deletes(word, distance):
+    """``word`` and every string up to ``distance`` characters shorter."""
+    variants = frontier = {word}
+    for _ in range(distance):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        variants = variants | frontier
+    return variants
+
+
+def edit_distance(a, b, limit=2):
+    """Damerau-Levenshtein (optimal string alignment) distance, or ``limit + 1`` when over ``limit``."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return min(current[-1], limit + 1)
+
+
+class SuggestIndex:
+    """Prefix completions and spelling corrections over titles and authors.
+
+    Completions: every distinct title and author is stored under its
+    lowercase form in one sorted key list (titles also without a leading
+    article, authors also from each later name, so "crich" completes
+    "Michael Crichton"). A prefix is a contiguous range of that list, found
+    with two bisects, and its most popular phrases are returned. Ranges too
+    wide to scan per keystroke (the first letter or two) have their top
+    phrases computed at build time.
+
+    Corrections: a SymSpell-style deletion index over the words of the
+    titles and authors. Each word is stored under itself and every string
+    left after deleting up to ``max_distance`` letters, as 64-bit hashes in
+    one sorted array. An unknown query word generates its own deletions the
+    same way; every word within ``max_distance`` edits shares one of them,
+    and the candidates are verified with ``edit_distance``. Both lookups
+    touch a handful of entries, whatever the size of the catalog.
+    """
+
+    def __init__(self, titles, authors, weights=None, max_distance=2, n_top=8, wide_range=2000):
+        self.max_distance = max_distance
+        self.n_top = n_top
+        titles = pd.Series(titles).fillna("").astype(str).tolist()
+        authors = pd.Series(authors).fillna("").astype(str).tolist()
+        # Popularity per book; one extra so books without ratings still count
+        weights = np.ones(len(titles)) if weights is None else np.nan_to_num(np.asarray(weights, dtype=float)) + 1
+
+        # Distinct phrases, shown as their most popular spelling
+        values = titles + authors
+        weights = np.concatenate([weights, weights])
+        codes, uniques = pd.factorize(np.array([" ".join(value.lower().split()) for value in values], dtype=object))
+        best = np.lexsort((-weights, codes))
+        first = best[np.r_[True, codes[best][1:] != codes[best][:-1]]]
+        self.display = [values[i] for i in first]
+        self.phrase_weights = np.bincount(codes, weights=weights)
+        is_author = np.zeros(len(uniques), dtype=bool)
+        is_author[codes[len(titles):]] = True
+        phrases = list(uniques)
+
+        keys, key_phrases = [], []
+        for phrase_id, (key, author) in enumerate(zip(phrases, is_author.tolist())):
+            if not key:
+                continue
+            keys.append(key)
+            key_phrases.append(phrase_id)
+            for article in ARTICLES:
+                if key.startswith(article):
+                    keys.append(key[len(article):])
+                    key_phrases.append(phrase_id)
+            if author:
+                for match in WORD.finditer(key):
+                    if match.start():
+                        keys.append(key[match.start():])
+                        key_phrases.append(phrase_id)
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = [keys[i] for i in order]
+        self.key_phrases = np.array(key_phrases, dtype=np.int32)[order]
+        self.wide_range = wide_range
+        self.wide_prefixes = {}
+        self._add_wide_prefixes("", 0, len(self.keys))
+
+        # Words and how popular the phrases they occur in are
+        word_weights = defaultdict(float)
+        for key, weight in zip(phrases, self.phrase_weights.tolist()):
+            for word in set(WORD.findall(key)):
+                word_weights[word] += weight
+        self.words = list(word_weights)
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+        self.word_weights = np.array(list(word_weights.values()))
+        hashes, ids = [], []
+        for word_id, word in enumerate(self.words):
+            for variant in _deletes(word, max_distance):
+                hashes.append(hash(variant))
+                ids.append(word_id)
+        order = np.argsort(np.array(hashes, dtype=np.int64), kind="stable")
+        self.delete_hashes = np.array(hashes, dtype=np.int64)[order]
+        self.delete_words = np.array(ids, dtype=np.int32)[order]
+
+    def _add_wide_prefixes(self, prefix, start, end):
+        # Top phrases of every prefix whose key range is wider than wide_range,
+        # one character deeper at a time
+        while start < end:
+            if len(self.keys[start]) <= len(prefix):
+                start += 1
+                continue
+            child = self.keys[start][:len(prefix) + 1]
+            child_end = bisect.bisect_left(self.keys, child + "\U0010ffff", start, end)
+            if child_end - start > self.wide_range:
+                self.wide_prefixes[child] = self._top(start, child_end)
+                self._add_wide_prefixes(child, start, child_end)
+            start = child_end
+
+    def _top(self, start, end):
+        phrase_ids = np.unique(self.key_phrases[start:end])
+        if len(phrase_ids) > self.n_top:
+            phrase_ids = phrase_ids[np.argpartition(-self.phrase_weights[phrase_ids], self.n_top - 1)[:self.n_top]]
+        return phrase_ids[np.lexsort((phrase_ids, -self.phrase_weights[phrase_ids]))]
+
+    def complete(self, prefix, n=8):
+        """Up to ``n`` (at most ``n_top``) titles and authors starting with ``prefix``, most popular first."""
+        prefix = " ".join(prefix.lower().split())
+        if not prefix:
+            return []
+        phrase_ids = self.wide_prefixes.get(prefix)
+        if phrase_ids is None:
+            start = bisect.bisect_left(self.keys, prefix)
+            phrase_ids = self._top(start, bisect.bisect_left(self.keys, prefix + "\U0010ffff", start))
+        return [self.display[i] for i in phrase_ids[:n]]
+
+    def correct_word(self, word):
+        """Closest known word to ``word`` (most popular on a tie), ``word`` itself when known, or None."""
+        if word in self.word_ids:
+            return word
+        hashes = np.array([hash(variant) for variant in _deletes(word, self.max_distance)], dtype=np.int64)
+        starts = np.searchsorted(self.delete_hashes, hashes, side="left")
+        ends = np.searchsorted(self.delete_hashes, hashes, side="right")
+        candidates = {int(i) for start, end in zip(starts, ends) for i in self.delete_words[start:end]}
+        best, best_key = None, None
+        for i in candidates:
+            distance = edit_distance(word, self.words[i], self.max_distance)
+            key = (distance, -self.word_weights[i], self.words[i])
+            if distance <= self.max_distance and (best_key is None or key < best_key):
+                best, best_key = self.words[i], key
+        return best
+
+    def correct(self, query, min_length=4):
+        """``query`` with its unknown words spelled like the closest title or author word, or None when nothing changes.
+
+        Words shorter than ``min_length`` are left alone; they have too many
+        neighbors to guess from.
+        """
+        words = " ".join((query or "").lower().split()).split(" ")
+        corrected = [
+            (self.correct_word(word) or word) if len(word) >= min_length and WORD.fullmatch(word) else word
+            for word in words
+        ]
+        return " ".join(corrected) if corrected != words else None
+
+    def suggest(self, prefix, n=8):
+        """Completions of ``prefix``, or of its spelling correction when it has none."""
+        completions = self.complete(prefix, n)
+        if not completions:
+            corrected = self.correct(prefix)
+            if corrected:
+                completions = self.complete(corrected, n)
+        return completions
+
+
+# -----------------------
+# ✳️ Genre index
+# -----------------------
+class GenreIndex:
+    """Row x genre indicator matrix built from the per-book genre lists.
+
+    Genres are matched exactly (case-insensitive) against the split
+    ``catalog.genre_lists`` entries, so "fiction" no longer matches "non-fiction".
+    """
+
+    def __init__(self, genre_lists):
+        genre_lists = [{genre.lower() for genre in genres} for genres in genre_lists]
+        self.n_rows = len(genre_lists)
+        self.columns = {genre: i for i, genre in enumerate(sorted(set().union(*genre_lists)))}
+
+        rows = np.repeat(np.arange(self.n_rows, dtype=np.int32), [len(genres) for genres in genre_lists])
+        cols = np.array([self.columns[genre] for genres in genre_lists for genre in genres], dtype=np.int32)
+        self.matrix = sp.csc_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(self.n_rows, len(self.columns)))
+
+    def mask(self, selected, match_all=False):
+        """Boolean row mask for the selected genre(s), or None when nothing is selected.
+
+        ``selected`` is a genre, a list of genres, or "All"/None. With
+        ``match_all`` a book needs every selected genre, otherwise any one.
+        """
+        if isinstance(selected, str):
+            selected = [selected]
+        selected = [genre.lower() for genre in selected or [] if genre and genre != "All"]
+        if not selected:
+            return None
+
+        cols = [self.columns[genre] for genre in selected if genre in self.columns]
+        if not cols or (match_all and len(cols) < len(set(selected))):
+            return np.zeros(self.n_rows, dtype=bool)
+
+        rows = self.matrix[:, sorted(set(cols))].indices
+        if match_all:
+            return np.bincount(rows, minlength=self.n_rows) == len(set(cols))
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[rows] = True
+        return mask
+
+
+# -----------------------
+# ✳️ Work index
+# -----------------------
+class WorkIndex:
+    """work_id -> row number in books_df, built once at load time.
+
+    Every callback that gets a work_id back from the browser (details, love
+    buttons, exports) resolves it here instead of scanning the frame.
+    """
+
+    def __init__(self, work_ids):
+        self.rows = {}
+        for row, work_id in enumerate(work_ids):
+            # Keep the first row for a duplicated work_id, like ``.iloc[0]`` did
+            self.rows.setdefault(int(work_id), row)
+
+    def __contains__(self, work_id):
+        return self.row(work_id) is not None
+
+    def row(self, work_id):
+        """Row of ``work_id``, or None when it is not in the catalog."""
+        try:
+            return self.rows.get(int(work_id))
+        except (TypeError, ValueError):
+            return None
+
+    def lookup(self, work_ids):
+        """Rows of the known ``work_ids``, in the given order."""
+        rows = [self.row(work_id) for work_id in work_ids]
+        return np.array([row for row in rows if row is not None], dtype=np.int64)
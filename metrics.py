@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics of app20.py in the Prometheus text format, and a sampled profiler.
+
+Nothing to install: counters, gauges and histograms are kept in this
+module and ``registry.render()`` writes them out for the ``/metrics`` route
+of app20.py. What is recorded:
+
+* ``bookshelf_stage_seconds{stage=...}``: every step of a search or details
+  request (genre filter, title and author lookups, query vectorizing,
+  scoring, top-k, record reads, card rendering, reviews, ...), timed with a
+  ``Stopwatch`` where the step happens;
+* ``bookshelf_callback_seconds{callback=...}``: each callback and API route
+  as a whole (``timed``);
+* ``bookshelf_startup_seconds{phase=...}``: the loading phases of the
+  current bookshelf, and the phases of the index build it was built by;
+* cache hits, misses and sizes, and memory gauges, collected when scraped
+  (see ``Registry.collector``).
+
+Metrics are per process: with several workers each one reports its own, as
+Prometheus expects from a multi-target scrape. Callbacks run as background
+jobs (see app20.py) are timed in the job process and do not show up here.
+
+With ``BOOKSHELF_PROFILE_RATE`` > 0 that fraction of the ``timed`` calls
+runs under cProfile, one at a time; the summed profile is served as text by
+``/metrics/profile``.
+"""
+
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import resource
+import threading
+import time
+
+# Upper bounds of the latency histograms, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Fraction of timed calls run under the profiler; 0 turns it off
+PROFILE_RATE = float(os.environ.get("BOOKSHELF_PROFILE_RATE", 0))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items()) + "}"
+    if value == float("inf"):
+        value = "+Inf"
+    return f"{name} {value}"
+
+
+# -----------------------
+# ✳️ Metric types
+# -----------------------
+class Gauge:
+    """A value per combination of label values."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+        return self
+
+    def samples(self):
+        with self._lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Counter(Gauge):
+    """A running total per combination of label values; ``set`` is for totals kept elsewhere."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Gauge):
+    """Observations per combination of label values, counted into ``BUCKETS``."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum and the number of observations
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": bound}, count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, counts[-1]
+            yield f"{self.name}_sum", labels, counts[-2]
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class Registry:
+    """The metrics of this process, plus collectors that build more when scraped."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, collect):
+        """Register ``collect()``, which returns metrics read at scrape time (cache sizes, memory, ...)."""
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        metrics = list(self.metrics)
+        for collect in self.collectors:
+            metrics.extend(collect())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(_format_sample(name, labels, value) for name, labels, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.register(Histogram("bookshelf_stage_seconds", "Time per step of a search or details request", ["stage"]))
+callback_seconds = registry.register(Histogram("bookshelf_callback_seconds", "Time per callback or API request", ["callback"]))
+callback_errors = registry.register(Counter("bookshelf_callback_errors_total", "Callbacks and API requests that raised", ["callback"]))
+startup_seconds = registry.register(Gauge("bookshelf_startup_seconds", "Time per phase of loading the current bookshelf", ["phase"]))
+
+
+# -----------------------
+# ✳️ Timers
+# -----------------------
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+def record_startup(phase, seconds):
+    startup_seconds.set(seconds, phase=phase)
+
+
+class Stopwatch:
+    """Times consecutive steps: ``lap(name)`` records the time since the previous lap (or the start) as ``name``."""
+
+    def __init__(self, record=record_stage):
+        self.record = record
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.record(name, now - self.last)
+        self.last = now
+
+
+def timed(callback):
+    """Decorator: time every call in ``bookshelf_callback_seconds`` and sample it for the profiler."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with profiler.sample():
+                    return func(*args, **kwargs)
+            except Exception:
+                callback_errors.inc(callback=callback)
+                raise
+            finally:
+                callback_seconds.observe(time.perf_counter() - start, callback=callback)
+        return wrapper
+    return decorator
+
+
+# -----------------------
+# ✳️ Process gauges
+# -----------------------
+def memory_gauge(extra=()):
+    """``bookshelf_memory_bytes`` of this process (resident and peak), plus the ``(kind, bytes)`` pairs in ``extra``."""
+    gauge = Gauge("bookshelf_memory_bytes", "Memory of this process; mapped index files are shared between workers", ["kind"])
+    try:
+        with open("/proc/self/statm") as f:
+            gauge.set(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"), kind="rss")
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    gauge.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, kind="peak_rss")
+    for kind, size in extra:
+        gauge.set(size, kind=kind)
+    return gauge
+
+
+def cache_metrics(caches):
+    """Hit, miss, hit-rate and size metrics of ``{name: stats}``, ``stats`` as returned by the caches' ``stats()``."""
+    hits = Counter("bookshelf_cache_hits_total", "Cache lookups answered from the cache", ["cache"])
+    misses = Counter("bookshelf_cache_misses_total", "Cache lookups that had to compute", ["cache"])
+    hit_rate = Gauge("bookshelf_cache_hit_ratio", "Hits per lookup since the cache was created", ["cache"])
+    entries = Gauge("bookshelf_cache_entries", "Entries held by the cache", ["cache"])
+    for name, stats in caches.items():
+        hits.set(stats["hits"], cache=name)
+        misses.set(stats["misses"], cache=name)
+        hit_rate.set(stats["hit_rate"], cache=name)
+        if "entries" in stats:
+            entries.set(stats["entries"], cache=name)
+    return [hits, misses, hit_rate, entries]
+
+
+# -----------------------
+# ✳️ Sampled profiler
+# -----------------------
+class SampledProfiler:
+    """Runs ``rate`` of the sampled calls under cProfile and sums their profiles.
+
+    One profile at a time: a call sampled while another one is profiled runs
+    unprofiled, since Python allows a single active profiler.
+    """
+
+    def __init__(self, rate=PROFILE_RATE):
+        self.rate = rate
+        self.samples = 0
+        self.stats = None
+        self._lock = threading.Lock()
+
+    def sample(self):
+        if self.rate <= 0 or random.random() >= self.rate or not self._lock.acquire(blocking=False):
+            return _NOT_PROFILED
+        return _Profiled(self)
+
+    def report(self, sort="cumulative", limit=50):
+        """The summed profile as pstats text, most expensive first."""
+        with self._lock:
+            if self.stats is None:
+                return f"No profiled calls yet (BOOKSHELF_PROFILE_RATE={self.rate})\n"
+            out = io.StringIO()
+            out.write(f"{self.samples} profiled calls\n")
+            stats = pstats.Stats(stream=out)
+            stats.add(self.stats)
+            stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class _NotProfiled:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Profiled:
+    # Holds the profiler lock from sample() until the call returns
+    def __init__(self, owner):
+        self.owner = owner
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        try:
+            self.profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, py-spy in-process) is active
+            self.profile = None
+            self.owner._lock.release()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is None:
+            return False
+        self.profile.disable()
+        owner = self.owner
+        try:
+            if owner.stats is None:
+                owner.stats = pstats.Stats(self.profile)
+            else:
+                owner.stats.add(self.profile)
+            owner.samples += 1
+        finally:
+            owner._lock.release()
+        return False
+
+
+_NOT_PROFILED = _NotProfiled()
+profiler = SampledProfiler()
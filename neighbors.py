@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed "similar books" lists for the details modal.
+
+build_index.py computes, for every book, its nearest neighbors by cosine
+similarity of the TF-IDF rows: the matrix is multiplied against its own
+transpose one block of rows at a time, spread over a process pool, and each
+block against one slice of columns at a time, keeping a running top list so
+the nearly dense block of similarities is never held whole. The
+curated ``similar_books`` of the works CSV go first, TF-IDF neighbors fill up
+the rest. The result is one int32 array of book rows, ``n_books x
+N_NEIGHBORS`` and padded with -1, memory-mapped at startup so a lookup is a
+single row read.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+N_NEIGHBORS = 10
+BLOCK_SIZE = 512
+COLUMN_BLOCK = 4096
+
+# Set in each pool worker (inherited on fork, pickled once otherwise)
+_matrix = None
+
+
+def _init_worker(matrix):
+    global _matrix
+    _matrix = matrix
+
+
+def _block_neighbors(start, stop, n_neighbors, matrix=None):
+    """Top ``n_neighbors`` rows by cosine similarity for rows ``start:stop``, -1 padded."""
+    matrix = _matrix if matrix is None else matrix
+    return start, _top_neighbors(matrix, np.arange(start, stop), n_neighbors)
+
+
+def _best(rows, scores, own_row, out):
+    # The best of ``rows`` other than ``own_row`` into ``out``, -1 padded
+    keep = rows != own_row
+    rows, scores = rows[keep], scores[keep]
+    n_neighbors = len(out)
+    if len(rows) > n_neighbors:
+        part = np.argpartition(-scores, n_neighbors - 1)[:n_neighbors]
+        rows, scores = rows[part], scores[part]
+    # Best first, ties by row for stable output
+    order = np.lexsort((rows, -scores))
+    out[:len(order)] = rows[order]
+
+
+def _top_neighbors(matrix, own_rows, n_neighbors, column_block=COLUMN_BLOCK):
+    # Rows are L2-normalized, so the dot products are the cosine similarities.
+    # Most books share some common term, so each slice of similarities is
+    # taken dense; only the best ``n_neighbors`` per row are carried over.
+    block = matrix[own_rows]
+    n_own = len(own_rows)
+    best_rows = np.full((n_own, n_neighbors), -1, dtype=np.int64)
+    best_scores = np.full((n_own, n_neighbors), -np.inf)
+    for start in range(0, matrix.shape[0], column_block):
+        stop = min(start + column_block, matrix.shape[0])
+        sims = (block @ matrix[start:stop].T).toarray()
+        # Books sharing no term are no neighbors, nor is the book itself
+        sims[sims <= 0] = -np.inf
+        own = (own_rows >= start) & (own_rows < stop)
+        sims[np.flatnonzero(own), own_rows[own] - start] = -np.inf
+        if stop - start > n_neighbors:
+            cols = np.argpartition(-sims, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        else:
+            cols = np.broadcast_to(np.arange(stop - start), sims.shape)
+        rows = np.concatenate((best_rows, start + cols), axis=1)
+        scores = np.concatenate((best_scores, np.take_along_axis(sims, cols, axis=1)), axis=1)
+        # Best first, ties by row for stable output
+        order = np.lexsort((rows, -scores), axis=1)[:, :n_neighbors]
+        best_rows = np.take_along_axis(rows, order, axis=1)
+        best_scores = np.take_along_axis(scores, order, axis=1)
+    best_rows[best_scores == -np.inf] = -1
+    return best_rows.astype(np.int32)
+
+
+def compute(matrix, n_neighbors=N_NEIGHBORS, block_size=BLOCK_SIZE, workers=None):
+    """Nearest TF-IDF neighbors of every row of ``matrix``, as a -1 padded row array.
+
+    ``workers`` defaults to the number of cores; 1 computes in-process.
+    Memory per worker is bounded by ``block_size`` times ``COLUMN_BLOCK``
+    similarities, however many books share a term with the block.
+    """
+    n_rows = matrix.shape[0]
+    neighbors = np.full((n_rows, n_neighbors), -1, dtype=np.int32)
+    blocks = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(blocks) <= 1:
+        for start, stop in blocks:
+            neighbors[start:stop] = _block_neighbors(start, stop, n_neighbors, matrix)[1]
+        return neighbors
+
+    # Fork shares the matrix with the workers without copying it
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with ProcessPoolExecutor(min(workers, len(blocks)), mp_context=context, initializer=_init_worker, initargs=(matrix,)) as pool:
+        futures = [pool.submit(_block_neighbors, start, stop, n_neighbors) for start, stop in blocks]
+        for future in futures:
+            start, out = future.result()
+            neighbors[start:start + len(out)] = out
+    return neighbors
+
+
+def compute_rows(index, rows, n_neighbors=N_NEIGHBORS):
+    """Nearest TF-IDF neighbors of ``rows`` of a ``TfidfIndex`` only, in-process, in the order of ``rows``.
+
+    Used by incremental updates for the books that were added or changed.
+    Each row is scored against the posting lists of its own terms, so the
+    rows changed since the stored matrix count as they are now.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    out = np.full((len(rows), n_neighbors), -1, dtype=np.int32)
+    vectors = index.row_vectors(rows)
+    for i, row in enumerate(rows):
+        _best(*index.score(vectors[i]), row, out[i])
+    return out
+
+
+def curated(similar_books, positions, n_neighbors=N_NEIGHBORS):
+    """Rows of the works listed in the CSV's ``similar_books`` column, -1 padded.
+
+    ``positions`` is the ``catalog.WorkPositions`` of books_df. Listed works
+    that are not in the catalog are skipped.
+    """
+    out = np.full((len(positions), n_neighbors), -1, dtype=np.int32)
+    for row, listed in enumerate(similar_books):
+        if not isinstance(listed, str):
+            continue
+        ids = [int(work_id) for work_id in listed.split(",") if work_id.strip().isdigit()]
+        rows = [r for r in positions.get_indexer(ids) if r >= 0 and r != row][:n_neighbors]
+        out[row, :len(rows)] = rows
+    return out
+
+
+def merge(first, second):
+    """Row-wise ``first`` then ``second`` without duplicates, cut to the same width."""
+    out = second.copy()
+    # Only rows with entries in ``first`` need merging
+    for row in np.flatnonzero(first[:, 0] >= 0):
+        out[row] = -1
+        merged = list(dict.fromkeys(r for r in (*first[row], *second[row]) if r >= 0))[:first.shape[1]]
+        out[row, :len(merged)] = merged
+    return out
+
+
+def save(path, neighbors):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "neighbors.npy"), neighbors)
+
+
+def load(path):
+    return np.load(os.path.join(path, "neighbors.npy"), mmap_mode="r")
+
+
+def similar_rows(neighbors, row):
+    """Rows similar to book ``row``, most similar first."""
+    rows = neighbors[row]
+    return rows[rows >= 0]
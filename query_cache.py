@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of ranked search results shared by all gunicorn workers.
+
+Results (ranked work_ids plus the number of matches) are keyed on the
+normalized query and genre filter, and stored in a SQLite file next to the
+index they were computed from, so a rebuilt index starts with an empty
+cache. Entries expire after ``ttl`` seconds and the least recently used
+ones are evicted once there are more than ``max_entries`` (checked every
+``EVICT_EVERY`` writes per worker).
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+QUERY_CACHE_SIZE = int(os.environ.get("BOOKSHELF_QUERY_CACHE_SIZE", 10000))
+QUERY_CACHE_TTL = float(os.environ.get("BOOKSHELF_QUERY_CACHE_TTL", 24 * 3600))
+EVICT_EVERY = 64
+# Bumped when the stored value format or the rankings change; older caches are dropped
+CACHE_VERSION = 5
+
+
+def cache_key(query, genres, match_all=False, k=20, loved=None):
+    """Key for a search: same results, same key.
+
+    With ``loved`` (a list of work_ids) the key is for the recommendations
+    for those favorites instead, and the query is ignored. The key is also
+    the paging cursor of the search; ``parse_key`` turns it back into the
+    normalized arguments.
+    """
+    query = " ".join((query or "").lower().split()) if loved is None else ""
+    genres = sorted({genre.lower() for genre in genres or [] if genre and genre != "All"})
+    loved = sorted({int(work_id) for work_id in loved}) if loved is not None else None
+    # "Match all" makes no difference for less than two genres
+    return json.dumps([query, genres, bool(match_all) and len(genres) > 1, k, loved])
+
+
+def parse_key(key):
+    """``(query, genres, match_all, k, loved)`` of a key made by ``cache_key``."""
+    query, genres, match_all, k, loved = json.loads(key)
+    return query, genres, match_all, k, loved
+
+
+class QueryCache:
+    """SQLite-backed LRU/TTL cache of JSON-serializable search results.
+
+    One connection per thread and process; ``hits``/``misses`` count the
+    lookups of this worker only.
+    """
+
+    def __init__(self, path, max_entries=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._puts = 0
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        # One transaction, so workers starting together set the schema up once
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+            conn.execute("DROP TABLE IF EXISTS results")
+            conn.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        conn.execute("COMMIT")
+
+    def _connect(self):
+        # sqlite3 connections must not cross threads or forks
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        """Cached value for ``key``, or None."""
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            self.misses += 1
+            return None
+        conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO results (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now, now),
+        )
+        self._puts += 1
+        if self._puts % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries and everything past the ``max_entries`` most recently used."""
+        conn = self._connect()
+        conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+One ranked search over title matches, author matches and text relevance.
+
+Instead of trying the title index, then the author index, then the text
+engine, and returning the first non-empty answer, every query gets one
+indexed lookup per name field plus one relevance pass, over one shared
+candidate set. A candidate's score is its relevance (scaled to 0..1) plus a
+boost per kind of name match:
+
+    exact title / exact author      +4
+    title starts with the query     +3
+    title / author contains it      +2
+
+so name matches still come first, an exact author beats a mere substring,
+and relevance orders books within a tier. Equal scores go to the newest
+book. When the name matches alone fill all ``k`` places no other book can
+reach the top ``k``, so only the name matches are ranked, by kind of match
+and recency; the text matches are then only counted (``match_rows``, the
+posting lists of the query's terms without scoring), so the number of
+matching books is the same on both paths.
+"""
+
+import numpy as np
+
+import metrics
+import tfidf_index
+
+MATCH_BOOSTS = {
+    "title_exact": 4.0,
+    "author_exact": 4.0,
+    "title_prefix": 3.0,
+    "title_contains": 2.0,
+    "author_contains": 2.0,
+}
+
+
+class SearchPlanner:
+    """Ranks the rows of books_df for a query; see the module docstring."""
+
+    def __init__(self, years, title_index, author_index, engine, boosts=MATCH_BOOSTS):
+        # Unknown years sort last
+        self.years = np.nan_to_num(np.asarray(years, dtype=float), nan=-np.inf)
+        self.title_index = title_index
+        self.author_index = author_index
+        self.engine = engine
+        self.boosts = boosts
+
+    def top(self, rows, scores, k):
+        """The ``k`` best rows by score, then newest, then row."""
+        if len(rows) > k:
+            # Everything tied with the k-th score stays in for the tiebreak
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+            keep = scores >= threshold
+            rows, scores = rows[keep], scores[keep]
+        order = np.lexsort((rows, -self.years[rows], -scores))[:k]
+        return rows[order]
+
+    def name_boosts(self, query, title_rows, author_rows):
+        """Candidate rows of the name matches and the boost each one gets."""
+        rows = np.union1d(title_rows, author_rows)
+        boost = np.zeros(len(rows))
+        if len(title_rows):
+            at = np.searchsorted(rows, title_rows)
+            titles = self.title_index.values_at(title_rows)
+            boost[at] = np.where(
+                titles == query,
+                self.boosts["title_exact"],
+                np.where([title.startswith(query) for title in titles], self.boosts["title_prefix"], self.boosts["title_contains"]),
+            )
+        if len(author_rows):
+            at = np.searchsorted(rows, author_rows)
+            author_boost = np.where(self.author_index.values_at(author_rows) == query, self.boosts["author_exact"], self.boosts["author_contains"])
+            boost[at] = np.maximum(boost[at], author_boost)
+        return rows, boost
+
+    def rank(self, query, mask=None, k=20):
+        """Top ``k`` rows for ``query`` (already lowercased), best first, and the number of matches.
+
+        Without a query the rows inside ``mask`` are listed newest first.
+        """
+        timer = metrics.Stopwatch()
+        if not query:
+            rows = np.arange(len(self.years)) if mask is None else np.flatnonzero(mask)
+            # Every row ties on score; select on the year alone, without a full sort
+            top = tfidf_index.top_k(rows, self.years[rows], k)[0]
+            timer.lap("top")
+            return top, len(rows)
+
+        title_rows = self.title_index.lookup(query)
+        timer.lap("title_lookup")
+        author_rows = self.author_index.lookup(query)
+        timer.lap("author_lookup")
+        if mask is not None:
+            title_rows, author_rows = title_rows[mask[title_rows]], author_rows[mask[author_rows]]
+        name_rows, boost = self.name_boosts(query, title_rows, author_rows)
+        timer.lap("name_boosts")
+
+        query_vec = self.engine.vectorizer.transform([query])
+        timer.lap("vectorize")
+        if len(name_rows) >= k:
+            # Short-circuit: relevance (at most 1) cannot lift another book past
+            # a name match (2+); the text matches only count towards the total
+            top = self.top(name_rows, boost, k)
+            timer.lap("top")
+            rows = self.engine.match_rows(query_vec, mask)
+            timer.lap("count")
+            return top, len(rows) + int(np.count_nonzero(~np.isin(name_rows, rows)))
+
+        rows, scores = self.engine.matches(query_vec, mask)
+        timer.lap("score")
+
+        if len(scores):
+            scores = scores / scores.max()
+        rows = np.asarray(rows, dtype=np.int64)
+        candidates = np.union1d(rows, name_rows)
+        total = np.zeros(len(candidates))
+        total[np.searchsorted(candidates, rows)] += scores
+        total[np.searchsorted(candidates, name_rows)] += boost
+        top = self.top(candidates, total, k)
+        timer.lap("top")
+        return top, len(candidates)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+"Recommended for you": ranking the catalog against the loved books.
+
+A user's profile is the centroid of the TF-IDF rows of their loved books.
+Only its heaviest terms are used as the query: at most ``PROFILE_TERMS``, and
+only as many as fit in ``POSTINGS_BUDGET`` posting entries, so the scoring
+cost is bounded however many books are loved and however large the catalog
+is. The loved books themselves are masked out of the results.
+
+Profiles are kept per favorites list in a small LRU. A heart click derives
+the new profile from the previous one by adding or subtracting one row
+instead of summing every loved book again.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+
+import tfidf_index
+
+PROFILE_TERMS = 64
+POSTINGS_BUDGET = 500_000
+PROFILE_CACHE_SIZE = 1024
+
+
+class ProfileCache:
+    """Summed TF-IDF rows of a ``TfidfIndex`` per set of loved rows, most recently used last."""
+
+    def __init__(self, index, max_entries=PROFILE_CACHE_SIZE):
+        self.index = index
+        self.max_entries = max_entries
+        self.profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _store(self, key, profile):
+        with self._lock:
+            self.profiles[key] = profile
+            self.profiles.move_to_end(key)
+            while len(self.profiles) > self.max_entries:
+                self.profiles.popitem(last=False)
+        return profile
+
+    def get(self, rows):
+        """Sum of the rows of ``matrix`` at ``rows`` as a sparse 1 x n_terms row."""
+        key = frozenset(int(row) for row in rows)
+        with self._lock:
+            profile = self.profiles.get(key)
+            if profile is not None:
+                self.hits += 1
+                self.profiles.move_to_end(key)
+                return profile
+            self.misses += 1
+        rows = np.fromiter(key, dtype=np.int64, count=len(key))
+        profile = sp.csr_matrix(np.ones((1, len(rows)))) @ self.index.row_vectors(rows) if len(rows) else sp.csr_matrix((1, self.index.n_terms))
+        return self._store(key, profile)
+
+    def toggle(self, rows, row):
+        """Profile after ``row`` was added to or removed from ``rows``."""
+        rows = frozenset(int(r) for r in rows)
+        return self.update(rows, rows ^ {int(row)})
+
+    def update(self, rows, new_rows):
+        """Profile of ``new_rows``, after the favorites changed from ``rows``.
+
+        Reuses the cached profile of ``rows`` when there is one, adding and
+        subtracting only the rows that differ.
+        """
+        before = frozenset(int(r) for r in rows)
+        after = frozenset(int(r) for r in new_rows)
+        added, removed = after - before, before - after
+        with self._lock:
+            previous = None if after in self.profiles else self.profiles.get(before)
+        if previous is None or len(added) + len(removed) > len(after):
+            return self.get(after)
+        profile = previous
+        for sign, changed in ((1, added), (-1, removed)):
+            if changed:
+                profile = profile + sign * (sp.csr_matrix(np.ones((1, len(changed)))) @ self.index.row_vectors(sorted(changed)))
+        profile.eliminate_zeros()
+        return self._store(after, profile)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.profiles), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def query_vector(profile, index, n_terms=PROFILE_TERMS, budget=POSTINGS_BUDGET):
+    """The profile's heaviest terms, L2-normalized, as a search vector.
+
+    Terms are taken heaviest first, skipping any whose posting list (in the
+    ``TfidfIndex``) no longer fits in ``budget``, until ``n_terms`` are
+    chosen.
+    """
+    profile = sp.csr_matrix(profile)
+    # Subtraction can leave tiny float residues of removed books
+    keep = profile.data > 1e-9
+    indices, data = profile.indices[keep], profile.data[keep]
+    lengths = index.posting_lengths(indices)
+    chosen = []
+    for i in np.argsort(-data, kind="stable"):
+        if lengths[i] <= budget:
+            chosen.append(i)
+            budget -= lengths[i]
+            if len(chosen) == n_terms:
+                break
+    indices, data = indices[chosen], data[chosen]
+    order = np.argsort(indices)
+    vec = sp.csr_matrix((data[order], indices[order], [0, len(data)]), shape=profile.shape)
+    # Imported here like in tfidf_index.make_vectorizer, to keep importing cheap
+    from sklearn.preprocessing import normalize
+    return normalize(vec)
+
+
+def recommend(index, profile, loved_rows, k=20, mask=None):
+    """Top ``k`` rows for a profile, best first, and the number of matching rows.
+
+    Rows in ``loved_rows`` and, when given, outside ``mask`` are never returned.
+    """
+    mask = np.ones(index.n_rows, dtype=bool) if mask is None else mask.copy()
+    mask[np.asarray(loved_rows, dtype=np.int64)] = False
+    rows, scores = index.matches(query_vector(profile, index), mask)
+    return tfidf_index.top_k(rows, scores, k)[0], len(rows)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk review store for the details modal.
+
+Reviews are written sorted by (book row, date_added newest first) into flat
+column files next to the TF-IDF index:
+
+    offsets.npy       book row -> first review, length n_books + 1
+    dates.npy         datetime64[s], NaT for unparseable dates
+    ratings.npy       float32, NaN when missing
+    text_offsets.npy  review -> byte range in text.bin
+    text.bin          UTF-8 review texts, back to back
+
+All files are memory-mapped, so opening a book's reviews is two offset
+lookups and a slice; the workers no longer keep the reviews frame in RAM.
+
+update_index.py writes the reviews of each update as one more store (a
+segment) instead of rewriting this one; ``ReviewStore`` reads them all.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+GOODREADS_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+
+def _parse_dates(values):
+    dates = pd.to_datetime(values, errors="coerce", utc=True, format=GOODREADS_DATE_FORMAT)
+    # Anything not in the Goodreads export format gets the generic parser
+    retry = dates.isna() & values.notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(values[retry], errors="coerce", utc=True, format="mixed")
+    return dates.dt.tz_localize(None).to_numpy().astype("datetime64[s]")
+
+
+def build(path, positions, out_dir, chunksize):
+    """Write the store for the books of ``positions`` from the reviews CSV at ``path``.
+
+    ``positions`` is the ``catalog.WorkPositions`` of books_df; the reviews
+    of a duplicated work_id go to its first row.
+    """
+    tmp_dir = f"{out_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    # Pass 1: stream the CSV, append texts in file order and keep only the small sort keys
+    rows, dates, ratings, starts, lengths = [], [], [], [], []
+    offset = 0
+    unsorted_path = os.path.join(tmp_dir, "unsorted.bin")
+    with open(unsorted_path, "wb") as blob:
+        for chunk in pd.read_csv(path, usecols=["work_id", "review_text", "rating", "date_added"], chunksize=chunksize):
+            chunk_rows = positions.get_indexer(chunk["work_id"])
+            chunk = chunk[chunk_rows >= 0]
+            encoded = [str(text).encode("utf-8") for text in chunk["review_text"].fillna("")]
+            chunk_lengths = np.fromiter((len(text) for text in encoded), dtype=np.int64, count=len(encoded))
+            blob.write(b"".join(encoded))
+
+            rows.append(chunk_rows[chunk_rows >= 0].astype(np.int32))
+            dates.append(_parse_dates(chunk["date_added"]))
+            ratings.append(pd.to_numeric(chunk["rating"], errors="coerce").to_numpy(dtype=np.float32))
+            starts.append(offset + np.concatenate(([0], np.cumsum(chunk_lengths)[:-1])).astype(np.int64))
+            lengths.append(chunk_lengths)
+            offset += int(chunk_lengths.sum())
+
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int32)
+    dates = np.concatenate(dates) if dates else np.empty(0, dtype="datetime64[s]")
+    ratings = np.concatenate(ratings) if ratings else np.empty(0, dtype=np.float32)
+    starts = np.concatenate(starts) if starts else np.empty(0, dtype=np.int64)
+    lengths = np.concatenate(lengths) if lengths else np.empty(0, dtype=np.int64)
+
+    # Book row ascending, then newest first; ~x reverses int64 order without
+    # overflowing, and puts NaT (the smallest int64) last
+    order = np.lexsort((~dates.view(np.int64), rows))
+
+    # Pass 2: copy the texts into sorted order
+    text_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths[order], out=text_offsets[1:])
+    if offset:
+        unsorted = np.memmap(unsorted_path, dtype=np.uint8, mode="r")
+        with open(os.path.join(tmp_dir, "text.bin"), "wb") as blob:
+            for i in order:
+                blob.write(unsorted[starts[i]:starts[i] + lengths[i]])
+        del unsorted
+    else:
+        open(os.path.join(tmp_dir, "text.bin"), "wb").close()
+    os.remove(unsorted_path)
+
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.searchsorted(rows[order], np.arange(len(positions) + 1)).astype(np.int64))
+    np.save(os.path.join(tmp_dir, "dates.npy"), dates[order])
+    np.save(os.path.join(tmp_dir, "ratings.npy"), ratings[order])
+    np.save(os.path.join(tmp_dir, "text_offsets.npy"), text_offsets)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+class _Segment:
+    def __init__(self, path):
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.dates = np.load(os.path.join(path, "dates.npy"), mmap_mode="r")
+        self.ratings = np.load(os.path.join(path, "ratings.npy"), mmap_mode="r")
+        self.text_offsets = np.load(os.path.join(path, "text_offsets.npy"), mmap_mode="r")
+        text_path = os.path.join(path, "text.bin")
+        # np.memmap cannot map an empty file
+        self.text = np.memmap(text_path, dtype=np.uint8, mode="r") if os.path.getsize(text_path) else np.empty(0, dtype=np.uint8)
+
+    def recent(self, row, n):
+        # Segments written before a book was added have no entry for it
+        if row + 1 >= len(self.offsets):
+            return []
+        start = int(self.offsets[row])
+        end = min(int(self.offsets[row + 1]), start + n)
+        reviews = []
+        for i in range(start, end):
+            reviews.append({
+                "date_added": pd.Timestamp(self.dates[i]),
+                "rating": float(self.ratings[i]),
+                "review_text": self.text[self.text_offsets[i]:self.text_offsets[i + 1]].tobytes().decode("utf-8"),
+            })
+        return reviews
+
+
+class ReviewStore:
+    """Read side of the store: the most recent reviews of one book, over one or more segments."""
+
+    def __init__(self, *paths):
+        self.segments = [_Segment(path) for path in paths]
+
+    def recent(self, row, n=10):
+        """The ``n`` most recent reviews of book ``row`` as dicts, newest first."""
+        reviews = [review for segment in self.segments for review in segment.recent(row, n)]
+        if len(self.segments) > 1:
+            # Newest first across the segments, unknown dates last
+            reviews.sort(key=lambda review: (pd.isna(review["date_added"]), -review["date_added"].value if pd.notna(review["date_added"]) else 0))
+        return reviews[:n]
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Search, recommendations and book details as plain Python, without Dash.
+
+Every function takes the ``app_context.Bookshelf`` to answer from and
+returns work_ids, rows or JSON-serializable dicts. The Dash callbacks of
+app20.py render these into components; the JSON API on the same Flask
+server (``/api/...``, see app20.py) returns them as they are, so other
+services pay neither for the component tree nor for its serialization.
+
+A search is identified by its cursor (``query_cache.cache_key``): the
+ranked work_ids are computed once per cursor and cached, and any page of
+it is a slice of that list. Cursors come back from clients, so they are
+checked and normalized before use (``parse_cursor``).
+
+pandas and recommendations.py (scipy) are imported by the functions that
+use them, not by ``import app20``; the loaded bookshelf has them by then.
+"""
+
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+import neighbors
+import query_cache
+
+# Fields of a book in search results and on the cards
+RESULT_COLUMNS = ["work_id", "original_title", "author", "genres", "original_publication_year", "avg_rating", "image_url", "num_pages"]
+
+# Results per page, and how deep a search is ranked (and cached) at most
+PAGE_SIZE = 20
+MAX_RESULTS = 500
+# Favorites one recommendation is computed from at most
+MAX_LOVED = int(os.environ.get("BOOKSHELF_MAX_LOVED", 500))
+# JSON-ready book records kept per worker for the API
+RECORD_CACHE_SIZE = int(os.environ.get("BOOKSHELF_RECORD_CACHE_SIZE", 10000))
+
+
+# -----------------------
+# ✳️ Ranking
+# -----------------------
+def rank_books(shelf, query, selected_genres, match_all_genres, k=20):
+    """Top ``k`` rows for a search, best first, and the number of matching books.
+
+    Title and author matches and text relevance are ranked together by the
+    planner (see query_planner.py); without a query the genre-filtered books
+    are listed newest first.
+    """
+    # 1. Filter by genre: boolean row mask over books_df, None means no filter
+    timer = metrics.Stopwatch()
+    genre_mask = shelf.genre_index.mask(selected_genres, match_all=bool(match_all_genres))
+    timer.lap("genre_filter")
+    if genre_mask is not None and not genre_mask.any():
+        return np.empty(0, dtype=np.int64), 0
+    return shelf.planner.rank(query, genre_mask, k)
+
+
+def profile_favorites(shelf, loved_ids):
+    """The favorites a recommendation is computed from, oldest first.
+
+    These are the last ``MAX_LOVED`` of ``loved_ids`` that this catalog
+    knows. The profile cache is updated and read with the same list, so a
+    heart click prepares the profile the next recommendation uses.
+    """
+    return [work_id for work_id in loved_ids if work_id in shelf.work_index][-MAX_LOVED:]
+
+
+def rank_for_you(shelf, loved_ids, selected_genres, match_all_genres, k=20):
+    """Top ``k`` rows for the favorites in ``loved_ids``, and the number of matching books."""
+    import recommendations
+
+    timer = metrics.Stopwatch()
+    genre_mask = shelf.genre_index.mask(selected_genres, match_all=bool(match_all_genres))
+    timer.lap("genre_filter")
+    loved_rows = shelf.work_index.lookup(loved_ids)
+    profile = shelf.profiles.get(loved_rows)
+    timer.lap("profile")
+    result = recommendations.recommend(shelf.tfidf, profile, loved_rows, k, genre_mask)
+    timer.lap("recommend")
+    return result
+
+
+def search_cursor(query, selected_genres, match_all_genres, loved_ids=None):
+    """Cursor of a search (or of the recommendations for ``loved_ids``): the key its ranked results are cached under."""
+    return query_cache.cache_key(query, selected_genres, match_all_genres, MAX_RESULTS, loved=loved_ids)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_cursor(cursor):
+    """``(query, genres, match_all, loved)`` of a cursor from a client; ValueError for a malformed one.
+
+    The depth stored in the cursor is ignored: every search is ranked
+    ``MAX_RESULTS`` deep. More than ``MAX_LOVED`` favorites are refused.
+    """
+    try:
+        query, genres, match_all, _, loved = query_cache.parse_key(cursor)
+    except (TypeError, ValueError) as err:
+        raise ValueError("invalid cursor") from err
+    if not (isinstance(query, str) and isinstance(genres, list) and all(isinstance(genre, str) for genre in genres) and isinstance(match_all, bool)):
+        raise ValueError("invalid cursor")
+    if loved is not None:
+        if not isinstance(loved, list) or not all(_is_int(work_id) for work_id in loved):
+            raise ValueError("invalid cursor")
+        if len(loved) > MAX_LOVED:
+            raise ValueError(f"at most {MAX_LOVED} loved books")
+    return query, genres, match_all, loved
+
+
+def ranked_results(shelf, cursor):
+    """``{"work_ids": [...], "total": n}`` for a cursor, ranked at most once per cache lifetime.
+
+    Any worker can serve any page: on a cache miss the search is re-ranked
+    from the arguments stored in the cursor itself.
+    """
+    query, genres, match_all, loved = parse_cursor(cursor)
+
+    def rank():
+        if loved is not None:
+            rows, total = rank_for_you(shelf, loved, genres, match_all, MAX_RESULTS)
+        else:
+            rows, total = rank_books(shelf, query, genres, match_all, MAX_RESULTS)
+        return {"work_ids": shelf.books_df["work_id"].to_numpy()[rows].tolist(), "total": total}
+
+    # Cached under the normalized cursor, whatever form the client sent
+    return shelf.results_cache.get_or_compute(search_cursor(query, genres, match_all, loved), rank)
+
+
+def search_page(shelf, cursor, page=1, page_size=PAGE_SIZE):
+    """One page of the search behind ``cursor`` as a dict.
+
+    A query that finds nothing is retried once with its misspelled words
+    corrected; ``corrected`` is then the query that was searched instead
+    and ``cursor`` its cursor. ``work_ids`` are the page's books, ``ranked``
+    the number of results that can be paged through, ``total`` the number
+    of matching books. ``page`` is clamped to the pages there are.
+    ValueError for a malformed cursor.
+    """
+    searched, genres, match_all, loved = parse_cursor(cursor)
+    cursor = search_cursor(searched, genres, match_all, loved)
+    results = ranked_results(shelf, cursor)
+    corrected = shelf.suggestions.correct(searched) if searched and not results["total"] else None
+    if corrected:
+        cursor = search_cursor(corrected, genres, match_all)
+        results = ranked_results(shelf, cursor)
+    pages = max(-(-len(results["work_ids"]) // page_size), 1)
+    page = min(max(int(page or 1), 1), pages)
+    return {
+        "cursor": cursor,
+        "query": searched,
+        "corrected": corrected,
+        "total": results["total"],
+        "ranked": len(results["work_ids"]),
+        "page": page,
+        "pages": pages,
+        "work_ids": results["work_ids"][(page - 1) * page_size:page * page_size],
+    }
+
+
+# -----------------------
+# ✳️ Book records
+# -----------------------
+def book_records(shelf, rows):
+    """Card fields of ``rows`` as dicts, descriptions included."""
+    timer = metrics.Stopwatch()
+    books = shelf.books_df.iloc[rows][RESULT_COLUMNS].to_dict("records")
+    for book, row in zip(books, rows):
+        book["description"] = shelf.descriptions[row]
+    timer.lap("records")
+    return books
+
+
+def _json_value(value):
+    if not isinstance(value, float):
+        return value
+    # NaN is not valid JSON; the float32 columns print with their own precision
+    return None if math.isnan(value) else float(f"{value:.7g}")
+
+
+def json_records(books):
+    return [{key: _json_value(value) for key, value in book.items()} for book in books]
+
+
+class RecordCache:
+    """``json_records`` of books per work_id, least recently used evicted first.
+
+    Reading a page of records out of the frame costs a few milliseconds of
+    pandas indexing; popular books are read once. Keyed on the index
+    directory too, so a new index generation reads them again.
+    """
+
+    def __init__(self, max_entries=RECORD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, shelf, work_ids):
+        """Records of the known ``work_ids``, in the given order; shared, so not to be modified."""
+        rows = shelf.work_index.lookup(work_ids)
+        keys = [(shelf.index_dir, int(work_id)) for work_id in shelf.books_df["work_id"].to_numpy()[rows]]
+        with self._lock:
+            records = [self.records.get(key) for key in keys]
+            missing = [i for i, record in enumerate(records) if record is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            for i, record in zip(missing, json_records(book_records(shelf, rows[missing]))):
+                records[i] = record
+        with self._lock:
+            for key, record in zip(keys, records):
+                self.records[key] = record
+                self.records.move_to_end(key)
+            while len(self.records) > self.max_entries:
+                self.records.popitem(last=False)
+        return records
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.records), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+record_cache = RecordCache()
+
+
+def search(shelf, query=None, genres=(), match_all=False, loved=None, page=1, page_size=PAGE_SIZE, cursor=None):
+    """``search_page`` with the page's books as JSON-ready records.
+
+    With ``loved`` (work_ids) these are the recommendations for those
+    favorites and ``query`` is ignored. A ``cursor`` from an earlier result
+    continues that search instead.
+    """
+    cursor = cursor or search_cursor(query, genres, match_all, loved)
+    result = search_page(shelf, cursor, page, page_size)
+    result["books"] = record_cache.get(shelf, result.pop("work_ids"))
+    return result
+
+
+def details(shelf, work_id, n_reviews=10):
+    """Everything the details modal shows for ``work_id``, or None for an unknown book.
+
+    ``reviews`` are the most recent first, ``similar`` the precomputed
+    similar books.
+    """
+    import pandas as pd
+
+    row = shelf.work_index.row(work_id)
+    if row is None:
+        return None
+    book = json_records(book_records(shelf, [row]))[0]
+    timer = metrics.Stopwatch()
+    reviews = [
+        {
+            "date_added": review["date_added"].strftime("%Y-%m-%d") if pd.notna(review["date_added"]) else None,
+            "rating": int(review["rating"]) if pd.notna(review["rating"]) else None,
+            "review_text": review["review_text"],
+        }
+        for review in shelf.reviews.recent(row, n=n_reviews)
+    ]
+    timer.lap("reviews")
+    similar_rows = neighbors.similar_rows(shelf.similar_books, row)
+    similar = shelf.books_df.iloc[similar_rows][["work_id", "original_title", "author"]].to_dict("records")
+    timer.lap("similar")
+    return {"book": book, "reviews": reviews, "similar": similar}
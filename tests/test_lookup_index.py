@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+The lookup structures of lookup_index.py against the pandas filters they replace.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import catalog
+from lookup_index import GenreIndex, SubstringIndex, SuggestIndex
+
+BOOKS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "books_1980_1990.csv")
+
+
+@pytest.fixture(scope="module")
+def books_df():
+    return catalog.load_works(BOOKS_CSV)
+
+
+# -----------------------
+# ✳️ Substring index
+# -----------------------
+@pytest.fixture(scope="module")
+def title_index(books_df):
+    return SubstringIndex(books_df["original_title"])
+
+
+@pytest.mark.parametrize("query", ["the", "harry", "of the", "e", "ar", "love story", "z9q", "", "!"])
+def test_substring_lookup_matches_str_contains(books_df, title_index, query):
+    expected = np.flatnonzero(books_df["original_title"].astype(object).fillna("").str.lower().str.contains(query, regex=False))
+    np.testing.assert_array_equal(title_index.lookup(query), expected)
+
+
+def test_substring_lookup_rows_of_repeated_values():
+    index = SubstringIndex(["Dune", "It", "dune messiah", None, "Dune"])
+    np.testing.assert_array_equal(index.lookup("dune"), [0, 2, 4])
+    np.testing.assert_array_equal(index.lookup("it"), [1])
+    assert index.lookup("xyz").dtype == np.int32
+    assert list(index.values_at(np.array([4, 3]))) == ["dune", ""]
+
+
+# -----------------------
+# ✳️ Genre index
+# -----------------------
+@pytest.fixture(scope="module")
+def genre_index():
+    return GenreIndex(catalog.genre_lists(["Fiction, Mystery", "Non-Fiction, History", "fiction", None, "Mystery, Thriller, Fiction"]))
+
+
+def test_genre_mask_nothing_selected(genre_index):
+    assert genre_index.mask(None) is None
+    assert genre_index.mask("All") is None
+    assert genre_index.mask([]) is None
+    assert genre_index.mask(["All", ""]) is None
+
+
+def test_genre_mask_exact_and_case_insensitive(genre_index):
+    # "fiction" must not match "non-fiction"
+    np.testing.assert_array_equal(genre_index.mask("FICTION"), [True, False, True, False, True])
+    np.testing.assert_array_equal(genre_index.mask(["non-fiction"]), [False, True, False, False, False])
+
+
+def test_genre_mask_any_and_all(genre_index):
+    np.testing.assert_array_equal(genre_index.mask(["History", "Thriller"]), [False, True, False, False, True])
+    np.testing.assert_array_equal(genre_index.mask(["Fiction", "Mystery"], match_all=True), [True, False, False, False, True])
+    # The same genre twice is still one genre
+    np.testing.assert_array_equal(genre_index.mask(["Mystery", "mystery"], match_all=True), [True, False, False, False, True])
+
+
+def test_genre_mask_unknown_genre(genre_index):
+    np.testing.assert_array_equal(genre_index.mask("Poetry"), np.zeros(5, dtype=bool))
+    np.testing.assert_array_equal(genre_index.mask(["Fiction", "Poetry"]), [True, False, True, False, True])
+    np.testing.assert_array_equal(genre_index.mask(["Fiction", "Poetry"], match_all=True), np.zeros(5, dtype=bool))
+
+
+# -----------------------
+# ✳️ Spelling corrections
+# -----------------------
+@pytest.fixture(scope="module")
+def suggestions():
+    titles = ["Jurassic Park", "Congo", "The Shining", "Sphere", "Misery"]
+    authors = ["Michael Crichton", "Michael Crichton", "Stephen King", "Michael Crichton", "Stephen King"]
+    return SuggestIndex(titles, authors, weights=[100, 10, 50, 5, 40])
+
+
+@pytest.mark.parametrize("word, expected", [
+    ("crichton", "crichton"),  # known
+    ("crichtn", "crichton"),  # deletion
+    ("crichtoon", "crichton"),  # insertion
+    ("cricthon", "crichton"),  # transposition
+    ("crochtan", "crichton"),  # two substitutions
+    ("shpere", "sphere"),
+    ("xyzzyx", None),  # nothing within two edits
+])
+def test_correct_word(suggestions, word, expected):
+    assert suggestions.correct_word(word) == expected
+
+
+def test_correct_word_max_distance():
+    index = SuggestIndex(["Sphere"], ["Michael Crichton"], max_distance=1)
+    assert index.correct_word("crichtn") == "crichton"
+    assert index.correct_word("crochtan") is None
+
+
+def test_correct_word_prefers_closer_then_more_popular():
+    # "kine" is one edit from both; "king" is in the more popular book
+    index = SuggestIndex(["Kind", "Misery"], ["Anon", "Stephen King"], weights=[1, 1000])
+    assert index.correct_word("kine") == "king"
+    # "kinds" is one edit from "kind" and two from "king"
+    assert index.correct_word("kinds") == "kind"
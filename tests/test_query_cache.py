@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Cache keys of query_cache.py: the same search always gets the same key.
+"""
+
+import query_cache
+from query_cache import cache_key, parse_key
+
+
+def test_cache_key_normalizes_the_search():
+    key = cache_key("  Jurassic   PARK ", ["Thriller", "fiction", "All", "", "FICTION"], match_all=1, k=20)
+    assert key == cache_key("jurassic park", ["fiction", "thriller"], match_all=True, k=20)
+    assert parse_key(key) == ("jurassic park", ["fiction", "thriller"], True, 20, None)
+
+
+def test_cache_key_distinguishes_searches():
+    key = cache_key("dune", ["fiction"])
+    assert key != cache_key("dune messiah", ["fiction"])
+    assert key != cache_key("dune", ["science fiction"])
+    assert key != cache_key("dune", ["fiction"], k=500)
+    assert cache_key("dune", ["fiction", "classics"]) != cache_key("dune", ["fiction", "classics"], match_all=True)
+
+
+def test_cache_key_match_all_needs_two_genres():
+    assert cache_key("dune", ["fiction"], match_all=True) == cache_key("dune", ["fiction"])
+    assert cache_key(None, None, match_all=True) == cache_key("", [])
+    assert parse_key(cache_key(None, None, match_all=True)) == ("", [], False, 20, None)
+
+
+def test_cache_key_of_recommendations():
+    key = cache_key("ignored", ["Fiction"], k=500, loved=[3, 1, 2, 3])
+    assert key == cache_key(None, ["fiction"], k=500, loved=(1, 2, 3))
+    assert parse_key(key) == ("", ["fiction"], False, 500, [1, 2, 3])
+    # No favorites is not the same as no recommendations
+    assert parse_key(cache_key("", [], loved=[]))[4] == []
+    assert cache_key("", [], loved=[]) != cache_key("", [])
+
+
+def test_cached_results_round_trip(tmp_path):
+    cache = query_cache.QueryCache(str(tmp_path / "cache.sqlite"))
+    key = cache_key("dune", ["fiction"])
+    assert cache.get(key) is None
+    cache.put(key, {"work_ids": [3, 1], "total": 2})
+    assert cache.get(key) == {"work_ids": [3, 1], "total": 2}
+    assert (cache.hits, cache.misses) == (1, 1)
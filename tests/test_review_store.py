@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+The on-disk review store of review_store.py: reviews per book, newest first.
+"""
+
+import pandas as pd
+import pytest
+
+import catalog
+import review_store
+
+
+def write_reviews(path, rows):
+    pd.DataFrame(rows, columns=["work_id", "review_text", "rating", "date_added"]).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture
+def store(tmp_path):
+    reviews_path = write_reviews(tmp_path / "reviews.csv", [
+        (20, "middle", 3, "Tue Mar 05 10:00:00 -0800 2013"),
+        (10, "only one", 5, "Mon Jan 01 00:00:00 +0000 2018"),
+        (20, "undated", None, "not a date"),
+        (99, "unknown work", 1, "Mon Jan 01 00:00:00 +0000 2018"),
+        (20, "newest, ünïcode", 4, "2019-06-01 12:00:00"),
+        (20, None, 2, "Wed Jan 01 00:00:00 +0000 2003"),
+        (20, "oldest", 1, "Wed Jan 01 00:00:00 +0000 2003"),
+    ])
+    # Book 30 has no reviews; the second 20 is a duplicated work_id
+    positions = catalog.WorkPositions([10, 20, 30, 20])
+    # A small chunksize, so the reviews of one book come from several chunks
+    out_dir = review_store.build(reviews_path, positions, str(tmp_path / "reviews"), chunksize=2)
+    return review_store.ReviewStore(out_dir)
+
+
+def test_reviews_newest_first(store):
+    reviews = store.recent(1)
+    assert [review["review_text"] for review in reviews[:2]] == ["newest, ünïcode", "middle"]
+    # Equal dates keep the file order; unknown dates go last
+    assert [review["review_text"] for review in reviews[2:]] == ["", "oldest", "undated"]
+    assert [review["rating"] for review in reviews[:2]] == [4.0, 3.0]
+    assert reviews[0]["date_added"] == pd.Timestamp("2019-06-01 12:00:00")
+    assert reviews[1]["date_added"] == pd.Timestamp("2013-03-05 18:00:00")
+    assert pd.isna(reviews[-1]["date_added"]) and pd.isna(reviews[-1]["rating"])
+
+
+def test_reviews_per_book(store):
+    assert [review["review_text"] for review in store.recent(0)] == ["only one"]
+    assert store.recent(2) == []
+    # Reviews of a duplicated work_id go to its first row only
+    assert store.recent(3) == []
+    assert len(store.recent(1, n=2)) == 2
+
+
+def test_reviews_across_segments(store, tmp_path):
+    delta_path = write_reviews(tmp_path / "reviews_delta.csv", [
+        (20, "from the update", 5, "Mon Jan 01 00:00:00 +0000 2016"),
+        (40, "new book", 5, "Mon Jan 01 00:00:00 +0000 2016"),
+    ])
+    positions = catalog.WorkPositions([10, 20, 30, 20, 40])
+    out_dir = review_store.build(delta_path, positions, str(tmp_path / "reviews-g1"), chunksize=10)
+    merged = review_store.ReviewStore(str(tmp_path / "reviews"), out_dir)
+    assert [review["review_text"] for review in merged.recent(1, n=3)] == ["newest, ünïcode", "from the update", "middle"]
+    assert [review["review_text"] for review in merged.recent(4)] == ["new book"]
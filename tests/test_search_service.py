@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Cursors from clients: search_service.parse_cursor accepts what search_cursor makes and nothing else.
+"""
+
+import json
+
+import pytest
+
+import search_service
+from search_service import parse_cursor, search_cursor
+
+
+def test_parse_cursor_round_trip():
+    cursor = search_cursor(" Jurassic Park", ["Thriller", "Fiction"], True)
+    assert parse_cursor(cursor) == ("jurassic park", ["fiction", "thriller"], True, None)
+    cursor = search_cursor("", ["Fiction"], False, loved_ids=[7, 5])
+    assert parse_cursor(cursor) == ("", ["fiction"], False, [5, 7])
+
+
+def test_parse_cursor_ignores_the_depth():
+    # Every search is ranked MAX_RESULTS deep, whatever the client asks for
+    assert parse_cursor(json.dumps(["dune", [], False, 10 ** 9, None])) == ("dune", [], False, None)
+
+
+@pytest.mark.parametrize("cursor", [
+    None,
+    "",
+    "not json",
+    "{}",
+    "[]",
+    json.dumps(["dune", [], False, 500]),
+    json.dumps([1, [], False, 500, None]),
+    json.dumps(["dune", "fiction", False, 500, None]),
+    json.dumps(["dune", [1], False, 500, None]),
+    json.dumps(["dune", [], "yes", 500, None]),
+    json.dumps(["", [], False, 500, 5]),
+    json.dumps(["", [], False, 500, ["5"]]),
+    json.dumps(["", [], False, 500, [True]]),
+    json.dumps(["", [], False, 500, [1.5]]),
+])
+def test_parse_cursor_rejects_malformed(cursor):
+    with pytest.raises(ValueError, match="invalid cursor"):
+        parse_cursor(cursor)
+
+
+def test_parse_cursor_caps_the_favorites(monkeypatch):
+    monkeypatch.setattr(search_service, "MAX_LOVED", 3)
+    assert parse_cursor(json.dumps(["", [], False, 500, [1, 2, 3]]))[3] == [1, 2, 3]
+    with pytest.raises(ValueError, match="at most 3 loved books"):
+        parse_cursor(json.dumps(["", [], False, 500, [1, 2, 3, 4]]))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+The sharded term counting of tfidf_index.py against a single TfidfVectorizer.
+
+``count_all`` + ``fit_counts`` must build the index ``TfidfVectorizer.fit_transform``
+builds from the old boosted ``text`` column: same vocabulary, same IDF, same
+matrix.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import catalog
+import tfidf_index
+
+BOOKS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "books_1980_1990.csv")
+
+
+@pytest.fixture(scope="module")
+def books_df():
+    return catalog.load_works(BOOKS_CSV)
+
+
+@pytest.fixture
+def reviews_path(books_df, tmp_path):
+    # Two reviews for every fifth book, an empty one and one of an unknown work
+    work_ids = books_df["work_id"].to_numpy()[::5]
+    reviews = pd.DataFrame({
+        "work_id": [*np.repeat(work_ids, 2), work_ids[0], -1],
+        "review_text": [*(f"Review {i} of a thrilling mystery, {i % 7} stars" for i in range(2 * len(work_ids))), None, "unknown work"],
+    })
+    path = tmp_path / "reviews.csv"
+    reviews.to_csv(path, index=False)
+    return str(path)
+
+
+def boosted_text(books_df, reviews_path):
+    """The document of every book as app20.py used to build it before the counts were sharded."""
+    reviews = pd.read_csv(reviews_path).dropna(subset=["review_text"])
+    grouped = reviews.groupby("work_id")["review_text"].apply(lambda texts: " ".join(str(t) for t in texts))
+    review_text = books_df["work_id"].map(grouped).fillna("")
+
+    def column(name):
+        return books_df[name].astype(object).fillna("").astype(str).str.lower()
+
+    return (
+        (column("original_title") + " ")
+        + (column("genres") + " ") * 2
+        + column("description") + " "
+        + (column("author") + " ") * 4
+        + review_text.str.lower()
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_sharded_counts_match_tfidf_vectorizer(books_df, reviews_path, monkeypatch, workers):
+    # Several shards per field and several review chunks, even for this small catalog
+    monkeypatch.setattr(tfidf_index, "SHARD_ROWS", 100)
+    fields, vocabulary = tfidf_index.count_all(books_df, reviews_path, chunksize=7, workers=workers)
+    index = tfidf_index.fit_counts(tfidf_index.weighted_counts(fields), vocabulary)
+
+    expected = tfidf_index.make_vectorizer()
+    expected_matrix = expected.fit_transform(boosted_text(books_df, reviews_path))
+
+    assert index.vectorizer.vocabulary == expected.vocabulary_
+    np.testing.assert_allclose(index.vectorizer.idf_, expected.idf_)
+    assert index.matrix.shape == expected_matrix.shape
+    assert abs(index.matrix - expected_matrix).max() < 1e-12
@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+"""
+Persisted TF-IDF index.
+
+`python build_index.py` fits the vectorizer once and writes the vocabulary,
+IDF weights and the matrix to ``index/v<version>-<digest>/``, where the digest
+is a hash of the source CSVs. At startup app20.py loads the arrays with
+``np.load(mmap_mode="r")`` so every gunicorn worker maps the same pages from
+the page cache instead of holding its own fitted copy.
+
+The matrix is stored twice: CSR (one row per book) and CSC (one posting list
+per term). Queries only touch the CSC columns of their own terms.
+
+Generations written by update_index.py hard-link those arrays from the
+previous generation and store only the rows that changed since the last
+full fit (``RowDelta``); the delta is swapped in when a row or a posting
+list is read.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+import catalog
+
+INDEX_VERSION = 7
+INDEX_ROOT = os.environ.get("BOOKSHELF_INDEX_DIR", "index")
+
+
+def make_vectorizer(vocabulary=None):
+    # scikit-learn takes longer to import than the rest of the app together;
+    # it is imported when an index is loaded or built, not with app20.py
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer(stop_words="english", vocabulary=vocabulary)
+
+
+# -----------------------
+# ✳️ Term counts
+# -----------------------
+# Fields that make up a book's document: books_df columns plus the reviews.
+# Their term counts are kept apart for BM25F (see bm25f_index.py). The
+# analyzer lowercases, so the columns are counted as they are.
+FIELD_COLUMNS = {
+    "title": "original_title",
+    "genres": "genres",
+    "description": "description",
+    "author": "author",
+}
+FIELDS = [*FIELD_COLUMNS, "reviews"]
+
+# How often each field is counted in the TF-IDF document. Same weights as the
+# old boosted `text` column, which repeated the genres twice and the author
+# four times.
+FIELD_WEIGHTS = {"title": 1, "genres": 2, "description": 1, "author": 4, "reviews": 1}
+# Books per shard when the books_df fields are counted in parallel
+SHARD_ROWS = 20_000
+
+
+class TermCounter:
+    """Term counting with a vocabulary that grows as text arrives.
+
+    Uses the vectorizer's own analyzer, so the counts are exactly what
+    ``TfidfVectorizer.fit`` would have seen for the concatenated text.
+    """
+
+    def __init__(self, vocabulary=None):
+        self.analyzer = make_vectorizer().build_analyzer()
+        self.vocabulary = dict(vocabulary or {})
+
+    def count(self, texts, rows, n_rows):
+        """Sparse ``n_rows x len(vocabulary)`` term counts of ``texts``, summed per target row."""
+        vocabulary = self.vocabulary
+        cols, lengths = [], []
+        for text in texts:
+            terms = self.analyzer(text)
+            cols.extend([vocabulary.setdefault(term, len(vocabulary)) for term in terms])
+            lengths.append(len(terms))
+        coo_rows = np.repeat(np.asarray(rows, dtype=np.int32), lengths)
+        counts = sp.csr_matrix(
+            (np.ones(len(cols), dtype=np.int32), (coo_rows, np.array(cols, dtype=np.int32))),
+            shape=(n_rows, len(vocabulary)),
+        )
+        counts.sum_duplicates()
+        return counts
+
+
+def add_counts(parts, n_cols):
+    # Pad every part to the current vocabulary size before summing
+    total = None
+    for part in parts:
+        part.resize((part.shape[0], n_cols))
+        total = part if total is None else total + part
+    return total
+
+
+class CountTotal:
+    """Running sum of count matrices whose vocabulary keeps growing.
+
+    Parts are folded in as they arrive; pending parts are merged into the
+    total once they hold as many non-zeros as it does, so the work stays
+    proportional to the output rather than to the number of parts.
+    """
+
+    def __init__(self):
+        self.total, self.pending, self.pending_nnz = None, [], 0
+
+    def add(self, part, n_cols):
+        self.pending.append(part)
+        self.pending_nnz += part.nnz
+        if self.total is None or self.pending_nnz >= self.total.nnz:
+            self.total = add_counts(([self.total] if self.total is not None else []) + self.pending, n_cols)
+            self.pending, self.pending_nnz = [], 0
+
+    def result(self, n_rows, n_cols):
+        parts = ([self.total] if self.total is not None else []) + self.pending
+        if not parts:
+            return sp.csr_matrix((n_rows, n_cols), dtype=np.int32)
+        return add_counts(parts, n_cols)
+
+
+def _count_shard(texts, rows, n_rows):
+    """Term counts of one shard with a vocabulary of its own: COO arrays plus its terms in id order."""
+    counter = TermCounter()
+    counts = counter.count(texts, rows, n_rows).tocoo()
+    return counts.row, counts.col, counts.data, list(counter.vocabulary)
+
+
+def _count_shards(shards, workers):
+    """``(field, _count_shard(...))`` per ``(field, texts, rows, n_rows)`` shard, in shard order.
+
+    With more than one worker the shards are tokenized in a process pool;
+    at most two per worker are in flight, so a streamed CSV is never read
+    far ahead of the counting.
+    """
+    if workers == 1:
+        for field, *args in shards:
+            yield field, _count_shard(*args)
+        return
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        in_flight = deque()
+        for field, *args in shards:
+            in_flight.append((field, pool.submit(_count_shard, *args)))
+            if len(in_flight) >= 2 * workers:
+                field, future = in_flight.popleft()
+                yield field, future.result()
+        while in_flight:
+            field, future = in_flight.popleft()
+            yield field, future.result()
+
+
+def count_all(books_df, reviews_path=catalog.REVIEWS_CSV, chunksize=catalog.REVIEW_CHUNKSIZE, workers=None, positions=None):
+    """Raw per-book term counts of every field, as ``({field: counts}, vocabulary)``.
+
+    The books_df fields are cut into shards of ``SHARD_ROWS`` books and the
+    reviews CSV into chunks of ``chunksize`` reviews. Each shard is counted
+    with its own vocabulary (on ``workers`` processes, default all cores)
+    and remapped onto the shared one as the results come back in order.
+    Counts are integers, so the sums equal a single-process count exactly;
+    only the order of the vocabulary differs, and ``alphabetical`` sorts
+    that away.
+
+    Neither the review frame nor a concatenated per-book text is ever held
+    in memory; only the term counts are. ``positions`` is the
+    ``catalog.WorkPositions`` of books_df when the caller has it already.
+    """
+    n_rows = len(books_df)
+    workers = workers or os.cpu_count() or 1
+    if positions is None:
+        positions = catalog.WorkPositions(books_df["work_id"])
+
+    def shards():
+        for field, column in FIELD_COLUMNS.items():
+            texts = books_df[column].astype(object).fillna("").to_numpy()
+            for start in range(0, n_rows, SHARD_ROWS):
+                rows = np.arange(start, min(start + SHARD_ROWS, n_rows))
+                yield field, texts[rows], rows, n_rows
+        for rows, texts in catalog.iter_review_chunks(reviews_path, positions, chunksize):
+            yield "reviews", texts, rows, n_rows
+
+    vocabulary = {}
+    totals = {field: CountTotal() for field in FIELDS}
+    for field, (coo_rows, cols, data, terms) in _count_shards(shards(), workers):
+        term_ids = np.array([vocabulary.setdefault(term, len(vocabulary)) for term in terms], dtype=np.int32)
+        part = sp.csr_matrix((data, (coo_rows, term_ids[cols])), shape=(n_rows, len(vocabulary)))
+        totals[field].add(part, len(vocabulary))
+    # Pad every field to the final vocabulary size
+    return {field: total.result(n_rows, len(vocabulary)) for field, total in totals.items()}, vocabulary
+
+
+def weighted_counts(fields, weights=FIELD_WEIGHTS):
+    """Per-book counts of the whole document, each field counted ``weights[field]`` times."""
+    n_cols = max(counts.shape[1] for counts in fields.values())
+    return add_counts([counts * weights[field] for field, counts in fields.items()], n_cols)
+
+
+def alphabetical(vocabulary):
+    """Sorted vocabulary and the old -> new term id map, as the vectorizer numbers its features."""
+    terms = sorted(vocabulary, key=vocabulary.get)
+    order = np.argsort(terms)
+    remap = np.empty(len(terms), dtype=np.int32)
+    remap[order] = np.arange(len(terms), dtype=np.int32)
+    return {terms[i]: j for j, i in enumerate(order)}, remap
+
+
+def remap_terms(counts, remap, dtype=np.float64):
+    counts = sp.csr_matrix(counts, dtype=dtype)
+    counts.resize((counts.shape[0], len(remap)))
+    counts.indices = remap[counts.indices]
+    counts.sort_indices()
+    return counts
+
+
+def fit_counts(counts, vocabulary):
+    """TF-IDF index from raw per-book term counts, as ``TfidfVectorizer.fit_transform`` builds it."""
+    from sklearn.feature_extraction.text import TfidfTransformer
+    sorted_vocabulary, remap = alphabetical(vocabulary)
+    transformer = TfidfTransformer()
+    tfidf_matrix = transformer.fit_transform(remap_terms(counts, remap))
+    vectorizer = make_vectorizer(vocabulary=sorted_vocabulary)
+    vectorizer.idf_ = transformer.idf_
+    return TfidfIndex(vectorizer, tfidf_matrix)
+
+
+def build(books_df, reviews_path=catalog.REVIEWS_CSV, chunksize=catalog.REVIEW_CHUNKSIZE, workers=None):
+    """Fit the TF-IDF index, streaming the reviews CSV in chunks."""
+    fields, vocabulary = count_all(books_df, reviews_path, chunksize, workers)
+    return fit_counts(weighted_counts(fields), vocabulary)
+
+
+# -----------------------
+# ✳️ Scoring
+# -----------------------
+class TfidfIndex:
+    """Fitted vectorizer plus the L2-normalized TF-IDF matrix in CSR and CSC form.
+
+    Rows are normalized by the vectorizer, so the dot product with a
+    transformed query is the cosine similarity that ``linear_kernel`` gave.
+    """
+
+    def __init__(self, vectorizer, matrix, matrix_csc=None, delta=None):
+        self.vectorizer = vectorizer
+        self.matrix = sp.csr_matrix(matrix)
+        self.matrix_csc = matrix_csc if matrix_csc is not None else self.matrix.tocsc()
+        # Rows changed since ``matrix`` was fitted (see update_index.py)
+        self.delta = delta
+        self.n_rows, self.n_terms = delta.shape if delta is not None else self.matrix.shape
+
+    def row_vectors(self, rows):
+        """CSR rows ``rows`` of the matrix, changed rows included."""
+        return take_rows(self.matrix, self.delta, rows, self.n_terms)
+
+    def full_matrix(self):
+        """The whole matrix as CSR; a copy with the changed rows swapped in when there are any."""
+        return self.matrix if self.delta is None else self.delta.apply(self.matrix)
+
+    def posting_lengths(self, terms):
+        """Entries in the posting lists of ``terms`` (counting a changed row's old entries too)."""
+        terms = np.asarray(terms, dtype=np.int64)
+        indptr = self.matrix_csc.indptr
+        stored = terms < len(indptr) - 1
+        lengths = np.zeros(len(terms), dtype=np.int64)
+        lengths[stored] = indptr[terms[stored] + 1] - indptr[terms[stored]]
+        if self.delta is not None:
+            indptr = self.delta.postings.indptr
+            lengths += indptr[terms + 1] - indptr[terms]
+        return lengths
+
+    def score(self, query_vec):
+        """Rows with a non-zero score for ``query_vec`` and their scores.
+
+        Only the posting lists of the query's own terms are read, instead of
+        multiplying against every row of the matrix.
+        """
+        query_vec = sp.csr_matrix(query_vec)
+        postings = [(*column(self.matrix_csc, self.delta, term), weight) for term, weight in zip(query_vec.indices, query_vec.data)]
+        postings = [(rows, values, weight) for rows, values, weight in postings if len(rows)]
+        if not postings:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        rows = np.concatenate([rows for rows, _, _ in postings])
+        weights = np.concatenate([values * weight for _, values, weight in postings])
+        if len(postings) == 1:
+            return rows.astype(np.int64), weights
+
+        if len(rows) > self.n_rows // 8:
+            # Broad query: a dense accumulator beats sorting the postings
+            scores = np.bincount(rows, weights=weights, minlength=self.n_rows)
+            rows = np.flatnonzero(scores)
+            return rows, scores[rows]
+        rows, inverse = np.unique(rows, return_inverse=True)
+        return rows.astype(np.int64), np.bincount(inverse, weights=weights)
+
+    def matches(self, query_vec, mask=None):
+        """Every row inside ``mask`` with a non-zero score and its score, unordered."""
+        rows, scores = self.score(query_vec)
+        if mask is not None:
+            keep = mask[rows]
+            rows, scores = rows[keep], scores[keep]
+        return rows, scores
+
+    def match_rows(self, query_vec, mask=None):
+        """The rows ``matches`` returns, sorted, without scoring them: every row with a query term."""
+        hit = np.zeros(self.n_rows, dtype=bool)
+        for term in sp.csr_matrix(query_vec).indices:
+            hit[column(self.matrix_csc, self.delta, term)[0]] = True
+        if mask is not None:
+            hit &= mask
+        return np.flatnonzero(hit)
+
+    def search_vector(self, query_vec, k=20, mask=None):
+        return top_k(*self.matches(query_vec, mask), k)
+
+    def search(self, query, k=20, mask=None):
+        """Top ``k`` rows for ``query`` as ``(rows, scores)``, best first.
+
+        ``mask`` is an optional boolean row mask (e.g. the genre filter);
+        rows outside it, and rows sharing no term with the query, are never
+        returned.
+        """
+        return self.search_vector(self.vectorizer.transform([query]), k, mask)
+
+
+# -----------------------
+# ✳️ Row deltas
+# -----------------------
+# Stored values read per pass when rows are picked out of a CSC matrix
+SCAN_ENTRIES = 1 << 22
+
+
+class RowDelta:
+    """Rows of a stored matrix replaced or appended since it was written (see update_index.py).
+
+    ``rows`` are the sorted row numbers of the whole ``shape`` matrix and
+    ``matrix`` their current values, one CSR row each. A column of the
+    whole matrix is the stored column without the replaced rows plus the
+    same column of ``postings``.
+    """
+
+    def __init__(self, rows, matrix, n_rows):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.matrix = sp.csr_matrix(matrix)
+        self.shape = (n_rows, self.matrix.shape[1])
+        self.replaced = np.zeros(n_rows, dtype=bool)
+        self.replaced[self.rows] = True
+        # The same values by column, numbered as rows of the whole matrix
+        postings = self.matrix.tocsc()
+        self.postings = sp.csc_matrix((postings.data, self.rows[postings.indices], postings.indptr), shape=self.shape)
+
+    def positions(self, rows):
+        """Position of each of ``rows`` in ``self.rows``, -1 for rows without a change."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(self.rows):
+            return np.full(len(rows), -1)
+        found = np.minimum(np.searchsorted(self.rows, rows), len(self.rows) - 1)
+        return np.where(self.rows[found] == rows, found, -1)
+
+    def apply(self, stored):
+        """The whole matrix as CSR: ``stored`` (CSR or CSC) with these rows swapped in."""
+        dtype = self.matrix.dtype
+        matrix = sp.csr_matrix(stored, dtype=dtype, copy=True)
+        matrix.resize(self.shape)
+        scatter = sp.csr_matrix((np.ones(len(self.rows), dtype=dtype), (self.rows, np.arange(len(self.rows)))), shape=(self.shape[0], len(self.rows)))
+        matrix = sp.diags((~self.replaced).astype(dtype)) @ matrix + scatter @ self.matrix
+        matrix.eliminate_zeros()
+        return matrix
+
+
+def column(stored, delta, term):
+    """Rows and values of column ``term`` of the CSC matrix ``stored`` with ``delta`` (or None) applied."""
+    rows, values = stored.indices[:0], stored.data[:0]
+    if term < stored.shape[1]:
+        start, end = stored.indptr[term], stored.indptr[term + 1]
+        rows, values = stored.indices[start:end], stored.data[start:end]
+    if delta is None:
+        return rows, values
+    keep = ~delta.replaced[rows]
+    start, end = delta.postings.indptr[term], delta.postings.indptr[term + 1]
+    return np.concatenate([rows[keep], delta.postings.indices[start:end]]), np.concatenate([values[keep], delta.postings.data[start:end]])
+
+
+def _stored_rows(stored, rows):
+    # CSR rows of a stored CSR or CSC matrix; a CSC one is read column by
+    # column, about SCAN_ENTRIES values at a time, never converted whole
+    if sp.isspmatrix_csr(stored):
+        return stored[rows]
+    position = np.full(stored.shape[0], -1, dtype=np.int64)
+    position[rows] = np.arange(len(rows))
+    indptr = np.asarray(stored.indptr)
+    out_rows, out_cols, out_values = [], [], []
+    first = 0
+    while first < stored.shape[1]:
+        last = min(max(int(np.searchsorted(indptr, indptr[first] + SCAN_ENTRIES, side="right")) - 1, first + 1), stored.shape[1])
+        start, end = indptr[first], indptr[last]
+        found = position[stored.indices[start:end]]
+        hit = np.flatnonzero(found >= 0)
+        out_rows.append(found[hit])
+        out_cols.append(np.searchsorted(indptr, start + hit, side="right") - 1)
+        out_values.append(stored.data[start:end][hit])
+        first = last
+    return sp.csr_matrix((np.concatenate(out_values), (np.concatenate(out_rows), np.concatenate(out_cols))), shape=(len(rows), stored.shape[1]))
+
+
+def take_rows(stored, delta, rows, n_cols):
+    """CSR rows ``rows`` (distinct) of the stored matrix with ``delta`` (or None) applied, ``n_cols`` wide.
+
+    Rows past the stored ones that the delta does not hold are empty.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if delta is None and sp.isspmatrix_csr(stored) and stored.shape[1] == n_cols:
+        return stored[rows]
+    changed = delta.positions(rows) if delta is not None else np.full(len(rows), -1)
+    parts = []
+    from_stored = np.flatnonzero((changed < 0) & (rows < stored.shape[0]))
+    if len(from_stored):
+        parts.append((from_stored, _stored_rows(stored, rows[from_stored]).tocoo()))
+    from_delta = np.flatnonzero(changed >= 0)
+    if len(from_delta):
+        parts.append((from_delta, delta.matrix[changed[from_delta]].tocoo()))
+    if not parts:
+        return sp.csr_matrix((len(rows), n_cols), dtype=delta.matrix.dtype if delta is not None else stored.dtype)
+    return sp.csr_matrix(
+        (np.concatenate([part.data for _, part in parts]),
+         (np.concatenate([positions[part.row] for positions, part in parts]), np.concatenate([part.col for _, part in parts]))),
+        shape=(len(rows), n_cols),
+    )
+
+
+def top_k(rows, scores, k):
+    # Partial selection, then sort only the k winners (ties by row for stable output)
+    if len(rows) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[part], scores[part]
+    order = np.lexsort((rows, -scores))
+    return rows[order], scores[order]
+
+
+# -----------------------
+# Source fingerprints
+# -----------------------
+def _file_stat(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def source_digest(paths):
+    # Content hash of the source CSVs, salted with the index format version
+    h = hashlib.sha256(f"bookshelf-index-v{INDEX_VERSION}".encode())
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def index_path(digest, root=INDEX_ROOT, generation=0):
+    # Incremental updates (see update_index.py) are numbered generations of a full build
+    suffix = f"-g{generation}" if generation else ""
+    return os.path.join(root, f"v{INDEX_VERSION}-{digest[:16]}{suffix}")
+
+
+def staging_path(digest, root=INDEX_ROOT, generation=0):
+    # Builds are written here and renamed into place by save_index; other
+    # artifacts (e.g. the review store) can be staged alongside first
+    return f"{index_path(digest, root, generation)}.tmp-{os.getpid()}"
+
+
+@contextlib.contextmanager
+def build_lock(root=INDEX_ROOT):
+    """Hold the exclusive lock of the index builds under ``root`` (``<root>/.build.lock``).
+
+    Builds and updates write and swap whole directories; with the lock,
+    workers starting on a cold index directory build it once and the others
+    wait for that build instead of racing it.
+    """
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".build.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_meta(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        return json.load(f)
+
+
+def segment_paths(path, name):
+    """``<path>/<name>`` and the ``<name>-g<generation>`` segments added to it by updates, oldest first."""
+    generations = [0]
+    for entry in os.listdir(path):
+        if entry.startswith(f"{name}-g") and entry[len(name) + 2:].isdigit():
+            generations.append(int(entry[len(name) + 2:]))
+    return [os.path.join(path, f"{name}-g{g}" if g else name) for g in sorted(generations)]
+
+
+def find_index(paths, root=INDEX_ROOT):
+    """Return the directory of the index built from ``paths``, or None.
+
+    Hashing a multi-GB reviews dump on every boot would defeat the purpose,
+    so an index whose recorded file sizes and mtimes still match is trusted
+    without re-reading the sources. Of several generations of the same
+    build the latest wins.
+    """
+    found = index_generations(paths, root)
+    if not found:
+        base = os.path.basename(index_path(source_digest(paths), root))
+        found = _generations(root, lambda meta: True, prefix=base)
+    return max(found)[1] if found else None
+
+
+def index_generations(paths, root=INDEX_ROOT):
+    """``(generation, path)`` of every finished index whose sources still match ``paths``, oldest first."""
+    stats = {os.path.basename(p): _file_stat(p) for p in paths}
+    return sorted(_generations(root, lambda meta: meta.get("sources") == stats))
+
+
+def _generations(root, accept, prefix=f"v{INDEX_VERSION}-"):
+    # (generation, path) of the finished index directories under root
+    found = []
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if not name.startswith(prefix) or ".tmp-" in name or not os.path.exists(os.path.join(path, "meta.json")):
+                continue
+            meta = read_meta(path)
+            if accept(meta):
+                found.append((meta.get("generation", 0), path))
+    return found
+
+
+# -----------------------
+# Save / load
+# -----------------------
+def save_sparse(path, prefix, matrix):
+    np.save(os.path.join(path, f"{prefix}data.npy"), matrix.data)
+    np.save(os.path.join(path, f"{prefix}indices.npy"), matrix.indices)
+    np.save(os.path.join(path, f"{prefix}indptr.npy"), matrix.indptr)
+
+
+def load_sparse(path, prefix, shape, cls, mmap_mode):
+    data = np.load(os.path.join(path, f"{prefix}data.npy"), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(path, f"{prefix}indices.npy"), mmap_mode=mmap_mode)
+    indptr = np.load(os.path.join(path, f"{prefix}indptr.npy"), mmap_mode=mmap_mode)
+    return cls((data, indices, indptr), shape=shape, copy=False)
+
+
+def link_sparse(src, dst, prefix):
+    # Hard links to the arrays stored by another generation: same data, no copy
+    for name in ("data", "indices", "indptr"):
+        os.link(os.path.join(src, f"{prefix}{name}.npy"), os.path.join(dst, f"{prefix}{name}.npy"))
+
+
+def save_delta(path, prefix, delta):
+    np.save(os.path.join(path, f"{prefix}delta_rows.npy"), delta.rows)
+    delta.matrix.sort_indices()
+    save_sparse(path, f"{prefix}delta_", delta.matrix)
+
+
+def load_delta(path, prefix, shape):
+    """The ``RowDelta`` stored with ``prefix`` for a ``shape`` matrix, or None when there is none."""
+    rows_path = os.path.join(path, f"{prefix}delta_rows.npy")
+    if not os.path.exists(rows_path):
+        return None
+    rows = np.load(rows_path)
+    return RowDelta(rows, load_sparse(path, f"{prefix}delta_", (len(rows), shape[1]), sp.csr_matrix, None), shape[0])
+
+
+def save_index(index, paths, root=INDEX_ROOT, digest=None, generation=0, extra_meta=None, base_from=None):
+    """Write ``index`` as a finished index directory and return its path.
+
+    With ``base_from``, the directory ``index.matrix`` was loaded from, the
+    stored matrix is hard-linked from there and only the delta is written.
+    """
+    digest = digest or source_digest(paths)
+    path = index_path(digest, root, generation)
+    tmp_path = staging_path(digest, root, generation)
+    os.makedirs(tmp_path, exist_ok=True)
+
+    tfidf_matrix = index.matrix
+    terms = index.vectorizer.get_feature_names_out().tolist()
+
+    with open(os.path.join(tmp_path, "vocabulary.json"), "w", encoding="utf-8") as f:
+        json.dump(terms, f, ensure_ascii=False)
+    np.save(os.path.join(tmp_path, "idf.npy"), index.vectorizer.idf_)
+    if base_from is None:
+        tfidf_matrix.sort_indices()
+        index.matrix_csc.sort_indices()
+        save_sparse(tmp_path, "", tfidf_matrix)
+        save_sparse(tmp_path, "csc_", index.matrix_csc)
+    else:
+        link_sparse(base_from, tmp_path, "")
+        link_sparse(base_from, tmp_path, "csc_")
+    if index.delta is not None:
+        save_delta(tmp_path, "", index.delta)
+
+    meta = {
+        "version": INDEX_VERSION,
+        "digest": digest,
+        "shape": [index.n_rows, index.n_terms],
+        # Of the stored matrix; the delta rows come on top
+        "stored_shape": list(tfidf_matrix.shape),
+        "nnz": int(tfidf_matrix.nnz) + (int(index.delta.matrix.nnz) if index.delta is not None else 0),
+        "sources": {os.path.basename(p): _file_stat(p) for p in paths},
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "generation": generation,
+        # Books of the full build; later generations append the works deltas
+        "base_rows": index.n_rows,
+        "works_deltas": [],
+        **(extra_meta or {}),
+    }
+    # meta.json is written last: a directory without it is an unfinished build
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # Swap the finished build into place so readers never see a partial index
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_index(path, mmap=True):
+    mmap_mode = "r" if mmap else None
+    meta = read_meta(path)
+    if meta["version"] != INDEX_VERSION:
+        raise ValueError(f"Index at {path} has version {meta['version']}, expected {INDEX_VERSION}")
+
+    with open(os.path.join(path, "vocabulary.json"), encoding="utf-8") as f:
+        terms = json.load(f)
+    vectorizer = make_vectorizer(vocabulary={term: i for i, term in enumerate(terms)})
+    vectorizer.idf_ = np.load(os.path.join(path, "idf.npy"))
+
+    shape = tuple(meta["shape"])
+    stored_shape = tuple(meta.get("stored_shape", shape))
+    tfidf_matrix = load_sparse(path, "", stored_shape, sp.csr_matrix, mmap_mode)
+    matrix_csc = load_sparse(path, "csc_", stored_shape, sp.csc_matrix, mmap_mode)
+    return TfidfIndex(vectorizer, tfidf_matrix, matrix_csc, load_delta(path, "", shape))
+
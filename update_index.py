@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental updates of a built index: new works and new reviews.
+
+    python update_index.py [--works-delta new_works.csv] [--reviews-delta new_reviews.csv] [--refit-idf]
+
+A delta never touches the index the workers are reading. It is written as
+the next generation of the latest build (``v<version>-<digest>-g<N>``):
+
+* only the delta is tokenized; its term counts are added to the per-field
+  counts of the books it touches (new terms get new ids at the end);
+* the TF-IDF rows of the added works and of the works with new reviews are
+  weighted with the existing IDF, the other rows are kept as they are;
+* the TF-IDF matrix and the BM25F field counts of the last full fit are
+  hard-linked, and only the rows changed since then are written next to
+  them (``tfidf_index.RowDelta``). An update costs memory and disk in
+  proportion to those rows, not to the index;
+* the changed rows get fresh similar-books lists and, when there is one, a
+  place in the ANN index;
+* the delta's reviews and descriptions become one more segment of the
+  review store and the description column. Unchanged segments, and the
+  works CSVs of earlier deltas, are hard-linked from the previous
+  generation instead of copied.
+
+The IDF itself drifts as rows change. Once more than ``REFIT_FRACTION`` of
+the books changed since the last refit (or with ``--refit-idf``), the delta
+is folded in and the whole generation is re-derived from the summed counts
+instead: IDF, every row, BM25F, all similar-books lists and the ANN index.
+That is what a full build of the same data gives, without tokenizing
+anything again. Run it from cron or any background job; serving is never
+paused.
+
+Running workers pick the new generation up by themselves (see
+app_context.py). The oldest generations beyond ``KEEP_GENERATIONS`` are
+deleted once a newer one has been out for ``RETIRE_SECONDS``: by then every
+worker has moved on from them, including their query caches.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import normalize
+
+import ann_index
+import bm25f_index
+import catalog
+import metrics
+import neighbors
+import review_store
+import tfidf_index
+
+REFIT_FRACTION = float(os.environ.get("BOOKSHELF_REFIT_FRACTION", 0.1))
+KEEP_GENERATIONS = 3
+# How long a superseded generation is kept: well past BOOKSHELF_RELOAD_SECONDS
+# (app_context.py) plus the time a worker takes to load the next one
+RETIRE_SECONDS = float(os.environ.get("BOOKSHELF_RETIRE_SECONDS", 600))
+
+logger = logging.getLogger(__name__)
+
+
+def _link_tree(src, dst):
+    # Hard-link every file of src into dst: same data, no copy
+    os.makedirs(dst, exist_ok=True)
+    for name in os.listdir(src):
+        if os.path.isdir(os.path.join(src, name)):
+            _link_tree(os.path.join(src, name), os.path.join(dst, name))
+        else:
+            os.link(os.path.join(src, name), os.path.join(dst, name))
+
+
+def _idf(counts, n_rows):
+    # TfidfTransformer's smoothed IDF
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    return np.log((1 + n_rows) / (1 + df)) + 1
+
+
+def update(works_path, reviews_path, works_delta=None, reviews_delta=None, refit_idf=None,
+           root=tfidf_index.INDEX_ROOT, chunksize=catalog.REVIEW_CHUNKSIZE, workers=None):
+    """Write the next generation of the index for the CSVs with the deltas applied, and return its directory.
+
+    ``refit_idf`` forces (True) or skips (False) the full re-weighting;
+    by default it runs once ``REFIT_FRACTION`` of the books changed.
+    """
+    paths = [works_path, reviews_path]
+    path = tfidf_index.find_index(paths, root)
+    if path is None:
+        raise FileNotFoundError(f"No index for {works_path} and {reviews_path} in {root}; run build_index.py first")
+    meta = tfidf_index.read_meta(path)
+    generation = meta.get("generation", 0) + 1
+    staging = tfidf_index.staging_path(meta["digest"], root, generation)
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    timings = {}
+    timer = metrics.Stopwatch(timings.__setitem__)
+    works_deltas = list(meta.get("works_deltas", []))
+    delta_paths = [os.path.join(path, name) for name in works_deltas]
+    books_df = catalog.load_works(works_path, ["work_id"], deltas=delta_paths)
+    n_old = len(books_df)
+    new_works = pd.DataFrame()
+    if works_delta:
+        new_works = pd.read_csv(works_delta)
+        new_works = new_works[~new_works["work_id"].isin(books_df["work_id"])].drop_duplicates("work_id")
+        if len(new_works):
+            name = f"works-g{generation}.csv"
+            new_works.to_csv(os.path.join(staging, name), index=False)
+            works_deltas.append(name)
+            delta_paths.append(os.path.join(staging, name))
+    n_rows = n_old + len(new_works)
+    work_ids = pd.concat([books_df["work_id"], new_works.get("work_id", pd.Series(dtype=np.int64))], ignore_index=True)
+    positions = catalog.WorkPositions(work_ids)
+
+    # Term counts of the delta only, on top of the previous vocabulary
+    old_index = tfidf_index.load_index(path)
+    old_bm25f = bm25f_index.load(os.path.join(path, "bm25f"), old_index.vectorizer)
+    counter = tfidf_index.TermCounter(old_index.vectorizer.vocabulary)
+    delta = {}
+    new_rows = np.arange(n_old, n_rows)
+    for field, column in tfidf_index.FIELD_COLUMNS.items():
+        texts = new_works[column].astype(object).fillna("") if len(new_works) else []
+        delta[field] = counter.count(texts, new_rows, n_rows)
+    review_rows = []
+    if reviews_delta:
+        parts = tfidf_index.CountTotal()
+        for rows, texts in catalog.iter_review_chunks(reviews_delta, positions, chunksize):
+            parts.add(counter.count(texts, rows, n_rows), len(counter.vocabulary))
+            review_rows.append(rows)
+        delta["reviews"] = parts.result(n_rows, len(counter.vocabulary))
+    n_terms = len(counter.vocabulary)
+    changed = np.union1d(new_rows, np.concatenate(review_rows) if review_rows else np.empty(0, dtype=np.int64)).astype(np.int64)
+    timer.lap("count")
+    logger.info("Counted %d new works and the reviews of %d books in %.1fs", len(new_works), len(changed) - len(new_works), timings["count"])
+    if not len(changed) and not refit_idf:
+        shutil.rmtree(staging)
+        logger.info("Nothing to update")
+        return path
+
+    # Every row that differs from the stored matrices: the ones changed since
+    # the last refit and this delta's. Their per-field counts are read from
+    # the previous generation and the delta added
+    stale = np.union1d(old_index.delta.rows if old_index.delta is not None else [], changed).astype(np.int64)
+    fields, before = {}, []
+    for field in tfidf_index.FIELDS:
+        counts = tfidf_index.take_rows(old_bm25f.fields[field], old_bm25f.deltas.get(field), stale, n_terms).astype(np.float32)
+        before.append(counts)
+        if field in delta:
+            added = delta[field][stale]
+            added.resize((len(stale), n_terms))
+            counts = counts + added.astype(np.float32)
+        fields[field] = counts
+    weighted = tfidf_index.weighted_counts(fields)
+    similar_books = catalog.load_similar_books(works_path, delta_paths)
+
+    stale_rows = len(stale)
+    if refit_idf is None:
+        refit_idf = stale_rows > REFIT_FRACTION * n_rows
+    timer.lap("weight")
+    if refit_idf:
+        # Same as a full build of the same data: IDF, rows and term order from the counts
+        fields = {field: tfidf_index.RowDelta(stale, counts, n_rows).apply(old_bm25f.fields[field]) for field, counts in fields.items()}
+        index = tfidf_index.fit_counts(tfidf_index.weighted_counts(fields), counter.vocabulary)
+        similar = neighbors.compute(index.matrix, workers=workers)
+        bm25f = bm25f_index.build(fields, counter.vocabulary, index.vectorizer)
+        stale_rows = 0
+        base_from = None
+    else:
+        vectorizer = tfidf_index.make_vectorizer(vocabulary=counter.vocabulary)
+        idf = np.concatenate([old_index.vectorizer.idf_, _idf(weighted, n_rows)[len(old_index.vectorizer.idf_):]])
+        vectorizer.idf_ = idf
+        # Unchanged rows keep their vectors; changed rows are weighted with the
+        # current IDF (the same as before for the terms they already had).
+        # Their neighbors lists are recomputed, the other rows' lists only
+        # learn about new books at the next refit
+        rows = normalize(weighted.multiply(idf).tocsr())
+        index = tfidf_index.TfidfIndex(vectorizer, old_index.matrix, old_index.matrix_csc, tfidf_index.RowDelta(stale, rows, n_rows))
+        similar = np.full((n_rows, neighbors.N_NEIGHBORS), -1, dtype=np.int32)
+        similar[:n_old] = neighbors.load(path)
+        similar[changed] = neighbors.compute_rows(index, changed)
+
+        # BM25F: the same rows as field deltas, with the lengths and the
+        # document frequencies moved by what they gained
+        lengths = {}
+        for field, counts in fields.items():
+            lengths[field] = np.zeros(n_rows, dtype=np.float32)
+            lengths[field][:n_old] = old_bm25f.lengths[field]
+            lengths[field][stale] = np.asarray(counts.sum(axis=1)).ravel()
+        df = np.zeros(n_terms, dtype=np.int64)
+        df[:len(old_bm25f.df)] = old_bm25f.df
+        df += np.bincount(tfidf_index.add_counts(list(fields.values()), n_terms).indices, minlength=n_terms)
+        df -= np.bincount(tfidf_index.add_counts(before, n_terms).indices, minlength=n_terms)
+        deltas = {field: tfidf_index.RowDelta(stale, counts, n_rows) for field, counts in fields.items()}
+        bm25f = bm25f_index.Bm25fIndex(vectorizer, old_bm25f.fields, lengths, df, deltas=deltas)
+        base_from = path
+    if similar_books is not None:
+        curated = neighbors.curated(similar_books, positions)
+        if refit_idf:
+            similar = neighbors.merge(curated, similar)
+        else:
+            similar[changed] = neighbors.merge(curated[changed], similar[changed])
+    neighbors.save(staging, similar)
+    bm25f_index.save(bm25f, os.path.join(staging, "bm25f"), base_from and os.path.join(base_from, "bm25f"))
+    if os.path.exists(os.path.join(path, "ann", "meta.json")):
+        ann = ann_index.build(index) if refit_idf else ann_index.update(ann_index.load(os.path.join(path, "ann"), old_index.vectorizer), index, changed)
+        ann_index.save(ann, os.path.join(staging, "ann"))
+    phase = "fit" if refit_idf else "update_rows"
+    timer.lap(phase)
+    logger.info("%s %d rows in %.1fs", "Refitted all" if refit_idf else "Updated", n_rows if refit_idf else len(changed), timings[phase])
+
+    # Review and description segments: the previous ones linked, the delta's added
+    for name in ("reviews", "descriptions"):
+        for segment in tfidf_index.segment_paths(path, name):
+            _link_tree(segment, os.path.join(staging, os.path.basename(segment)))
+    for name in works_deltas:
+        if not os.path.exists(os.path.join(staging, name)):
+            os.link(os.path.join(path, name), os.path.join(staging, name))
+    if reviews_delta:
+        review_store.build(reviews_delta, positions, os.path.join(staging, f"reviews-g{generation}"), chunksize)
+    if len(new_works):
+        catalog.save_text_column(new_works["description"], os.path.join(staging, f"descriptions-g{generation}"))
+    timer.lap("segments")
+
+    extra_meta = {"base_rows": meta.get("base_rows", meta["shape"][0]), "works_deltas": works_deltas, "stale_rows": stale_rows, "build_seconds": timings}
+    new_path = tfidf_index.save_index(index, paths, root, meta["digest"], generation, extra_meta, base_from)
+    remove_old_generations(paths, root)
+    return new_path
+
+
+def remove_old_generations(paths, root=tfidf_index.INDEX_ROOT, keep=KEEP_GENERATIONS, retire_seconds=RETIRE_SECONDS):
+    """Delete the generations beyond the latest ``keep`` that were superseded more than ``retire_seconds`` ago.
+
+    Workers only load a newer generation on their next check, so one is
+    deleted once the generation after it has been out long enough: until
+    then a worker may still be reading it (and its query cache).
+    """
+    found = tfidf_index.index_generations(paths, root)
+    now = time.time()
+    for (_, path), (_, successor) in zip(found[:-keep], found[1:]):
+        if now - os.path.getmtime(os.path.join(successor, "meta.json")) > retire_seconds:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply new works and reviews to the index of app20.py")
+    parser.add_argument("--works", default=catalog.WORKS_CSV, help="works CSV the index was built from")
+    parser.add_argument("--reviews", default=catalog.REVIEWS_CSV, help="reviews CSV the index was built from")
+    parser.add_argument("--works-delta", help="CSV of new works, same columns as the works CSV")
+    parser.add_argument("--reviews-delta", help="CSV of new reviews, same columns as the reviews CSV")
+    parser.add_argument("--refit-idf", action="store_true", default=None, help="re-weight every row with a fresh IDF")
+    parser.add_argument("--out", default=tfidf_index.INDEX_ROOT)
+    parser.add_argument("--workers", type=int, default=None, help="processes for the similar-books job of a refit (default: all cores)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with tfidf_index.build_lock(args.out):
+        path = update(args.works, args.reviews, args.works_delta, args.reviews_delta, args.refit_idf, args.out, workers=args.workers)
+    print(f"Wrote index to {path}")
+
+
+if __name__ == "__main__":
+    main()